@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmark of synchronous against asynchronous (AsyncWriter) reporting.
+
+Runs a Lennard-Jones water-like box with a StateDataReporter log and a
+DCDReporter firing every --interval steps, once with the reporters called on
+the integrator's thread and once wrapped by OpenMMRunner.AsyncWriter. The
+optional --latency adds a sleep to every report to mimic a slow network
+filesystem. Step throughput is reported for both modes.
+
+Usage (with mstbx installed or on PYTHONPATH):
+    python benchmarks/bench_async_io.py --atoms 30000 --interval 10 --latency 5
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from openmm import LangevinMiddleIntegrator, NonbondedForce, Platform, System, Vec3
+from openmm.app import DCDReporter, Element, Simulation, StateDataReporter, Topology
+from openmm.unit import kelvin, nanometers, picosecond, picoseconds
+
+from mstbx.core.MDProtocols.OpenMMRunner import AsyncWriter
+
+
+class SlowReporter(object):
+    """Adds a fixed delay after every report, like a write to a slow filesystem."""
+
+    def __init__(self, reporter, latency):
+        self.reporter = reporter
+        self.latency = latency
+
+    def describeNextReport(self, simulation):
+        return self.reporter.describeNextReport(simulation)
+
+    def report(self, simulation, state):
+        self.reporter.report(simulation, state)
+        time.sleep(self.latency)
+
+
+def lj_box(natoms, seed=2024):
+    rng = np.random.default_rng(seed)
+    box = (natoms * 0.03) ** (1.0 / 3.0)
+    topology = Topology()
+    chain = topology.addChain()
+    oxygen = Element.getBySymbol("O")
+    system = System()
+    force = NonbondedForce()
+    force.setNonbondedMethod(NonbondedForce.CutoffPeriodic)
+    force.setCutoffDistance(0.9)
+    for _ in range(natoms):
+        topology.addAtom("OW", oxygen, topology.addResidue("WAT", chain))
+        system.addParticle(18.0)
+        force.addParticle(0.0, 0.3, 0.5)
+    system.addForce(force)
+    vectors = [Vec3(box, 0, 0), Vec3(0, box, 0), Vec3(0, 0, box)]
+    system.setDefaultPeriodicBoxVectors(*vectors)
+    topology.setPeriodicBoxVectors(vectors)
+    grid = int(np.ceil(natoms ** (1.0 / 3.0)))
+    points = np.stack(np.meshgrid(*[np.arange(grid)] * 3, indexing="ij"), -1).reshape(-1, 3)[:natoms]
+    positions = (points + 0.5) * box / grid + rng.normal(0.0, 0.01, size=(natoms, 3))
+    return topology, system, positions
+
+
+def run(topology, system, positions, platform, steps, interval, latency, workdir, async_io):
+    integrator = LangevinMiddleIntegrator(300 * kelvin, 1 / picosecond, 0.002 * picoseconds)
+    sim = Simulation(topology, system, integrator, Platform.getPlatformByName(platform))
+    sim.context.setPositions(positions * nanometers)
+    sim.context.setVelocitiesToTemperature(300 * kelvin, 1)
+    sim.step(10)
+
+    tag = "async" if async_io else "sync"
+    reporters = [
+        StateDataReporter(os.path.join(workdir, f"{tag}.log"), interval, step=True, potentialEnergy=True,
+                          temperature=True, volume=True, speed=True, separator="\t"),
+        DCDReporter(os.path.join(workdir, f"{tag}.dcd"), interval),
+    ]
+    if latency > 0:
+        reporters = [SlowReporter(reporter, latency) for reporter in reporters]
+    writer = AsyncWriter() if async_io else None
+    if writer:
+        reporters = [writer.wrap(reporter) for reporter in reporters]
+    sim.reporters.extend(reporters)
+
+    start = time.perf_counter()
+    sim.step(steps)
+    if writer:
+        writer.close()
+    return steps / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--atoms", type=int, default=20000, help="Number of particles.")
+    parser.add_argument("--steps", type=int, default=2000, help="Timed steps per mode.")
+    parser.add_argument("--interval", type=int, default=10, help="Report interval for the log and DCD (steps).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Extra delay per report in milliseconds.")
+    parser.add_argument("--platform", default="CPU", help="OpenMM platform name.")
+    args = parser.parse_args()
+
+    topology, system, positions = lj_box(args.atoms)
+    print(f"atoms={args.atoms} steps={args.steps} interval={args.interval} latency={args.latency} ms platform={args.platform}")
+    with tempfile.TemporaryDirectory() as workdir:
+        rates = {}
+        for async_io in (False, True):
+            rates[async_io] = run(topology, system, positions, args.platform, args.steps, args.interval,
+                                  args.latency / 1000.0, workdir, async_io)
+        print(f"sync reporters  : {rates[False]:10.1f} steps/s")
+        print(f"async reporters : {rates[True]:10.1f} steps/s")
+        print(f"speedup         : {rates[True] / rates[False]:10.2f} x")
+
+
+if __name__ == "__main__":
+    main()
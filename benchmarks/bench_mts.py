@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark of MTSLangevin against LangevinMiddle on a CHARMM-GUI system.
+
+Loads a solvated protein the way openmm-run does (PSF, coordinates, box from
+the step3 .str, toppar directory), builds the System once per integrator and
+times a block of steps for LangevinMiddle at --dt and for MTSLangevin with
+PME reciprocal space (and with --mts-vdw also the force-switched LJ) in the
+slow group at --mts-dt, split --ratio times for the fast forces. Throughput
+is reported in steps/s and ns/day; the potential energy after the warm-up is
+printed so obviously unstable settings stand out.
+
+Usage (with mstbx installed or on PYTHONPATH, from a CHARMM-GUI openmm/ folder):
+    python benchmarks/bench_mts.py --psf step3_input.psf --crd step3_input.crd --ratio 2 --mts-dt 0.004
+"""
+
+import argparse
+import copy
+import time
+
+from openmm import Platform
+from openmm.app import Simulation
+from openmm.unit import kelvin, kilojoules_per_mole
+
+from mstbx.core.MDProtocols.OpenMMRunner import (
+    OpenMMReadInputs,
+    load_system,
+    make_integrator,
+    read_box_from_str,
+    read_crd,
+    read_top,
+)
+
+
+def run(psf_path, crd_path, pbc, toppar, inputs, platform, steps, warmup):
+    psf = read_box_from_str(pbc, read_top(psf_path))
+    crd = read_crd(crd_path, psf_path)
+    system = load_system(psf, psf_path, toppar, inputs, use_cache=False)
+    integrator = make_integrator(inputs, system)
+    sim = Simulation(psf.topology, system, integrator, Platform.getPlatformByName(platform))
+    sim.context.setPositions(crd.positions)
+    sim.minimizeEnergy(maxIterations=200)
+    sim.context.setVelocitiesToTemperature(inputs.temp * kelvin, 1)
+    sim.step(warmup)
+    energy = sim.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+
+    start = time.perf_counter()
+    sim.step(steps)
+    rate = steps / (time.perf_counter() - start)
+    return rate, rate * inputs.dt * 86400 / 1000.0, energy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--psf", required=True, help="Topology (.psf).")
+    parser.add_argument("--crd", required=True, help="Coordinates (.crd or .pdb).")
+    parser.add_argument("--pbc", default="01build/step3_pbcsetup.str", help="CHARMM-GUI box .str file.")
+    parser.add_argument("--toppar", default="toppar/", help="Toppar directory.")
+    parser.add_argument("--platform", default="CPU", help="OpenMM platform name.")
+    parser.add_argument("--steps", type=int, default=500, help="Timed steps per integrator.")
+    parser.add_argument("--warmup", type=int, default=50, help="Untimed steps before timing.")
+    parser.add_argument("--dt", type=float, default=0.002, help="LangevinMiddle time step (ps).")
+    parser.add_argument("--mts-dt", type=float, default=0.004, help="MTSLangevin outer (slow) time step (ps).")
+    parser.add_argument("--ratio", type=int, default=2, help="Fast-force evaluations per MTS outer step.")
+    parser.add_argument("--mts-vdw", action="store_true", help="Also put the vfswitch CustomNonbondedForce in the slow group.")
+    args = parser.parse_args()
+
+    base = OpenMMReadInputs()
+    base.init_openmm_defaults()
+    base.temp = 300.0
+    middle = copy.copy(base)
+    middle.integrator, middle.dt = "LangevinMiddle", args.dt
+    mts = copy.copy(base)
+    mts.integrator, mts.dt, mts.mts_ratio, mts.mts_vdw = "MTSLangevin", args.mts_dt, args.ratio, "yes" if args.mts_vdw else "no"
+
+    print(f"psf={args.psf} platform={args.platform} steps={args.steps}")
+    results = {}
+    for label, inputs in (("LangevinMiddle", middle), ("MTSLangevin", mts)):
+        results[label] = run(args.psf, args.crd, args.pbc, args.toppar, inputs, args.platform, args.steps, args.warmup)
+        rate, ns_day, energy = results[label]
+        print(f"{label:<15s}: dt={inputs.dt * 1000:g} fs {rate:10.1f} steps/s {ns_day:8.2f} ns/day  PE={energy:.1f} kJ/mol")
+    print(f"speedup (ns/day): {results['MTSLangevin'][1] / results['LangevinMiddle'][1]:10.2f} x")
+
+
+if __name__ == "__main__":
+    main()
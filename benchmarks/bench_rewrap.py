@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark of OpenMMRunner.rewrap (NumPy) against rewrap_legacy (CHARMM-GUI).
+
+Builds a force-free water box on the Reference platform, breaks a fraction
+of the molecules across the periodic boundary, runs both rewrap paths on
+identical contexts and reports wall time and the largest coordinate
+difference between them.
+
+Usage (with mstbx installed or on PYTHONPATH):
+    python benchmarks/bench_rewrap.py --waters 100000 --broken 0.01
+"""
+
+import argparse
+import time
+
+import numpy as np
+from openmm import Platform, System, Vec3, VerletIntegrator
+from openmm.app import Element, Simulation, Topology
+from openmm.unit import nanometers
+
+from mstbx.core.MDProtocols.OpenMMRunner import rewrap, rewrap_legacy
+
+
+def water_box(nwat, broken, seed=2024):
+    rng = np.random.default_rng(seed)
+    box = (nwat * 0.0299) ** (1.0 / 3.0)
+    topology = Topology()
+    chain = topology.addChain()
+    oxygen = Element.getBySymbol("O")
+    hydrogen = Element.getBySymbol("H")
+    for _ in range(nwat):
+        residue = topology.addResidue("TIP3", chain)
+        o = topology.addAtom("OH2", oxygen, residue)
+        topology.addBond(o, topology.addAtom("H1", hydrogen, residue))
+        topology.addBond(o, topology.addAtom("H2", hydrogen, residue))
+
+    positions = np.repeat(rng.uniform(0.0, box, size=(nwat, 1, 3)), 3, axis=1)
+    positions[:, 1:, :] += rng.normal(0.0, 0.06, size=(nwat, 2, 3))
+    split = rng.choice(nwat, size=int(nwat * broken), replace=False)
+    positions[split, 1, rng.integers(0, 3, size=len(split))] += box
+    positions = positions.reshape(-1, 3)
+
+    vectors = [Vec3(box, 0, 0), Vec3(0, box, 0), Vec3(0, 0, box)]
+    topology.setPeriodicBoxVectors(vectors)
+    return topology, positions, vectors
+
+
+def make_simulation(topology, positions, vectors):
+    system = System()
+    for _ in range(topology.getNumAtoms()):
+        system.addParticle(1.0)
+    system.setDefaultPeriodicBoxVectors(*vectors)
+    sim = Simulation(topology, system, VerletIntegrator(0.001), Platform.getPlatformByName("Reference"))
+    sim.context.setPositions(positions * nanometers)
+    return sim
+
+
+def timed(func, sim):
+    start = time.perf_counter()
+    func(sim)
+    elapsed = time.perf_counter() - start
+    state = sim.context.getState(getPositions=True)
+    return elapsed, state.getPositions(asNumpy=True).value_in_unit(nanometers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--waters", type=int, default=50000, help="Number of TIP3 molecules.")
+    parser.add_argument("--broken", type=float, default=0.01, help="Fraction of molecules split across the box.")
+    parser.add_argument("--skip-legacy", action="store_true", help="Only time the NumPy path.")
+    args = parser.parse_args()
+
+    topology, positions, vectors = water_box(args.waters, args.broken)
+    print(f"atoms={topology.getNumAtoms()} bonds={topology.getNumBonds()} broken_fraction={args.broken}")
+
+    t_new, pos_new = timed(rewrap, make_simulation(topology, positions, vectors))
+    # Second call reuses the cached topology index.
+    t_cached, _ = timed(rewrap, make_simulation(topology, positions, vectors))
+    print(f"rewrap (numpy, cold index) : {t_new:10.3f} s")
+    print(f"rewrap (numpy, warm index) : {t_cached:10.3f} s")
+
+    if not args.skip_legacy:
+        t_old, pos_old = timed(rewrap_legacy, make_simulation(topology, positions, vectors))
+        print(f"rewrap_legacy              : {t_old:10.3f} s")
+        print(f"speedup (warm)             : {t_old / max(t_cached, 1e-9):10.1f} x")
+        print(f"max |dx| vs legacy         : {np.abs(pos_new - pos_old).max():10.3e} nm")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the native solvation backend against VMD solvate.
+
+Solvates the same PSF/PDB over the same -minmax region (computed like
+PSFGenSol.tcl from --padding or the per-axis pads) twice: once with
+mstbx.core.Build.NativeSolvate in this process, once with a one-shot
+``vmd -dispdev text`` running ``solvate -minmax``. Reports wall time, peak
+resident memory (this process for the native run, the VMD child for VMD),
+and the number of waters and atoms each wrote. The VMD run is skipped when
+``vmd`` is not on PATH. A padding of 100 A around ubiquitin gives a system
+of roughly one million atoms.
+
+Usage (with mstbx installed or on PYTHONPATH):
+    python benchmarks/bench_solvate.py --psf mstbx/testing/ubiquitin/step1_pdbreader.psf \\
+        --pdb mstbx/testing/ubiquitin/step1_pdbreader.pdb --padding 100
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from mstbx.core.Build.NativeSolvate import read_pdb_coordinates, read_psf, solvate, solvation_box
+from mstbx.core.Utils.VMDSession import tcl_quote
+
+VMD_SCRIPT = """\
+package require solvate
+solvate %s %s -minmax {{%s} {%s}} -o %s
+quit
+"""
+
+
+def peak_rss_mb(who):
+    """Peak resident set size in MB (``ru_maxrss`` is in KB on Linux)."""
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def count_waters(psf):
+    atoms = read_psf(psf)[2]
+    return sum(1 for line in atoms if line.split()[3] == "TIP3") // 3, len(atoms)
+
+
+def run_native(psf, pdb, pads, workdir):
+    start = time.perf_counter()
+    result = solvate(psf, pdb, output=os.path.join(workdir, "native"), **pads)
+    seconds = time.perf_counter() - start
+    return seconds, peak_rss_mb(resource.RUSAGE_SELF), result["waters"], result["atoms"]
+
+
+def run_vmd(psf, pdb, minmax, workdir):
+    script = os.path.join(workdir, "solvate.tcl")
+    with open(script, "w") as handle:
+        handle.write(VMD_SCRIPT % (tcl_quote(os.path.abspath(psf)), tcl_quote(os.path.abspath(pdb)),
+                                   " ".join(f"{value:.4f}" for value in minmax[0]),
+                                   " ".join(f"{value:.4f}" for value in minmax[1]), "vmdsolv"))
+    start = time.perf_counter()
+    subprocess.run(["vmd", "-dispdev", "text", "-e", script], cwd=workdir, stdin=subprocess.DEVNULL,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, check=True)
+    seconds = time.perf_counter() - start
+    waters, atoms = count_waters(os.path.join(workdir, "vmdsolv.psf"))
+    return seconds, peak_rss_mb(resource.RUSAGE_CHILDREN), waters, atoms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--psf", required=True, help="Solute topology (.psf, X-PLOR format).")
+    parser.add_argument("--pdb", required=True, help="Solute coordinates (.pdb).")
+    parser.add_argument("--padding", type=float, default=18.0, help="Cubic padding (A), as topopsfgen --padding.")
+    for axis in ("x", "y", "z"):
+        for side in ("pos", "neg"):
+            parser.add_argument(f"--pad-{axis}-{side}", type=float, default=None, help=f"Per-axis padding {axis}{side} (A).")
+    parser.add_argument("--skip-vmd", action="store_true", help="Only time the native backend.")
+    parser.add_argument("--keep", action="store_true", help="Keep the output directory.")
+    args = parser.parse_args()
+
+    pads = {name: getattr(args, name) for name in ("padding", "pad_x_pos", "pad_x_neg", "pad_y_pos",
+                                                   "pad_y_neg", "pad_z_pos", "pad_z_neg")}
+    minmax = solvation_box(read_pdb_coordinates(args.pdb)[0], **pads)
+    workdir = tempfile.mkdtemp(prefix="bench_solvate-")
+    print(f"psf={args.psf} minmax={minmax.round(2).tolist()} workdir={workdir}")
+    try:
+        results = {"native": run_native(args.psf, args.pdb, pads, workdir)}
+        if args.skip_vmd or shutil.which("vmd") is None:
+            print("vmd        : skipped (not on PATH or --skip-vmd)")
+        else:
+            results["vmd"] = run_vmd(args.psf, args.pdb, minmax, workdir)
+        for label, (seconds, rss, waters, atoms) in results.items():
+            print(f"{label:<11s}: {seconds:9.2f} s  peak RSS {rss:9.1f} MB  {waters:9d} waters  {atoms:10d} atoms")
+        if "vmd" in results:
+            print(f"speedup    : {results['vmd'][0] / results['native'][0]:9.2f} x")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
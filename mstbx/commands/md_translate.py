@@ -3,6 +3,7 @@ import os
 import shutil
 import subprocess
 from mstbx.core.Utils.Utils import UnixMessage
+from mstbx.core.Utils.VMDSession import VMDJobError, run_tcl
 
 @click.command(help="Convierte archivos de NAMD (PSF/COOR/XSC) a formatos de otros motores (GROMACS, etc.).")
 @click.option('--psf', type=click.Path(exists=True, dir_okay=False), required=True, help="Archivo PSF de NAMD.")
@@ -35,13 +36,14 @@ quit
         with open("translate.tcl", "w") as f:
             f.write(tcl_script)
             
-        exit_code = os.system("vmd -dispdev text -e translate.tcl > /dev/null")
-        os.remove("translate.tcl")
-
-        if exit_code != 0:
-            message = f"VMD exited with a non-zero status ({exit_code}) while translating {psf}."
+        try:
+            run_tcl("translate.tcl", echo=False)
+        except VMDJobError as error:
+            message = f"VMD failed while translating {psf}: {error}"
             uxm.message(message, "error")
-            raise click.ClickException(message)
+            raise click.ClickException(message) from error
+        finally:
+            os.remove("translate.tcl")
 
         uxm.message(f"Conversión a {target} (parcial) completada.", "info")
         uxm.message("Nota: La conversión completa de topología requiere TopoTools instalado en VMD.", "warning")
@@ -2,26 +2,76 @@ import click
 import os
 import sys
 from mstbx.core.Utils.Utils import UnixMessage
-from mstbx.core.MDProtocols.OpenMMRunner import run_simulation, generate_default_inps
+from mstbx.core.Utils.ClickHelp import explicit as _explicit
+from mstbx.core.MDProtocols.OpenMMRunner import run_simulation, run_protocol, run_ensemble, generate_default_inps, convert_restart, WALLTIME_EXIT_CODE
 
 @click.command(help="Strict Manual OpenMM Runner for CHARMM-GUI systems.")
 @click.option('-i', '--inp', type=click.Path(exists=True, dir_okay=False), help="Input file (.inp)")
 @click.option('-p', '--psf', type=click.Path(exists=True, dir_okay=False), help="Topology file (.psf)")
 @click.option('-c', '--pdb', type=click.Path(exists=True, dir_okay=False), help="Coordinates file (.pdb)")
 @click.option('--mk-inp', is_flag=True, help="Generate default .inp templates (min.inp, eq1.inp, prod.inp)")
-@click.option('-irst', '--irst', type=click.Path(exists=True, dir_okay=False), help="Input restart (.rst)")
-@click.option('-orst', '--orst', default="output", help="Output prefix")
+@click.option('--hmr', is_flag=True, help="With --mk-inp, write a 4 fs profile (HMASS = 3.024 amu, dt = 0.004 ps, step counts scaled to keep the same ns)")
+@click.option('--protocol', is_flag=True, help="Run every --mk-inp stage (02eq1 -> 03eq2 -> 04prod) in one process and one Context")
+@click.option('--replicas', type=click.IntRange(min=1), default=None, help="Run N replicas of the stage in parallel, one gen_seed each (gen_seed, gen_seed+1, ...), writing to rep{i}/")
+@click.option('-irst', '--irst', type=click.Path(exists=True, dir_okay=False), help="Input restart (XML .rst or binary .npz)")
+@click.option('-orst', '--orst', default="output", help="Output prefix; ending it in .npz writes a binary restart instead of XML")
+@click.option('--compress-rst', is_flag=True, help="Compress .npz restarts (smaller files, slower to write)")
+@click.option('--convert-rst', nargs=2, type=click.Path(dir_okay=False), default=None, metavar="SRC DST", help="Convert a restart between XML (.rst) and binary (.npz) and exit")
 @click.option('--toppar', default="toppar/", help="Toppar directory")
 @click.option('--pbc', default=None, help="PBC str file")
 @click.option('--platform', help="Force platform (CUDA, OpenCL, CPU)")
+@click.option('--autotune', is_flag=True, help="On CPU, benchmark Threads and PME grid choices and use the fastest (cached per host and system size)")
 @click.option('--ns', type=float, help="Override duration in nanoseconds")
 @click.option('--rewrap', is_flag=True, help="Apply centering (Original CHARMM-GUI logic)")
+@click.option('--resume', is_flag=True, help="Continue from the newest {orst}.chk checkpoint (written every NSTCHK steps), appending to the existing DCD and log")
+@click.option('--max-hours', type=click.FloatRange(min=0, min_open=True), default=None, help=f"Stop cleanly before this many hours (or SLURM_JOB_END_TIME, if earlier) with a checkpoint, exiting with status {WALLTIME_EXIT_CODE}; rerun with --resume")
+@click.option('--async-io', is_flag=True, help="Write the log, DCD and XTC from a background thread so dynamics overlaps with disk I/O")
+@click.option('--energy-table', type=click.Choice(['csv', 'parquet']), default=None, help="Also write the numeric log columns to {orst}_energy.csv or .parquet")
+@click.option('--metrics', type=click.Path(dir_okay=False), default=None, help="Rewrite this file with ns/day, steps, ETA, energy, temperature, volume, peak RSS and checkpoint age on every log row (Prometheus textfile, or JSON if it ends in .json)")
+@click.option('--profile-forces', is_flag=True, help="Set up and minimize the stage, then time each force (one force group each) and write {orst}_forces.csv instead of running dynamics")
+@click.option('--no-param-cache', is_flag=True, help="Always re-parse toppar files instead of using the on-disk parameter cache")
+@click.option('--no-system-cache', is_flag=True, help="Always rebuild the OpenMM System instead of loading the serialized System cache")
 @click.option('--debug', is_flag=True, help="Enable debug mode")
-def openmm_run(inp, psf, pdb, mk_inp, irst, orst, toppar, pbc, platform, ns, rewrap, debug):
+def openmm_run(inp, psf, pdb, mk_inp, hmr, protocol, replicas, irst, orst, compress_rst, convert_rst, toppar, pbc, platform, autotune, ns, rewrap, resume, max_hours, async_io, energy_table, metrics, profile_forces, no_param_cache, no_system_cache, debug):
     uxm = UnixMessage()
     
     if mk_inp:
-        generate_default_inps()
+        generate_default_inps(hmr=hmr)
+        return
+
+    if convert_rst:
+        src, dst = convert_rst
+        if not os.path.exists(src):
+            raise click.BadParameter(f"restart file {src} does not exist.", param_hint="--convert-rst")
+        convert_restart(src, dst, compress=compress_rst)
+        return
+
+    if protocol:
+        ctx = click.get_current_context()
+        wrong = [flag for flag, name in [("-i/--inp", "inp"), ("-irst/--irst", "irst"), ("-orst/--orst", "orst"), ("--ns", "ns"), ("--resume", "resume"), ("--max-hours", "max_hours"), ("--profile-forces", "profile_forces")] if _explicit(ctx, name)]
+        if replicas:
+            wrong.append("--replicas")
+        if wrong:
+            raise click.UsageError(f"--protocol reads each stage's .inp and writes each stage's own outputs; it does not accept {', '.join(wrong)}.")
+        if not psf or not pdb:
+            raise click.UsageError("--protocol requires -p/--psf and -c/--pdb.")
+        uxm.message(f"Starting in-process OpenMM protocol with psf={psf}, pdb={pdb}...", "info")
+        run_protocol(
+            args_psf=psf,
+            args_pdb=pdb,
+            args_toppar=toppar,
+            args_pbc=pbc,
+            args_platform=platform,
+            args_rewrap=rewrap,
+            args_debug=debug,
+            args_param_cache=not no_param_cache,
+            args_system_cache=not no_system_cache,
+            args_async_io=async_io,
+            args_energy_table=energy_table,
+            args_autotune=autotune,
+            args_metrics=metrics
+        )
+        uxm.message("Protocol finished successfully.", "info")
         return
 
     # Check if user EXPLICITLY passed pbc along with irst
@@ -42,10 +92,44 @@ def openmm_run(inp, psf, pdb, mk_inp, irst, orst, toppar, pbc, platform, ns, rew
         click.echo(ctx.get_help())
         sys.exit(1)
 
+    if replicas:
+        if autotune:
+            raise click.UsageError("--replicas splits the CPU threads evenly between replicas; it cannot be combined with --autotune.")
+        if profile_forces:
+            raise click.UsageError("--profile-forces profiles a single stage; it cannot be combined with --replicas.")
+        uxm.message(f"Starting {replicas}-replica OpenMM ensemble with input={inp}, psf={psf}, pdb={pdb}...", "info")
+        results = run_ensemble(
+            replicas,
+            args_psf=psf,
+            args_pdb=pdb,
+            args_inp=inp,
+            args_irst=irst,
+            args_orst=orst,
+            args_toppar=toppar,
+            args_pbc=pbc,
+            args_platform=platform,
+            args_ns=ns,
+            args_rewrap=rewrap,
+            args_debug=debug,
+            args_param_cache=not no_param_cache,
+            args_system_cache=not no_system_cache,
+            args_resume=resume,
+            args_rst_compress=compress_rst,
+            args_async_io=async_io,
+            args_energy_table=energy_table,
+            args_metrics=metrics,
+            args_max_hours=max_hours
+        )
+        if any(result.get('walltime') for result in results or []):
+            uxm.message(f"Walltime reached; replicas checkpointed. Rerun with --resume to continue (exit status {WALLTIME_EXIT_CODE}).", "warning")
+            sys.exit(WALLTIME_EXIT_CODE)
+        uxm.message("Ensemble finished successfully.", "info")
+        return
+
     uxm.message(f"Starting OpenMM simulation run with input={inp}, psf={psf}, pdb={pdb}...", "info")
     
     # Run the core simulation logic (Chef)
-    run_simulation(
+    result = run_simulation(
         args_psf=psf,
         args_pdb=pdb,
         args_inp=inp,
@@ -56,7 +140,20 @@ def openmm_run(inp, psf, pdb, mk_inp, irst, orst, toppar, pbc, platform, ns, rew
         args_platform=platform,
         args_ns=ns,
         args_rewrap=rewrap,
-        args_debug=debug
+        args_debug=debug,
+        args_param_cache=not no_param_cache,
+        args_system_cache=not no_system_cache,
+        args_resume=resume,
+        args_rst_compress=compress_rst,
+        args_async_io=async_io,
+        args_energy_table=energy_table,
+        args_autotune=autotune,
+        args_profile_forces=profile_forces,
+        args_metrics=metrics,
+        args_max_hours=max_hours
     )
+    if result and result.get('walltime'):
+        uxm.message(f"Walltime reached; checkpoint written. Rerun with --resume to continue (exit status {WALLTIME_EXIT_CODE}).", "warning")
+        sys.exit(WALLTIME_EXIT_CODE)
     
     uxm.message("Simulation finished successfully.", "info")
@@ -1,8 +1,8 @@
 import click
 import os
-import subprocess
 import re
 from mstbx.core.Utils.Utils import UnixMessage
+from mstbx.core.Utils.VMDSession import VMDJobError, run_tcl
 
 def get_psf_natoms(psf_path):
     """Extrae el número de átomos de un archivo PSF."""
@@ -44,7 +44,7 @@ quit
     
     try:
         # Ejecutar VMD en modo texto
-        result = subprocess.run(["vmd", "-dispdev", "text", "-e", tcl_file], capture_output=True, text=True, check=True)
+        run_tcl(tcl_file, echo=False)
         
         if os.path.exists(tcl_file):
             os.remove(tcl_file)
@@ -64,11 +64,11 @@ quit
         else:
             uxm.message(f"Archivos {output}.psf y {output}.pdb generados, pero no se pudo verificar el número de átomos.", "warning")
 
-    except subprocess.CalledProcessError as e:
+    except VMDJobError as e:
         uxm.message(f"Error al ejecutar VMD: {e}", "error")
-        if e.stdout:
+        if e.output:
             with open("resetpsf_vmd.log", "w") as f:
-                f.write(e.stdout)
+                f.write(e.output)
             uxm.message("Revisa 'resetpsf_vmd.log' para detalles del error.", "warning")
         if os.path.exists(tcl_file):
             uxm.message(f"Puedes revisar '{tcl_file}' para debug.", "warning")
@@ -1,11 +1,16 @@
 import click
+import csv
+import glob
 import os
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from mstbx.core.Build.PSFGenSol import BuildSolution, BuildSolutionSMD
 from mstbx.core.Build.PSFGenMemb import BuildMembrane
 from mstbx.core.Utils.ClickHelp import explicit as _explicit
 from mstbx.core.Utils.ClickHelp import grouped_command
 from mstbx.core.Utils.Utils import UnixMessage
+from mstbx.core.Utils.VMDSession import VMDJobError, vmd_pool
 
 TOPOPSFGEN_OPTION_GROUPS = {
     "Environment": ["env"],
@@ -15,21 +20,46 @@ TOPOPSFGEN_OPTION_GROUPS = {
     ],
     "Membrane Options (trigger: --env membrane)": ["mol_outside", "z_distance"],
     "SMD Options (trigger: --env smd)": ["atoms_anchor", "atoms_pull", "extra_space"],
+    "Solvation (trigger: --env solution)": ["solvate_backend"],
+    "Batch Mode": ["manifest", "jobs"],
 }
 
 
-def _validate_env_flags(ctx, env, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pad_z_pos,
-                         pad_z_neg, mol_outside, z_distance, atoms_anchor, atoms_pull, extra_space):
+def _flag(value):
+    if value.lower() in ("1", "yes", "true", "y"):
+        return True
+    if value.lower() in ("0", "no", "false", "n"):
+        return False
+    raise ValueError(f"expected yes/no, got '{value}'")
+
+
+# Columns accepted in a --manifest CSV and how each cell is parsed
+MANIFEST_COLUMNS = {
+    "name": str, "env": str, "psf": str, "pdb": str, "salt": float, "ofile": str, "hmr": _flag,
+    "padding": float, "pad_x_pos": float, "pad_x_neg": float, "pad_y_pos": float, "pad_y_neg": float,
+    "pad_z_pos": float, "pad_z_neg": float, "mol_outside": _flag, "z_distance": float,
+    "atoms_anchor": str, "atoms_pull": str, "extra_space": float, "solvate_backend": str,
+}
+SUMMARY_COLUMNS = ["name", "env", "status", "atoms", "box", "seconds", "error"]
+
+
+def _validate_env_flags(explicit, env, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pad_z_pos,
+                         pad_z_neg, mol_outside, z_distance, atoms_anchor, atoms_pull, extra_space,
+                         solvate_backend="vmd"):
     """Reject per-env flags passed under the wrong --env: the builder for
     membrane and SMD systems does not accept per-axis padding at all, and the
     membrane/SMD-only options are simply never read outside their own env,
-    so passing them elsewhere used to succeed and silently do nothing."""
+    so passing them elsewhere used to succeed and silently do nothing.
+
+    ``explicit(name)`` tells whether an option with a default was actually
+    given (on the command line, or in a manifest row)."""
     if env != "solution":
         wrong = [
             flag for flag, value in [
                 ("--pad-x-pos", pad_x_pos is not None), ("--pad-x-neg", pad_x_neg is not None),
                 ("--pad-y-pos", pad_y_pos is not None), ("--pad-y-neg", pad_y_neg is not None),
                 ("--pad-z-pos", pad_z_pos is not None), ("--pad-z-neg", pad_z_neg is not None),
+                ("--solvate-backend", explicit("solvate_backend") and solvate_backend != "vmd"),
             ] if value
         ]
         if wrong:
@@ -41,7 +71,7 @@ def _validate_env_flags(ctx, env, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pa
     if env != "membrane":
         wrong = [
             flag for flag, value in [
-                ("--mol-outside", mol_outside), ("--z-distance", _explicit(ctx, "z_distance")),
+                ("--mol-outside", mol_outside), ("--z-distance", explicit("z_distance")),
             ] if value
         ]
         if wrong:
@@ -54,7 +84,7 @@ def _validate_env_flags(ctx, env, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pa
         wrong = [
             flag for flag, value in [
                 ("--atoms-anchor", atoms_anchor), ("--atoms-pull", atoms_pull),
-                ("--extra-space", _explicit(ctx, "extra_space")),
+                ("--extra-space", explicit("extra_space")),
             ] if value
         ]
         if wrong:
@@ -64,45 +94,38 @@ def _validate_env_flags(ctx, env, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pa
             )
 
 
-@click.command(cls=grouped_command(TOPOPSFGEN_OPTION_GROUPS), help="System generation (PSF/PDB) for different environments.")
-@click.option('--env', type=click.Choice(['solution', 'membrane', 'smd']), required=True, help="Environment of the system to build.")
-# Common Options
-@click.option('--psf', type=click.Path(exists=True, dir_okay=False), required=True, help="Input PSF file.")
-@click.option('--pdb', type=click.Path(exists=True, dir_okay=False), required=True, help="Input PDB file.")
-@click.option('--salt', default=0.150, help="NaCl concentration (mol/L). Default 0.150.")
-@click.option('--ofile', default="macromol150mM", help="Prefix for output files.")
-@click.option('--hmr', is_flag=True, help="Enable Hydrogen Mass Repartition.")
-@click.option('--padding', type=float, help="Global padding (A). Defaults: 18.0 (Solution/SMD), 25.0 (Membrane).")
-@click.option('--pad-x-pos', type=float, help="Specific padding for X+ axis.")
-@click.option('--pad-x-neg', type=float, help="Specific padding for X- axis.")
-@click.option('--pad-y-pos', type=float, help="Specific padding for Y+ axis.")
-@click.option('--pad-y-neg', type=float, help="Specific padding for Y- axis.")
-@click.option('--pad-z-pos', type=float, help="Specific padding for Z+ axis.")
-@click.option('--pad-z-neg', type=float, help="Specific padding for Z- axis.")
-# Membrane Options
-@click.option('--mol-outside', is_flag=True, help="Place protein outside the membrane.")
-@click.option('--z-distance', default=10.0, help="Distance in Z (A) from the membrane surface.")
-# SMD Options
-@click.option('--atoms-anchor', help="VMD selection for the fixed group.")
-@click.option('--atoms-pull', help="VMD selection for the pulling group.")
-@click.option('--extra-space', default=50.0, help="Extra space in Z+ for SMD.")
-def topopsfgen(env, psf, pdb, salt, ofile, hmr, padding, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pad_z_pos, pad_z_neg, mol_outside, z_distance, atoms_anchor, atoms_pull, extra_space):
-    """Module to build solvated, membrane, or SMD systems."""
+def _natoms(psf):
+    with open(psf, "r") as handle:
+        for line in handle:
+            if "!NATOM" in line:
+                return int(line.split()[0])
+    return None
+
+
+def _box(pbcsetup):
+    values = {}
+    with open(pbcsetup, "r") as handle:
+        for line in handle:
+            fields = line.split()
+            if len(fields) == 4 and fields[0] == "SET" and fields[1] in ("A", "B", "C"):
+                values[fields[1]] = float(fields[3])
+    return " x ".join(f"{values[axis]:.1f}" for axis in ("A", "B", "C") if axis in values)
+
+
+def build_system(env, psf, pdb, salt, ofile, hmr, padding, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg,
+                 pad_z_pos, pad_z_neg, mol_outside, z_distance, atoms_anchor, atoms_pull, extra_space,
+                 solvate_backend="vmd", echo=True, root="."):
+    """Build one system into ``01build/`` below ``root``."""
     hmrbool = 1 if hmr else 0
     uxm = UnixMessage()
 
-    _validate_env_flags(
-        click.get_current_context(), env, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg,
-        pad_z_pos, pad_z_neg, mol_outside, z_distance, atoms_anchor, atoms_pull, extra_space,
-    )
-
     if env == 'solution':
         sol_padding = padding if padding is not None else 18.0
         builder = BuildSolution()
         builder.build(psf=psf, pdb=pdb, salt=salt, ofile=ofile, hmr=hmrbool, padding=sol_padding,
                       pad_x_pos=pad_x_pos, pad_x_neg=pad_x_neg, pad_y_pos=pad_y_pos, 
-                      pad_y_neg=pad_y_neg, pad_z_pos=pad_z_pos, pad_z_neg=pad_z_neg)
-        script_tcl = "PSFGenSol.tcl"
+                      pad_y_neg=pad_y_neg, pad_z_pos=pad_z_pos, pad_z_neg=pad_z_neg,
+                      solvate_backend=solvate_backend)
 
     elif env == 'membrane':
         builder = BuildMembrane()
@@ -110,7 +133,6 @@ def topopsfgen(env, psf, pdb, salt, ofile, hmr, padding, pad_x_pos, pad_x_neg, p
         memb_padding = padding if padding is not None else 25.0
         builder.build(psf=psf, pdb=pdb, salt=salt, ofile=ofile, hmr=hmrbool, peptide=peptide, 
                       moveZ=z_distance, padding=memb_padding)
-        script_tcl = "PSFGenMemb.tcl"
 
     elif env == 'smd':
         if not atoms_anchor or not atoms_pull:
@@ -121,21 +143,187 @@ def topopsfgen(env, psf, pdb, salt, ofile, hmr, padding, pad_x_pos, pad_x_neg, p
         smd_padding = padding if padding is not None else 18.0
         builder.build(psf=psf, pdb=pdb, salt=salt, ofile=ofile, hmr=hmrbool, atomsvec1=atoms_anchor, 
                       atomsvec2=atoms_pull, extrapadz=extra_space, padding=smd_padding)
-        script_tcl = "PSFGenSolSMD.tcl"
 
     # Common Execution
-    uxm.makedir(dirs=["01build"])
-    os.chdir("01build")
-    uxm.message(f"Working inside: {os.path.abspath('.')}", "info")
-    
-    if env == 'membrane' and os.path.exists("../step4_lipid.psf"):
-        os.system("cp ../step4_*psf .")
-        os.system("cp ../step4_*pdb .")
-    else:
-        os.system("cp ../*psf .")
-        os.system("cp ../*pdb .")
-        
-    os.system(f"mv ../{script_tcl} .")
-    os.system(f"vmd -dispdev text -e {script_tcl} 2>&1 | tee psfgen.log")
+    workdir = os.path.join(root, "01build")
+    os.makedirs(workdir, exist_ok=True)
+    uxm.message(f"Working inside: {os.path.abspath(workdir)}", "info")
+
+    inputs = [psf, pdb]
+    if env == 'membrane' and os.path.exists(os.path.join(root, "step4_lipid.psf")):
+        inputs += sorted(glob.glob(os.path.join(root, "step4_*.psf")) + glob.glob(os.path.join(root, "step4_*.pdb")))
+    for path in inputs:
+        target = os.path.join(workdir, os.path.basename(path))
+        if not os.path.exists(target) or not os.path.samefile(path, target):
+            shutil.copy2(path, target)
+
+    try:
+        builder.run(workdir, "psfgen.log", echo=echo)
+    except VMDJobError as error:
+        message = f"VMD failed while running {builder.script}: {error} (see {os.path.join(workdir, 'psfgen.log')})."
+        uxm.message(message, "error")
+        raise click.ClickException(message) from error
     time.sleep(2)
-    uxm.message(f"{env.capitalize()} system ready in 01build/", "info")
+    uxm.message(f"{env.capitalize()} system ready in {os.path.normpath(workdir)}/", "info")
+
+
+def _manifest_jobs(manifest, defaults):
+    """One keyword dict per manifest row; blank or missing cells take the command-line value."""
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, "r", newline="") as handle:
+        rows = list(csv.DictReader(handle))
+    if not rows:
+        raise click.UsageError(f"{manifest} lists no systems.")
+    unknown = set(rows[0]) - set(MANIFEST_COLUMNS)
+    if unknown:
+        raise click.UsageError(f"Unknown column(s) in {manifest}: {', '.join(sorted(unknown))}. "
+                               f"Valid columns: {', '.join(MANIFEST_COLUMNS)}.")
+
+    jobs, names = [], set()
+    for number, row in enumerate(rows, start=2):
+        given = {key: value.strip() for key, value in row.items() if key and value is not None and value.strip()}
+        job = dict(defaults)
+        try:
+            for key, value in given.items():
+                job[key] = MANIFEST_COLUMNS[key](value)
+        except ValueError as error:
+            raise click.UsageError(f"{manifest} line {number}: {error}")
+        for key in ("env", "psf", "pdb"):
+            if not job.get(key):
+                raise click.UsageError(f"{manifest} line {number}: '{key}' is required (column or --{key}).")
+        if job["env"] not in ("solution", "membrane", "smd"):
+            raise click.UsageError(f"{manifest} line {number}: unknown env '{job['env']}'.")
+        if job["solvate_backend"] not in ("vmd", "native"):
+            raise click.UsageError(f"{manifest} line {number}: unknown solvate_backend '{job['solvate_backend']}'.")
+        for key in ("psf", "pdb"):
+            job[key] = os.path.join(base, job[key]) if key in given else os.path.abspath(job[key])
+            if not os.path.isfile(job[key]):
+                raise click.UsageError(f"{manifest} line {number}: {job[key]} does not exist.")
+        job["name"] = given.get("name") or os.path.splitext(os.path.basename(job["psf"]))[0]
+        if job["name"] in names:
+            raise click.UsageError(f"{manifest} line {number}: system name '{job['name']}' is used twice.")
+        names.add(job["name"])
+        try:
+            _validate_env_flags(
+                lambda name: name in given or defaults["explicit"](name), job["env"], job["pad_x_pos"],
+                job["pad_x_neg"], job["pad_y_pos"], job["pad_y_neg"], job["pad_z_pos"], job["pad_z_neg"],
+                job["mol_outside"], job["z_distance"], job["atoms_anchor"], job["atoms_pull"], job["extra_space"],
+                job["solvate_backend"],
+            )
+        except click.UsageError as error:
+            raise click.UsageError(f"{manifest} line {number} ({job['name']}): {error.message}")
+        del job["explicit"]
+        jobs.append(job)
+    return jobs
+
+
+def _build_manifest_system(job):
+    """Build one manifest system in ``<name>/``; runs in a worker thread."""
+    job = dict(job)
+    name = job.pop("name")
+    summary = {"name": name, "env": job["env"], "status": "ok", "atoms": "", "box": "", "seconds": "", "error": ""}
+    start = time.perf_counter()
+    try:
+        os.makedirs(name, exist_ok=True)
+        for key in ("psf", "pdb"):
+            shutil.copy2(job[key], name)
+            job[key] = os.path.join(name, os.path.basename(job[key]))
+        build_system(echo=False, root=name, **job)
+        summary["atoms"] = _natoms(os.path.join(name, "01build", f"{job['ofile']}.psf"))
+        summary["box"] = _box(os.path.join(name, "01build", "step3_pbcsetup.str"))
+    except (Exception, SystemExit) as error:
+        summary["status"] = "failed"
+        summary["error"] = getattr(error, "message", None) or str(error) or type(error).__name__
+    finally:
+        summary["seconds"] = f"{time.perf_counter() - start:.1f}"
+    return summary
+
+
+def run_manifest(manifest, jobs, defaults):
+    """Build every system of ``manifest`` with ``jobs`` worker threads and write the summary table.
+
+    The threads share this process's VMD pool, grown to ``jobs`` workers, so
+    each VMD start-up and ``package require`` is paid once per worker rather
+    than once per system.
+    """
+    uxm = UnixMessage()
+    systems = _manifest_jobs(manifest, defaults)
+    uxm.message(f"Building {len(systems)} system(s) from {manifest} with {jobs} worker thread(s).", "info")
+    if jobs == 1:
+        results = [_build_manifest_system(job) for job in systems]
+    else:
+        vmd_pool(jobs)
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="build") as pool:
+            results = list(pool.map(_build_manifest_system, systems))
+
+    summary = f"{os.path.splitext(manifest)[0]}_summary.csv"
+    with open(summary, "w", newline="") as handle:
+        writer = csv.DictWriter(handle, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+
+    widths = {column: max(len(column), *(len(str(row[column])) for row in results)) for column in SUMMARY_COLUMNS[:-1]}
+    click.echo("  ".join(column.ljust(widths[column]) for column in SUMMARY_COLUMNS[:-1]) + "  error")
+    for row in results:
+        click.echo("  ".join(str(row[column]).ljust(widths[column]) for column in SUMMARY_COLUMNS[:-1]) + f"  {row['error']}")
+    failed = [row["name"] for row in results if row["status"] != "ok"]
+    uxm.message(f"Summary written to {summary}", "info")
+    if failed:
+        message = f"{len(failed)} of {len(results)} system(s) failed: {', '.join(failed)}."
+        uxm.message(message, "error")
+        raise click.ClickException(message)
+
+
+@click.command(cls=grouped_command(TOPOPSFGEN_OPTION_GROUPS), help="System generation (PSF/PDB) for different environments.")
+@click.option('--env', type=click.Choice(['solution', 'membrane', 'smd']), help="Environment of the system to build (required unless every manifest row sets it).")
+# Common Options
+@click.option('--psf', type=click.Path(exists=True, dir_okay=False), help="Input PSF file.")
+@click.option('--pdb', type=click.Path(exists=True, dir_okay=False), help="Input PDB file.")
+@click.option('--salt', default=0.150, help="NaCl concentration (mol/L). Default 0.150.")
+@click.option('--ofile', default="macromol150mM", help="Prefix for output files.")
+@click.option('--hmr', is_flag=True, help="Enable Hydrogen Mass Repartition.")
+@click.option('--padding', type=float, help="Global padding (A). Defaults: 18.0 (Solution/SMD), 25.0 (Membrane).")
+@click.option('--pad-x-pos', type=float, help="Specific padding for X+ axis.")
+@click.option('--pad-x-neg', type=float, help="Specific padding for X- axis.")
+@click.option('--pad-y-pos', type=float, help="Specific padding for Y+ axis.")
+@click.option('--pad-y-neg', type=float, help="Specific padding for Y- axis.")
+@click.option('--pad-z-pos', type=float, help="Specific padding for Z+ axis.")
+@click.option('--pad-z-neg', type=float, help="Specific padding for Z- axis.")
+# Membrane Options
+@click.option('--mol-outside', is_flag=True, help="Place protein outside the membrane.")
+@click.option('--z-distance', default=10.0, help="Distance in Z (A) from the membrane surface.")
+# SMD Options
+@click.option('--atoms-anchor', help="VMD selection for the fixed group.")
+@click.option('--atoms-pull', help="VMD selection for the pulling group.")
+@click.option('--extra-space', default=50.0, help="Extra space in Z+ for SMD.")
+# Solvation
+@click.option('--solvate-backend', type=click.Choice(['vmd', 'native']), default='vmd', help="Solvation engine for --env solution: VMD solvate, or the NumPy/cKDTree water tiler (faster and leaner on large systems).")
+# Batch Mode
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False), help="CSV with one system per row (columns: name, env, psf, pdb and any option above); each is built in <name>/01build/.")
+@click.option('--jobs', type=click.IntRange(min=1), default=1, help="Systems built concurrently with --manifest (one thread and one VMD worker each).")
+def topopsfgen(env, psf, pdb, salt, ofile, hmr, padding, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pad_z_pos, pad_z_neg, mol_outside, z_distance, atoms_anchor, atoms_pull, extra_space, solvate_backend, manifest, jobs):
+    """Module to build solvated, membrane, or SMD systems."""
+    ctx = click.get_current_context()
+    options = dict(
+        env=env, psf=psf, pdb=pdb, salt=salt, ofile=ofile, hmr=hmr, padding=padding, pad_x_pos=pad_x_pos,
+        pad_x_neg=pad_x_neg, pad_y_pos=pad_y_pos, pad_y_neg=pad_y_neg, pad_z_pos=pad_z_pos, pad_z_neg=pad_z_neg,
+        mol_outside=mol_outside, z_distance=z_distance, atoms_anchor=atoms_anchor, atoms_pull=atoms_pull,
+        extra_space=extra_space, solvate_backend=solvate_backend,
+    )
+
+    if manifest:
+        options["explicit"] = lambda name: _explicit(ctx, name)
+        run_manifest(manifest, jobs, options)
+        return
+    if _explicit(ctx, "jobs"):
+        raise click.UsageError("--jobs only applies with --manifest.")
+    for name in ("env", "psf", "pdb"):
+        if options[name] is None:
+            raise click.UsageError(f"Missing option '--{name}' (or pass --manifest).")
+
+    _validate_env_flags(
+        lambda name: _explicit(ctx, name), env, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg,
+        pad_z_pos, pad_z_neg, mol_outside, z_distance, atoms_anchor, atoms_pull, extra_space,
+        solvate_backend,
+    )
+    build_system(**options)
@@ -0,0 +1,90 @@
+"""Isolated scratch directories for the Tcl system builders.
+
+The PSFGen scripts write fixed names (``solvated.*``, ``ionized.*``,
+``orient.*``, ``orientedtoZ.pdb``, ``step3_pbcsetup.str``) into the
+directory VMD runs in, so two builds sharing a directory overwrite each
+other. ``run_build_job`` runs a builder's script in a fresh hidden directory
+with a unique prefix inside the target directory and, once the script has
+succeeded and written every expected output, renames those outputs into
+place with ``os.replace``. Intermediates are discarded with the scratch
+directory. A failed build leaves the target untouched except for its log and
+keeps the scratch directory for inspection.
+"""
+
+import os
+import shutil
+import tempfile
+
+from ..Utils.VMDSession import VMDJobError, run_tcl
+
+
+def build_outputs(ofile, hmr):
+    """Final files of a PSFGen build; the box file comes last so it marks a complete set."""
+    outputs = [f"{ofile}.psf", f"{ofile}.pdb"]
+    if hmr:
+        outputs += [f"{ofile}.hmr.psf", f"{ofile}.hmr.pdb"]
+    return outputs + ["step3_pbcsetup.str"]
+
+
+def run_build_job(script, tcl, outputs, workdir=".", log="psfgen.log", prefix="build", echo=True, prepare=None):
+    """Write ``tcl`` as ``script`` into a private scratch directory, run it and promote ``outputs``.
+
+    The script only ever exists inside the scratch directory, so concurrent
+    builds never share a script file. It runs from there, so it must name its
+    inputs with absolute paths; relative paths are its own intermediates.
+
+    Parameters
+    ----------
+    script : str
+        File name for the generated Tcl (also used in error messages).
+    tcl : str
+        Text of the script.
+    outputs : list of str
+        Files the script writes in its working directory.
+    workdir : str
+        Directory that receives the outputs and ``log``.
+    log : str
+        Name of the VMD log.
+    prefix : str
+        Readable part of the scratch directory name (``.{prefix}-XXXXXXXX``).
+    echo : bool
+        Print VMD's output while it runs.
+    prepare : callable, optional
+        Called with the scratch directory before VMD starts, to write inputs
+        the script expects there (e.g. natively solvated structures).
+
+    Returns
+    -------
+    list of str
+        Paths of the promoted outputs.
+
+    Raises
+    ------
+    VMDJobError
+        The script or ``prepare`` failed, or not every output was written.
+    """
+    scratch = tempfile.mkdtemp(prefix=f".{prefix}-", dir=workdir)
+    with open(os.path.join(scratch, script), "w") as handle:
+        handle.write(tcl)
+    try:
+        if prepare is not None:
+            try:
+                prepare(scratch)
+            except Exception as error:
+                raise VMDJobError(f"Preparing {script} failed: {error}") from error
+        output = run_tcl(script, cwd=scratch, log=os.path.join(scratch, log), echo=echo)
+        missing = [name for name in outputs if not os.path.exists(os.path.join(scratch, name))]
+        if missing:
+            raise VMDJobError(f"{script} finished without writing {', '.join(missing)}", output)
+    except VMDJobError as error:
+        if os.path.exists(os.path.join(scratch, log)):
+            shutil.copy2(os.path.join(scratch, log), os.path.join(workdir, log))
+        raise VMDJobError(f"{error} (intermediates kept in {scratch})", error.output) from error
+
+    promoted = []
+    for name in outputs + [log]:
+        target = os.path.join(workdir, name)
+        os.replace(os.path.join(scratch, name), target)
+        promoted.append(target)
+    shutil.rmtree(scratch, ignore_errors=True)
+    return promoted
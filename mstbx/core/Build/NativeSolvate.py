@@ -0,0 +1,295 @@
+"""Python replacement for the VMD ``solvate`` step of ``PSFGenSol.tcl``.
+
+For large complexes ``solvate`` dominates ``topopsfgen --env solution``:
+VMD loads the solute and every tiled water into one molecule, runs atom
+selections over all of it and rewrites the structure through psfgen. This
+backend tiles OpenMM's pre-equilibrated 30 A TIP3P box over the same
+``-minmax`` region, drops waters that stick out of the region or come within
+2.4 A (solvate's default ``-b``) of a solute atom (a ``cKDTree`` query that
+only looks at waters near the solute), and writes ``solvated.psf/.pdb`` by
+copying the solute records and streaming the waters in chunks.
+
+Waters are CHARMM TIP3 (OH2/H1/H2, three bonds including H1-H2 for SHAKE,
+one angle) in segments ``W1``, ``W2``, ... of at most 9999 residues. The
+solute PSF must be an X-PLOR PSF (atom types as names), which is what
+CHARMM-GUI and psfgen write; other sections are copied, with the atom-indexed
+ones (``!NNB``, ``!NGRP``) extended to the new atoms.
+"""
+
+import os
+import re
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+try:
+    import openmm.app as _openmm_app
+except ImportError:
+    _openmm_app = None
+
+# Pre-equilibrated periodic TIP3P box shipped with OpenMM (Angstrom)
+WATER_BOX_EDGE = 30.0
+# TIP3 atoms: name, PDB name, type, charge, mass (toppar_water_ions.str)
+TIP3_ATOMS = [("OH2", " OH2", "OT", -0.834, 15.9994), ("H1", " H1 ", "HT", 0.417, 1.0080),
+              ("H2", " H2 ", "HT", 0.417, 1.0080)]
+SEGMENT_RESIDUES = 9999
+# Waters formatted per write() call
+WRITE_CHUNK = 20000
+
+# Ints per line and how many ints each listed entry holds, per PSF section
+PSF_SECTIONS = {
+    "NBOND": (8, 2), "NTHETA": (9, 3), "NPHI": (8, 4), "NIMPHI": (8, 4), "NDON": (8, 2),
+    "NACC": (8, 2), "NNB": (8, 1), "NGRP": (9, 3), "NUMLP": (8, 0), "NCRTERM": (8, 8),
+}
+
+
+def solvation_box(coordinates, padding=18.0, pad_x_pos=None, pad_x_neg=None, pad_y_pos=None,
+                  pad_y_neg=None, pad_z_pos=None, pad_z_neg=None):
+    """The ``-minmax`` region ``PSFGenSol.tcl`` computes for ``solvate``.
+
+    A cube of edge ``max_dim + 2 * padding + 2`` around the solute centre,
+    or, when any ``pad_*`` is given, the solute bounding box grown by the
+    per-axis paddings (unset axes use ``padding``).
+
+    Returns
+    -------
+    numpy.ndarray
+        ``[[xmin, ymin, zmin], [xmax, ymax, zmax]]``.
+    """
+    lower, upper = coordinates.min(axis=0), coordinates.max(axis=0)
+    pads = [pad_x_neg, pad_x_pos, pad_y_neg, pad_y_pos, pad_z_neg, pad_z_pos]
+    if any(pad is not None for pad in pads):
+        pads = np.array([padding if pad is None else pad for pad in pads], dtype=float).reshape(3, 2)
+        return np.array([lower - pads[:, 0], upper + pads[:, 1]])
+    half = (float((upper - lower).max()) + 2 * padding) / 2 + 1
+    center = coordinates.mean(axis=0)
+    return np.array([center - half, center + half])
+
+
+def water_box():
+    """OpenMM's equilibrated TIP3P box as an ``(n_waters, 3, 3)`` array, oxygen first."""
+    if _openmm_app is None:
+        raise ImportError("OpenMM is required for the native solvation backend (its tip3p.pdb water box)")
+    path = os.path.join(os.path.dirname(_openmm_app.__file__), "data", "tip3p.pdb")
+    with open(path, "r") as handle:
+        xyz = [(line[30:38], line[38:46], line[46:54]) for line in handle if line.startswith(("ATOM", "HETATM"))]
+    return np.array(xyz, dtype=float).reshape(-1, 3, 3)
+
+
+def place_waters(solute, minmax, boundary=2.4):
+    """Tile the water box over ``minmax`` and keep waters inside it and clear of the solute.
+
+    Parameters
+    ----------
+    solute : numpy.ndarray
+        ``(n, 3)`` solute coordinates.
+    minmax : numpy.ndarray
+        Region from ``solvation_box``; waters with any atom outside are dropped.
+    boundary : float
+        Waters with any atom closer than this to a solute atom are dropped.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``(n_waters, 3, 3)`` float32 coordinates.
+    """
+    box = water_box()
+    tree = cKDTree(solute)
+    near_lower, near_upper = solute.min(axis=0) - boundary, solute.max(axis=0) + boundary
+    counts = np.ceil((minmax[1] - minmax[0]) / WATER_BOX_EDGE).astype(int)
+    kept = []
+    for ix in range(counts[0]):
+        # One slab of tiles at a time keeps the candidate arrays small
+        shifts = np.array([(ix, iy, iz) for iy in range(counts[1]) for iz in range(counts[2])], dtype=float)
+        waters = (box[None, :, :, :] + (minmax[0] + shifts * WATER_BOX_EDGE)[:, None, None, :]).reshape(-1, 3, 3)
+        inside = ((waters >= minmax[0]) & (waters <= minmax[1])).all(axis=(1, 2))
+        waters = waters[inside]
+        near = ((waters >= near_lower) & (waters <= near_upper)).all(axis=2).any(axis=1)
+        if near.any():
+            distance, _ = tree.query(waters[near].reshape(-1, 3), distance_upper_bound=boundary, workers=-1)
+            clash = np.zeros(len(waters), dtype=bool)
+            clash[near] = (distance < boundary).reshape(-1, 3).any(axis=1)
+            waters = waters[~clash]
+        kept.append(waters.astype(np.float32))
+    return np.concatenate(kept) if kept else np.zeros((0, 3, 3), dtype=np.float32)
+
+
+def read_pdb_coordinates(pdb):
+    """``(n, 3)`` coordinates and the ATOM/HETATM lines of a PDB, in file order."""
+    with open(pdb, "r") as handle:
+        lines = [line for line in handle if line.startswith(("ATOM  ", "HETATM"))]
+    coordinates = np.array([(line[30:38], line[38:46], line[46:54]) for line in lines], dtype=float)
+    return coordinates.reshape(-1, 3), lines
+
+
+def read_psf(psf):
+    """Parse a PSF into its flags line, title lines, atom lines and integer sections.
+
+    Returns
+    -------
+    tuple
+        ``(flags, titles, atoms, sections)`` where ``sections`` is a list of
+        ``(name, header_label, counts, values)`` with ``values`` an int array.
+    """
+    with open(psf, "r") as handle:
+        lines = handle.read().splitlines()
+    flags = lines[0].split()
+    if not flags or flags[0] != "PSF":
+        raise ValueError(f"{psf} is not a PSF file")
+    if "CHEQ" in flags or "DRUDE" in flags:
+        raise ValueError(f"{psf}: {' '.join(flags)} PSFs are not supported by the native solvation backend")
+    header = re.compile(r"^\s*(-?\d+(?:\s+-?\d+)*)\s+!(\w+)(.*)$")
+    position = 1
+    titles, atoms, sections = [], [], []
+    while position < len(lines):
+        match = header.match(lines[position])
+        position += 1
+        if match is None:
+            continue
+        counts = [int(value) for value in match.group(1).split()]
+        name, label = match.group(2), match.group(2) + match.group(3)
+        if name == "NTITLE":
+            titles = lines[position:position + counts[0]]
+            position += counts[0]
+        elif name == "NATOM":
+            atoms = lines[position:position + counts[0]]
+            position += counts[0]
+            if atoms and _is_number(atoms[0].split()[5]):
+                raise ValueError(f"{psf} uses numeric CHARMM atom types; convert it to X-PLOR (e.g. mstbx resetpsf)")
+        elif name in PSF_SECTIONS:
+            per_line, width = PSF_SECTIONS[name]
+            if name == "NUMLP" and counts[0]:
+                raise ValueError(f"{psf} has lone pairs, which the native solvation backend does not handle")
+            needed = counts[0] * width + (len(atoms) if name == "NNB" else 0)
+            values = []
+            while len(values) < needed:
+                values += [int(value) for value in lines[position].split()]
+                position += 1
+            sections.append((name, label, counts, np.array(values[:needed], dtype=np.int64)))
+        else:
+            raise ValueError(f"{psf}: unsupported PSF section !{name}")
+    return flags, titles, atoms, sections
+
+
+def _is_number(text):
+    try:
+        float(text)
+    except ValueError:
+        return False
+    return True
+
+
+def _write_ints(handle, values, per_line, width):
+    fmt = f"%{width}d"
+    full = len(values) - len(values) % per_line
+    for start in range(0, full, WRITE_CHUNK * per_line):
+        block = values[start:min(start + WRITE_CHUNK * per_line, full)].reshape(-1, per_line)
+        handle.write("\n".join((fmt * per_line) % tuple(row) for row in block.tolist()) + "\n")
+    if full < len(values):
+        handle.write((fmt * (len(values) - full)) % tuple(values[full:].tolist()) + "\n")
+    handle.write("\n")
+
+
+def _segments(n_waters, taken):
+    names = []
+    number = 1
+    while len(names) * SEGMENT_RESIDUES < n_waters:
+        name = f"W{number}"
+        number += 1
+        if name not in taken:
+            names.append(name)
+    return names
+
+
+def write_solvated(psf, pdb, waters, output):
+    """Write ``{output}.psf`` and ``{output}.pdb``: the solute followed by ``waters`` as TIP3.
+
+    Returns
+    -------
+    int
+        Total number of atoms written.
+    """
+    flags, titles, atoms, sections = read_psf(psf)
+    _, pdb_lines = read_pdb_coordinates(pdb)
+    if len(pdb_lines) != len(atoms):
+        raise ValueError(f"{pdb} has {len(pdb_lines)} atoms but {psf} has {len(atoms)}")
+    extended = "EXT" in flags
+    width = 10 if extended else 8
+    atom_format = (("%10d %-8s %-8s %-8s %-8s %-6s %10.6f    %10.4f  %10d\n") if extended
+                   else ("%8d %-4s %-4s %-4s %-4s %-4s %10.6f    %10.4f  %10d\n"))
+    n_solute, n_waters = len(atoms), len(waters)
+    n_total = n_solute + 3 * n_waters
+    segments = _segments(n_waters, {line.split()[1] for line in atoms})
+    first = n_solute + 1 + 3 * np.arange(n_waters, dtype=np.int64)
+
+    def water_chunks():
+        for start in range(0, n_waters, WRITE_CHUNK):
+            stop = min(start + WRITE_CHUNK, n_waters)
+            yield start, stop, [(segments[k // SEGMENT_RESIDUES], k % SEGMENT_RESIDUES + 1) for k in range(start, stop)]
+
+    with open(f"{output}.psf", "w") as handle:
+        handle.write(" ".join(flags) + "\n\n")
+        handle.write(f"{len(titles) + 1:{width}d} !NTITLE\n")
+        handle.write("\n".join(titles + [" REMARKS solvated with TIP3 by mstbx NativeSolvate"]) + "\n\n")
+        handle.write(f"{n_total:{width}d} !NATOM\n")
+        handle.write("\n".join(atoms) + "\n")
+        for start, stop, residues in water_chunks():
+            block = []
+            for k, (segid, resid) in zip(range(start, stop), residues):
+                for offset, (name, _, kind, charge, mass) in enumerate(TIP3_ATOMS):
+                    block.append(atom_format % (n_solute + 3 * k + offset + 1, segid, resid, "TIP3", name, kind, charge, mass, 0))
+            handle.write("".join(block))
+        handle.write("\n")
+        for name, label, counts, values in sections:
+            per_line, _ = PSF_SECTIONS[name]
+            if name == "NBOND":
+                extra = np.stack([first, first + 1, first, first + 2, first + 1, first + 2], axis=1).ravel()
+                counts = [counts[0] + 3 * n_waters]
+            elif name == "NTHETA":
+                extra = np.stack([first + 1, first, first + 2], axis=1).ravel()
+                counts = [counts[0] + n_waters]
+            elif name == "NNB":
+                # The exclusion list, then one IBLO pointer per atom (the new atoms add none)
+                handle.write(f"{counts[0]:{width}d} !{label}\n")
+                _write_ints(handle, values[:counts[0]], per_line, width)
+                last = values[-1] if len(values) > counts[0] else 0
+                _write_ints(handle, np.concatenate([values[counts[0]:], np.full(3 * n_waters, last, dtype=np.int64)]), per_line, width)
+                continue
+            elif name == "NGRP":
+                extra = np.stack([first - 1, np.ones(n_waters, dtype=np.int64), np.zeros(n_waters, dtype=np.int64)], axis=1).ravel()
+                counts = [counts[0] + n_waters] + counts[1:]
+            else:
+                extra = np.zeros(0, dtype=np.int64)
+            handle.write("".join(f"{count:{width}d}" for count in counts) + f" !{label}\n")
+            _write_ints(handle, np.concatenate([values, extra]), per_line, width)
+
+    with open(f"{output}.pdb", "w") as handle:
+        handle.write("REMARK   solvated with TIP3 by mstbx NativeSolvate\n")
+        handle.writelines(pdb_lines)
+        for start, stop, residues in water_chunks():
+            block = []
+            for k, (segid, resid) in zip(range(start, stop), residues):
+                for offset, (_, pdb_name, _, _, _) in enumerate(TIP3_ATOMS):
+                    serial = n_solute + 3 * k + offset + 1
+                    x, y, z = waters[k, offset]
+                    block.append(f"ATOM  {serial if serial < 100000 else '*****':>5} {pdb_name} TIP3W{resid:4d}    "
+                                 f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00      {segid:<4s}\n")
+            handle.write("".join(block))
+        handle.write("END\n")
+    return n_total
+
+
+def solvate(psf, pdb, output="solvated", padding=18.0, pad_x_pos=None, pad_x_neg=None, pad_y_pos=None,
+            pad_y_neg=None, pad_z_pos=None, pad_z_neg=None, boundary=2.4):
+    """Solvate ``psf``/``pdb`` like ``PSFGenSol.tcl`` and write ``{output}.psf/.pdb``.
+
+    Returns
+    -------
+    dict
+        ``minmax`` region, number of ``waters`` and total ``atoms``.
+    """
+    coordinates, _ = read_pdb_coordinates(pdb)
+    minmax = solvation_box(coordinates, padding, pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pad_z_pos, pad_z_neg)
+    waters = place_waters(coordinates, minmax, boundary)
+    atoms = write_solvated(psf, pdb, waters, output)
+    return {"minmax": minmax, "waters": len(waters), "atoms": atoms}
@@ -2,12 +2,13 @@ import os
 import warnings
 import time 
 from ..Utils.Utils import UnixMessage 
+from .BuildJob import build_outputs, run_build_job
 from datetime import datetime
 warnings.filterwarnings("ignore")
 
 class BuildMembrane:
     def __init__(self) -> None:
-        pass
+        self.script = "PSFGenMemb.tcl"
 
     def build(self, psf: str, pdb: str, salt: float, ofile: str, hmr: int, peptide: int, 
               moveZ: float, padding: float = 25.0):
@@ -21,7 +22,9 @@ class BuildMembrane:
         
         Strict XY square box based on max dimensions of protein/lipids.
         """
-        f = open("PSFGenMemb.tcl", "w")
+        psf, pdb = os.path.abspath(psf), os.path.abspath(pdb)
+        self.ofile = ofile
+        self.outputs = build_outputs(ofile, hmr)
         script = """\
 #! Generated by MSTBx PSFGenMemb module
 set psf %s 
@@ -143,5 +146,8 @@ if {%s} {
 }
 quit
 """ % (psf, pdb, ofile, salt, peptide, padding, moveZ, hmr) 
-        f.write(script)
-        f.close()
+        self.tcl = script
+
+    def run(self, workdir=".", log="psfgen.log", echo=True):
+        """Run the rendered PSFGenMemb.tcl in a scratch directory below ``workdir`` and promote the outputs."""
+        return run_build_job(self.script, self.tcl, self.outputs, workdir, log, prefix=f"{self.ofile}-memb", echo=echo)
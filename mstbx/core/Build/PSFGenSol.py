@@ -1,17 +1,22 @@
 import os
 import warnings
 from ..Utils.Utils import UnixMessage
+from .BuildJob import build_outputs, run_build_job
+from .NativeSolvate import solvate
 warnings.filterwarnings("ignore")
 
 class BuildSolution:
     def __init__(self) -> None:
-        pass
+        self.script = "PSFGenSol.tcl"
 
     def build(self, psf: str, pdb: str, salt: float, ofile: str, hmr: int, 
               padding: float = 18.0, pad_x_pos: float = None, pad_x_neg: float = None,
               pad_y_pos: float = None, pad_y_neg: float = None, pad_z_pos: float = None,
-              pad_z_neg: float = None):
-        
+              pad_z_neg: float = None, solvate_backend: str = "vmd"):
+        """Render PSFGenSol.tcl: solvate (VMD or ``solvate_backend="native"``), ionize, recenter, HMR."""
+        if solvate_backend not in ("vmd", "native"):
+            raise ValueError(f"Unknown solvate backend '{solvate_backend}' (use 'vmd' or 'native')")
+
         # Determine specific axis padding or use global padding
         has_granular = 1 if any(p is not None for p in [pad_x_pos, pad_x_neg, pad_y_pos, pad_y_neg, pad_z_pos, pad_z_neg]) else 0
         px_pos = pad_x_pos if pad_x_pos is not None else padding
@@ -21,15 +26,17 @@ class BuildSolution:
         pz_pos = pad_z_pos if pad_z_pos is not None else padding
         pz_neg = pad_z_neg if pad_z_neg is not None else padding
 
-        f = open("PSFGenSol.tcl", "w")
-        tclscript = """\
-#! Generated by MSTBx PSFGenSol module
-set psf %s 
-set pdb %s 
-set sol solvated
-set output %s 
-set salt %s 
-
+        psf, pdb = os.path.abspath(psf), os.path.abspath(pdb)
+        self.ofile = ofile
+        self.outputs = build_outputs(ofile, hmr)
+        self.native = None
+        if solvate_backend == "native":
+            self.native = dict(psf=psf, pdb=pdb, padding=padding, pad_x_pos=pad_x_pos, pad_x_neg=pad_x_neg,
+                               pad_y_pos=pad_y_pos, pad_y_neg=pad_y_neg, pad_z_pos=pad_z_pos, pad_z_neg=pad_z_neg)
+            # $sol.psf/$sol.pdb are written by NativeSolvate before VMD starts; VMD only ionizes
+            solvate_section = "# Solvated by mstbx.core.Build.NativeSolvate (same -minmax region)"
+        else:
+            solvate_section = """\
 mol new $psf type psf waitfor all 
 mol addfile $pdb type pdb waitfor all 
 
@@ -64,7 +71,16 @@ if {%s} {
 # Solvate and Ionize
 package require solvate
 solvate $psf $pdb -minmax [list $boxmin $boxmax] -o $sol -s W 
+""" % (padding, has_granular, px_neg, px_pos, py_neg, py_pos, pz_neg, pz_pos)
+        tclscript = """\
+#! Generated by MSTBx PSFGenSol module
+set psf %s 
+set pdb %s 
+set sol solvated
+set output %s 
+set salt %s 
 
+%s
 mol delete all 
 package require autoionize 
 autoionize -psf $sol.psf -pdb $sol.pdb -cation SOD -anion CLA -sc $salt -o ionized -seg ION
@@ -107,18 +123,30 @@ if {%s} {
     writepdb $output.hmr.pdb
 }
 quit
-""" % (psf, pdb, ofile, salt, padding, has_granular, 
-       px_neg, px_pos, py_neg, py_pos, pz_neg, pz_pos, hmr)
-        f.write(tclscript)
-        f.close()
+""" % (psf, pdb, ofile, salt, solvate_section, hmr)
+        self.tcl = tclscript
+
+    def solvate_native(self, workdir):
+        """Write solvated.psf/solvated.pdb into ``workdir`` with the NumPy/cKDTree backend."""
+        result = solvate(output=os.path.join(workdir, "solvated"), **self.native)
+        UnixMessage().message(f"Native solvation: {result['waters']} TIP3 waters, {result['atoms']} atoms", "info")
+        return result
+
+    def run(self, workdir=".", log="psfgen.log", echo=True):
+        """Run the rendered PSFGenSol.tcl in a scratch directory below ``workdir`` and promote the outputs."""
+        prepare = self.solvate_native if self.native else None
+        return run_build_job(self.script, self.tcl, self.outputs, workdir, log, prefix=f"{self.ofile}-sol", echo=echo,
+                             prepare=prepare)
 
 class BuildSolutionSMD:
     def __init__(self) -> None:
-        pass
+        self.script = "PSFGenSolSMD.tcl"
 
     def build(self, psf, pdb, salt, ofile, hmr, atomsvec1, atomsvec2, extrapadz, padding=18.0):
         # SMD logic: Align to Z, Strict XY Square, Pad Z+ with extra space
-        f = open("PSFGenSolSMD.tcl", "w")
+        psf, pdb = os.path.abspath(psf), os.path.abspath(pdb)
+        self.ofile = ofile
+        self.outputs = build_outputs(ofile, hmr)
         tclscript = """\
 #! Generated by MSTBx PSFGenSolSMD module
 set psf %s 
@@ -221,5 +249,8 @@ if {%s} {
 }
 quit
 """ % (psf, pdb, ofile, salt, atomsvec1, atomsvec2, padding, extrapadz, hmr)
-        f.write(tclscript)
-        f.close()
+        self.tcl = tclscript
+
+    def run(self, workdir=".", log="psfgen.log", echo=True):
+        """Run the rendered PSFGenSolSMD.tcl in a scratch directory below ``workdir`` and promote the outputs."""
+        return run_build_job(self.script, self.tcl, self.outputs, workdir, log, prefix=f"{self.ofile}-smd", echo=echo)
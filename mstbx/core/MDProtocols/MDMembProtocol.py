@@ -1,8 +1,19 @@
 import os 
 import shutil
+from mstbx.core.Utils.Utils import UnixMessage
+from mstbx.core.Utils.VMDSession import VMDJobError, run_tcl
+from mstbx.core.MDProtocols.RefWriter import NATIVE_FALLBACK_ERRORS, StructureFlags
+
+# Reference files of the membrane protocol and their restrained atoms (VMD selection syntax), k = 5 kcal/mol/A²
+RESTRAINT_REFS = {
+    "restraints/meltlipid.ref": "(protein) or (segid MEMB and type PL) or (segid HETA and noh) or waters or ions",
+    "restraints/protein.ref": "protein or (segid HETA and noh)",
+    "restraints/backbone.ref": 'protein and backbone or (segid HETA and noh) or (segname "CAR.*" and noh)',
+}
 
 class MDProtocolMemb:
     def __init__(self, psf, pdb, temperature, mdtime, dcdfreq=10.0):
+        self.uxm = UnixMessage()
         self.psf = psf
         self.pdb = pdb
         self.temperature = temperature
@@ -390,7 +401,24 @@ run                     $currenttime;     # %s ns
         f.write(md)
         f.close()
 
-    def restraint(self):
+    def restraint(self, use_vmd=False):
+        """Write the meltlipid, protein and backbone reference PDBs in restraints/.
+
+        Uses the native writer (one parse, one pass for all three files);
+        VMD runs only with use_vmd or if that fails.
+        """
+        os.makedirs("restraints", exist_ok=True)
+        if not use_vmd:
+            try:
+                counts = StructureFlags(self.psf, self.pdb).write({path: (selection, 5.0) for path, selection in RESTRAINT_REFS.items()})
+                for path, count in counts.items():
+                    self.uxm.message(f"Restraint reference written: {count} atoms in {path}", "info")
+                return
+            except NATIVE_FALLBACK_ERRORS as error:
+                self.uxm.message(f"Native restraint writer cannot handle this system ({error}); falling back to VMD.", "warning")
+        self.restraint_vmd()
+
+    def restraint_vmd(self):
         f = open("rest.tcl", "w")
         rest = """\
 set psf %s 
@@ -421,8 +449,12 @@ quit
 """ % (self.psf, self.pdb) 
         f.write(rest)
         f.close()
-        os.system("mkdir -p restraints")
-        os.system("vmd -dispdev text -e rest.tcl 2>&1 | tee rest.log")
+        os.makedirs("restraints", exist_ok=True)
+        try:
+            run_tcl("rest.tcl", log="rest.log")
+        except VMDJobError as error:
+            self.uxm.message(f"VMD could not write the restraint references: {error} (see rest.log).", "error")
+            raise
 
     def runner_script(self):
         f = open("runner.sh", "w")
@@ -17,9 +17,24 @@
 #// ****************************************************************************************//#
 
 import os
+import re
+import numpy as np
 from mstbx.core.Utils.Utils import UnixMessage
+from mstbx.core.Utils.VMDSession import VMDJobError, run_tcl
+from mstbx.core.MDProtocols.RefWriter import NATIVE_FALLBACK_ERRORS, StructureFlags
 import shutil
 
+# Backbone, heavy ligand atoms and heavy carbohydrate atoms (VMD selection syntax)
+POSRES_SELECTION = 'protein and backbone or (segid HETA and noh) or (segname "CAR.*" and noh)'
+
+def fill_placeholders(path, values):
+    """Replace whole-word placeholders (e.g. xcenter) in a colvars config with their values."""
+    with open(path, "r") as f:
+        text = f.read()
+    pattern = re.compile(r"\b(%s)\b" % "|".join(map(re.escape, values)))
+    with open(path, "w") as f:
+        f.write(pattern.sub(lambda match: values[match.group(1)], text))
+
 class MDProtocolSol:
     def __init__(self, psf, pdb, temperature, mdtime, dcdfreq=10.0):
         self.uxm = UnixMessage()
@@ -325,7 +340,22 @@ run                     $currenttime;     # %s ns
         f.write(md)
         f.close()
 
-    def restraint(self):
+    def restraint(self, use_vmd=False):
+        """Write restraints/prot_posres.ref (B = 5 kcal/mol/A² on the restrained atoms).
+
+        Uses the native writer; VMD runs only with use_vmd or if that fails.
+        """
+        os.makedirs("restraints", exist_ok=True)
+        if not use_vmd:
+            try:
+                counts = StructureFlags(self.psf, self.pdb).write({"restraints/prot_posres.ref": (POSRES_SELECTION, 5.0)})
+                self.uxm.message(f"Restraint reference written: {counts['restraints/prot_posres.ref']} atoms in restraints/prot_posres.ref", "info")
+                return
+            except NATIVE_FALLBACK_ERRORS as error:
+                self.uxm.message(f"Native restraint writer cannot handle this system ({error}); falling back to VMD.", "warning")
+        self.restraint_vmd()
+
+    def restraint_vmd(self):
         f = open("makerest.tcl", "w")
         rest = """\
 set psf %s 
@@ -336,15 +366,19 @@ mol addfile $pdb
 
 set all [atomselect top "all"] 
 $all set beta 0 
-set restraints [atomselect top "protein and backbone or (segid HETA and noh) or (segname \\"CAR.*\\" and noh)"]
+set restraints [atomselect top "%s"]
 $restraints set beta 5 ;# Set force constant k=5 kcal/mol for restraint atoms
 $all writepdb restraints/prot_posres.ref
 quit
-""" % (self.psf, self.pdb) 
+""" % (self.psf, self.pdb, POSRES_SELECTION.replace('"', '\\"')) 
         f.write(rest)
         f.close()
-        os.system("mkdir -p restraints")
-        os.system("vmd -dispdev text -e makerest.tcl 2>&1 | tee rest.log")
+        os.makedirs("restraints", exist_ok=True)
+        try:
+            run_tcl("makerest.tcl", log="rest.log")
+        except VMDJobError as error:
+            self.uxm.message(f"VMD could not write the restraint reference: {error} (see rest.log).", "error")
+            raise
 
     def runner_script(self):
         f = open("runner.sh", "w")
@@ -416,6 +450,7 @@ echo -e "${GREEN}Simulation steps completed successfully.${NC}"
 class SMDProtocolSol:
     def __init__(self, psf, pdb, temperature, mdtime, selpull, selanchor, targetCenter,
                  kforce=1.5, dcdfreq=5000, velocity=10.0, colvar_input=None):
+        self.uxm = UnixMessage()
         self.psf = psf 
         self.pdb = pdb 
         self.temperature = temperature
@@ -607,7 +642,12 @@ run                     $currenttime;     #  %s ns
             return
 
         f = open("04md/smd.in", "w")
-        colvars = """\
+        f.write(self.colvars_config())
+        f.close()
+
+    def colvars_config(self, center="xcenter", target="xtarget"):
+        """The built-in smd.in; the centres stay placeholders until makecolvarspdb computes them."""
+        return """\
 Colvarstrajfrequency    100
 
 colvar {
@@ -632,20 +672,42 @@ colvar {
 harmonic {
     name SMD 
     colvars  PullAtom        #! in Angstroms 
-    centers  xcenter         #! Centro dos carbonos alpha ou heavy atoms para fazer pulling.
-    targetCenters xtarget    #! Centro taget até a onde se quer fazer pulling.
+    centers  %s         #! Centro dos carbonos alpha ou heavy atoms para fazer pulling.
+    targetCenters %s    #! Centro taget até a onde se quer fazer pulling.
     forceConstant %s         #! Força constante para o pulling em kcal/mol/A² 
     targetNumSteps %s        #! Total número de steps, calculado pela velocidade (%s A/ns).  
     outputCenters   on       #! Print o centers do atoms pulling durante a simulação. 
 
     outputAccumulatedWork yes #! Print o trabajo acumulado, necesario para o jarzynski.
     }
-    """ % (self.kforce, self.mdsteps, self.velocity)
-
-        f.write(colvars)
-        f.close()
-
-    def makecolvarspdb(self):
+    """ % (center, target, self.kforce, self.mdsteps, self.velocity)
+
+    def makecolvarspdb(self, use_vmd=False):
+        """Write 04md/PullAtom.pdb and 04md/AnchorAtom.pdb and put the pulling centres into smd.in.
+
+        The native path reads the structure once, writes both PDBs in one pass
+        and renders smd.in with the centres (a custom --colvar-input config
+        gets its xcenter/xtarget placeholders filled). VMD runs only with
+        use_vmd or if that fails.
+        """
+        if not use_vmd:
+            try:
+                flags = StructureFlags(self.psf, self.pdb)
+                flags.write({"04md/PullAtom.pdb": (self.selpull, 1.0), "04md/AnchorAtom.pdb": (self.selanchor, 5.0)})
+                center = flags.center(self.selpull)[2]
+                values = {"xcenter": f"{center:.6f}", "xtarget": f"{center + float(self.targetCenter):.6f}"}
+                if self.colvar_input and os.path.isdir(self.colvar_input):
+                    fill_placeholders("04md/smd.in", values)
+                else:
+                    with open("04md/smd.in", "w") as f:
+                        f.write(self.colvars_config(values["xcenter"], values["xtarget"]))
+                self.uxm.message(f"SMD centres: pull group z = {values['xcenter']} A, target z = {values['xtarget']} A", "info")
+                return
+            except NATIVE_FALLBACK_ERRORS as error:
+                self.uxm.message(f"Native colvars writer cannot handle this system ({error}); falling back to VMD.", "warning")
+        self.makecolvarspdb_vmd()
+
+    def makecolvarspdb_vmd(self):
         f = open("makePDBcolvars.tcl", "w")
         script = """\
 set psf %s 
@@ -680,7 +742,11 @@ quit
 """ % (self.psf, self.pdb, self.selpull, self.selanchor, self.targetCenter)
         f.write(script)
         f.close()
-        os.system("vmd -dispdev text -e makePDBcolvars.tcl 2>&1 | tee colvars.log")
+        try:
+            run_tcl("makePDBcolvars.tcl", log="colvars.log")
+        except VMDJobError as error:
+            self.uxm.message(f"VMD could not write the colvars PDBs: {error} (see colvars.log).", "error")
+            raise
 
     def runner_script(self):
         f = open("runner.sh", "w")
@@ -731,6 +797,7 @@ class WTMetaDProtocolSol:
     def __init__(self, psf, pdb, temperature, mdtime, hill=0.01, hillfreq=500, width=1.0,
                  biasT=15, sel1="segid PROA and name CA", sel2="segid PROB and name CA", 
                  dunbind=50.0, dcdfreq=5000, colvar_input=None):
+        self.uxm = UnixMessage()
         self.psf = psf 
         self.pdb = pdb 
         self.temperature = temperature
@@ -918,7 +985,12 @@ run                     $currenttime;     # %s ns
             return
 
         f = open("04md/wtmetad.in", "w")
-        colvars = """\
+        f.write(self.colvars_config())
+        f.close()
+
+    def colvars_config(self, lower="xc", upper="xd"):
+        """The built-in wtmetad.in; the walls stay placeholders until makecolvarspdb computes them."""
+        return """\
 Colvarstrajfrequency    100
 
 colvar {
@@ -943,8 +1015,8 @@ colvar {
 harmonicWalls {
     name WTMetaD-Walls
     colvars AtomDistance
-    lowerWalls xc          # lowerboundary. 
-    upperWalls xd         # upperboundary.
+    lowerWalls %s          # lowerboundary. 
+    upperWalls %s         # upperboundary.
     lowerWallConstant 10.0  # Força mesma como em charmm-gui. 
     upperWallConstant 10.0  # Força mesma como em charmm-gui. 
 
@@ -964,11 +1036,34 @@ metadynamics {
                                        # Onde TemperatureMD é a temperatura escolhida da simulação.
                                        # e biasTemperature é a temperatura escolhida aquí, na metadinâmica, biasFactor 15 cá. 
 } 
-""" % (self.width, self.hill, self.hillfreq, self.width, self.biasTemperature) 
-        f.write(colvars)
-        f.close()
-
-    def makecolvarspdb(self):
+""" % (self.width, lower, upper, self.hill, self.hillfreq, self.width, self.biasTemperature) 
+
+    def makecolvarspdb(self, use_vmd=False):
+        """Write 04md/colvars_sel1.pdb and 04md/colvars_sel2.pdb and put the distance walls into wtmetad.in.
+
+        The walls sit 5 A below (not under 0) and dunbind A above the current
+        distance between the two selection centres. The native path reads the
+        structure once and writes both PDBs in one pass. VMD runs only with
+        use_vmd or if that fails.
+        """
+        if not use_vmd:
+            try:
+                flags = StructureFlags(self.psf, self.pdb)
+                flags.write({"04md/colvars_sel1.pdb": (self.sel1, 1.0), "04md/colvars_sel2.pdb": (self.sel2, 1.0)})
+                distance = float(np.linalg.norm(flags.center(self.sel1) - flags.center(self.sel2)))
+                values = {"xc": f"{max(distance - 5.0, 0.0):.6f}", "xd": f"{distance + float(self.dunbind):.6f}"}
+                if self.colvar_input and os.path.isdir(self.colvar_input):
+                    fill_placeholders("04md/wtmetad.in", values)
+                else:
+                    with open("04md/wtmetad.in", "w") as f:
+                        f.write(self.colvars_config(values["xc"], values["xd"]))
+                self.uxm.message(f"WTMetaD walls: {values['xc']}-{values['xd']} A around a distance of {distance:.3f} A", "info")
+                return
+            except NATIVE_FALLBACK_ERRORS as error:
+                self.uxm.message(f"Native colvars writer cannot handle this system ({error}); falling back to VMD.", "warning")
+        self.makecolvarspdb_vmd()
+
+    def makecolvarspdb_vmd(self):
         f = open("makePDBcolvars.tcl", "w")
         script = """\
 set psf %s 
@@ -1008,7 +1103,11 @@ quit
 """ % (self.psf, self.pdb, self.sel1, self.sel2, self.dunbind, self.dunbind) 
         f.write(script)
         f.close()
-        os.system("vmd -dispdev text -e makePDBcolvars.tcl 2>&1 | tee colvars.log")
+        try:
+            run_tcl("makePDBcolvars.tcl", log="colvars.log")
+        except VMDJobError as error:
+            self.uxm.message(f"VMD could not write the colvars PDBs: {error} (see colvars.log).", "error")
+            raise
 
     def runner_script(self):
         f = open("runner.sh", "w")
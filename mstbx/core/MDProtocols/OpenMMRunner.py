@@ -4,13 +4,24 @@ Chef component of the OpenMM Runner integration in MSTBx.
 Consolidates simulation logic and OpenMM/CHARMM-GUI setup.
 """
 
+import io
 import sys
 import os
+import struct
 import shutil
 import glob
+import heapq
+import socket
+import time
+import queue
+import threading
 import warnings
+import json
+import copy
 from math import *
+import numpy as np
 from mstbx.core.Utils.Utils import MSTBxLogger
+from mstbx.core.Utils import Cache
 
 # ==============================================================================
 # Classes and Utility Functions
@@ -46,13 +57,32 @@ try:
     from openmm import *
     from openmm.app import *
     from openmm.unit import *
+    from openmm.app.internal.charmm.topologyobjects import NoUreyBradley
 except ImportError:
-    pass
+    # Base classes of the reporters below, so the CLI still imports without OpenMM
+    StateDataReporter = MinimizationReporter = object
 
 try:
-    from mdtraj.reporters import XTCReporter
+    import pyarrow
+    import pyarrow.parquet
 except ImportError:
-    XTCReporter = None
+    pyarrow = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from statsmodels.tsa.stattools import adfuller, kpss
+except ImportError:
+    adfuller = kpss = None
+
+try:
+    from mdtraj.reporters import XTCReporter, HDF5Reporter
+    from mdtraj.formats import XTCTrajectoryFile, HDF5TrajectoryFile
+except ImportError:
+    XTCReporter = HDF5Reporter = None
 
 def log_message(level, message, debug_mode=False):
     if level == "DEBUG" and not debug_mode:
@@ -66,17 +96,39 @@ def log_message(level, message, debug_mode=False):
 # Input Reading
 # ==============================================================================
 
+# Everything except water and monatomic ions: what the analysis scripts read
+DEFAULT_XTC_SEL = "not (resname TIP3 TIP4 SOL WAT HOH or resname SOD CLA POT CAL MG CES LIT RUB ZN2)"
+
 class OpenMMReadInputs():
     def __init__(self):
         self.mini_nstep       = 0
         self.mini_tol         = 1.0
+        self.mini_de          = 0.0
+        self.mini_fmax        = 0.0
+        self.mini_nprint      = 100
+        self.mini_sd_nstep    = 0
+        self.mini_sd_step     = 0.01
         self.gen_vel          = 'no'
         self.gen_temp         = 300.0
         self.gen_seed         = None
         self.nstep            = 0
         self.dt               = 0.002
+        self.hmass            = 0.0
         self.nstout           = 100
         self.nstdcd           = 0
+        self.nstchk           = 0
+        self.nstxtc           = 0
+        self.xtc_sel          = DEFAULT_XTC_SEL
+        self.xtc_fmt          = 'xtc'
+        self.eq_adaptive      = 'no'
+        self.eq_min_nstep     = 0
+        self.eq_max_nstep     = 0
+        self.eq_block         = 0
+        self.eq_alpha         = 0.05
+        self.guard_nstep      = 0
+        self.guard_retries    = 3
+        self.guard_dt_scale   = 0.5
+        self.guard_de         = 10.0
         self.coulomb          = None  # Will be set to PME after openmm is imported
         self.ewald_Tol        = 0.0005
         self.vdw              = 'Force-switch'
@@ -87,6 +139,8 @@ class OpenMMReadInputs():
         self.temp             = 300.0
         self.fric_coeff       = 1
         self.integrator       = 'Langevin'
+        self.mts_ratio        = 2
+        self.mts_vdw          = 'no'
         self.pcouple          = 'no'
         self.p_ref            = 1.0
         self.p_type           = 'isotropic'
@@ -135,6 +189,11 @@ class OpenMMReadInputs():
                 if input_value:
                     if input_param == 'MINI_NSTEP':                     self.mini_nstep       = int(input_value)
                     if input_param == 'MINI_TOL':                       self.mini_tol         = float(input_value)
+                    if input_param == 'MINI_DE':                        self.mini_de          = float(input_value)
+                    if input_param == 'MINI_FMAX':                      self.mini_fmax        = float(input_value)
+                    if input_param == 'MINI_NPRINT':                    self.mini_nprint      = int(input_value)
+                    if input_param == 'MINI_SD_NSTEP':                  self.mini_sd_nstep    = int(input_value)
+                    if input_param == 'MINI_SD_STEP':                   self.mini_sd_step     = float(input_value)
                     if input_param == 'GEN_VEL':
                         if input_value.upper() == 'YES':                self.gen_vel          = 'yes'
                         if input_value.upper() == 'NO':                 self.gen_vel          = 'no'
@@ -142,8 +201,26 @@ class OpenMMReadInputs():
                     if input_param == 'GEN_SEED':                       self.gen_seed         = int(input_value)
                     if input_param == 'NSTEP':                          self.nstep            = int(input_value)
                     if input_param == 'DT':                             self.dt               = float(input_value)
+                    if input_param == 'HMASS':                          self.hmass            = float(input_value)
                     if input_param == 'NSTOUT':                         self.nstout           = int(input_value)
                     if input_param == 'NSTDCD':                         self.nstdcd           = int(input_value)
+                    if input_param == 'NSTCHK':                         self.nstchk           = int(input_value)
+                    if input_param == 'NSTXTC':                         self.nstxtc           = int(input_value)
+                    if input_param == 'XTC_SEL':                        self.xtc_sel          = input_value.strip('"').strip("'")
+                    if input_param == 'XTC_FMT':
+                        if input_value.upper() == 'XTC':                self.xtc_fmt          = 'xtc'
+                        if input_value.upper() in ('H5', 'HDF5'):       self.xtc_fmt          = 'h5'
+                    if input_param == 'EQ_ADAPTIVE':
+                        if input_value.upper() == 'YES':                self.eq_adaptive      = 'yes'
+                        if input_value.upper() == 'NO':                 self.eq_adaptive      = 'no'
+                    if input_param == 'EQ_MIN_NSTEP':                   self.eq_min_nstep     = int(input_value)
+                    if input_param == 'EQ_MAX_NSTEP':                   self.eq_max_nstep     = int(input_value)
+                    if input_param == 'EQ_BLOCK':                       self.eq_block         = int(input_value)
+                    if input_param == 'EQ_ALPHA':                       self.eq_alpha         = float(input_value)
+                    if input_param == 'GUARD_NSTEP':                    self.guard_nstep      = int(input_value)
+                    if input_param == 'GUARD_RETRIES':                  self.guard_retries    = int(input_value)
+                    if input_param == 'GUARD_DT_SCALE':                 self.guard_dt_scale   = float(input_value)
+                    if input_param == 'GUARD_DE':                       self.guard_de         = float(input_value)
                     if input_param == 'COULOMB':
                         try:
                             if input_value.upper() == 'NOCUTOFF':           self.coulomb          = NoCutoff
@@ -171,6 +248,11 @@ class OpenMMReadInputs():
                     if input_param == 'INTEGRATOR':
                         if input_value.upper() == 'LANGEVIN':           self.integrator       = 'Langevin'
                         if input_value.upper() == 'LANGEVINMIDDLE':     self.integrator       = 'LangevinMiddle'
+                        if input_value.upper() == 'MTSLANGEVIN':        self.integrator       = 'MTSLangevin'
+                    if input_param == 'MTS_RATIO':                      self.mts_ratio        = int(input_value)
+                    if input_param == 'MTS_VDW':
+                        if input_value.upper() == 'YES':                self.mts_vdw          = 'yes'
+                        if input_value.upper() == 'NO':                 self.mts_vdw          = 'no'
                     if input_param == 'PCOUPLE':
                         if input_value.upper() == 'YES':                self.pcouple          = 'yes'
                         if input_value.upper() == 'NO':                 self.pcouple          = 'no'
@@ -235,6 +317,112 @@ class OpenMMReadInputs():
 def read_inputs(inputFile):
     return OpenMMReadInputs().read(inputFile)
 
+# ==============================================================================
+# Structure Session
+# ==============================================================================
+
+def source_stamp(path, digest=None):
+    """ Size, mtime and SHA-256 of one input file, as recorded in a .crd's .key """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest or Cache.file_digest(path)}
+
+class StructureSession(object):
+    """ The PSF and coordinates of one run, each parsed at most once.
+
+    The MDAnalysis Universe is built on first use and shared by the CRD
+    conversion, the MDAnalysis restraints and the XTC_SEL selection. A .pdb
+    is converted to a sibling CHARMM EXT .crd whose {crd}.key stamp records
+    the size, mtime and SHA-256 of the PDB and PSF it was written from; the
+    .crd is reused while the stamp matches, hashing a source only when its
+    size or mtime changed, and regenerated otherwise.
+    """
+    def __init__(self, psf_path, coord_path):
+        self.psf_path = psf_path
+        self.coord_path = coord_path
+        self._universe = None
+        self._coordinates = None
+
+    @property
+    def universe(self):
+        """ mda.Universe of the PSF (if it exists) and coordinates, or None without MDAnalysis """
+        if self._universe is None and mda is not None:
+            if self.psf_path and os.path.exists(self.psf_path): self._universe = mda.Universe(self.psf_path, self.coord_path)
+            else: self._universe = mda.Universe(self.coord_path)
+        return self._universe
+
+    def select(self, selection):
+        """ AtomGroup for an MDAnalysis selection string """
+        return self.universe.select_atoms(selection)
+
+    def sources(self):
+        return [path for path in (self.coord_path, self.psf_path) if path and os.path.exists(path)]
+
+    def crd_status(self, crd_filename):
+        """ (True if crd_filename was converted from the current PDB and PSF,
+        the stamp to store for it or None if the stored one is up to date).
+        Reads only; the caller that trusts the .crd writes the stamp. """
+        stamp = Cache.load_json(f"{crd_filename}.key")
+        sources = self.sources()
+        if stamp is None:
+            # A .crd from before stamps: trust it only if nothing it came from is newer
+            if any(os.path.getmtime(path) > os.path.getmtime(crd_filename) for path in sources):
+                return False, None
+            return True, {os.path.basename(path): source_stamp(path) for path in sources}
+        if set(stamp) != {os.path.basename(path) for path in sources}:
+            return False, None
+        touched = False
+        for path in sources:
+            entry, stat = stamp[os.path.basename(path)], os.stat(path)
+            if (entry.get('size'), entry.get('mtime_ns')) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            digest = Cache.file_digest(path) if entry.get('size') == stat.st_size else None
+            if digest is None or digest != entry.get('sha256'):
+                return False, None
+            stamp[os.path.basename(path)] = source_stamp(path, digest)
+            touched = True
+        return True, (stamp if touched else None)
+
+    def crd_is_current(self, crd_filename):
+        """ True if crd_filename was converted from the current PDB and PSF """
+        return self.crd_status(crd_filename)[0]
+
+    def coordinates(self):
+        """ CharmmCrdFile, PDBFile or AmberInpcrdFile for coord_path (None if unknown), read once """
+        if self._coordinates is None: self._coordinates = self._read_coordinates()
+        return self._coordinates
+
+    def _read_coordinates(self):
+        filename = self.coord_path
+        if filename.endswith('.pdb'):
+            crd_filename = filename.replace('.pdb', '.crd')
+            exists = os.path.exists(crd_filename)
+            current, stamp = self.crd_status(crd_filename) if exists else (False, None)
+            if current:
+                log_message("INFO", f"Using existing internal CHARMM CRD: {crd_filename}")
+                if stamp is not None:
+                    # Saves rehashing next time; a read-only directory just rehashes again
+                    try: Cache.dump_json(f"{crd_filename}.key", stamp)
+                    except OSError: pass
+                return CharmmCrdFile(crd_filename)
+
+            if mda is not None:
+                try:
+                    log_message("INFO", f"Internally converting {filename} to {crd_filename} (CHARMM EXT format){'; the old one is stale' if exists else ''}...")
+                    # Written aside and renamed so concurrent replicas never read a partial .crd
+                    tmp = f"{crd_filename}.{os.getpid()}.tmp.crd"
+                    self.universe.atoms.write(tmp, extended=True)
+                    os.replace(tmp, crd_filename)
+                    Cache.dump_json(f"{crd_filename}.key", {os.path.basename(path): source_stamp(path) for path in self.sources()})
+                    # Positions come from the .crd text on every run, so a fresh conversion starts bit-identically to a cache hit
+                    return CharmmCrdFile(crd_filename)
+                except Exception as e:
+                    log_message("WARNING", f"Internal CRD conversion failed: {e}. Falling back to standard PDBFile.")
+                    return PDBFile(filename)
+            return PDBFile(filename)
+        if filename.endswith('.crd'): return CharmmCrdFile(filename)
+        if filename.endswith('.inpcrd'): return AmberInpcrdFile(filename)
+        return None
+
 # ==============================================================================
 # Force Fields and System Setup
 # ==============================================================================
@@ -280,6 +468,7 @@ def vfswitch(system, psf, inputs):
         if hasattr(psf, 'NONBONDED_FORCE_GROUP'):
             vfswitch_force.setForceGroup(psf.NONBONDED_FORCE_GROUP)
             
+        vfswitch_force.setName('vfswitch')
         system.addForce(vfswitch_force)
     else:
         # vfswitch with NBFIX support
@@ -292,6 +481,7 @@ def vfswitch(system, psf, inputs):
                                 'onoff = Roff * Ron; Roff6 = Roff^6; Roff3 = Roff^3;'
                                 'Ron  = %f; Roff = %f;' % (r_on, r_off))
         nbfix.setUseLongRangeCorrection(False) # As per CHARMM-GUI issues #2353
+        nbfix.setName('vfswitch')
 
     # Add 1-4 scaling support (vfswitch14)
     vfswitch14 = CustomBondForce('select(step(r-Ron),(cr12*rjunk12 - cr6*rjunk6),'
@@ -308,6 +498,7 @@ def vfswitch(system, psf, inputs):
         atom1, atom2, chg, sig, eps = nonbonded.getExceptionParameters(i)
         nonbonded.setExceptionParameters(i, atom1, atom2, chg, 0.0, 0.0) # Zero out LJ14
         vfswitch14.addBond(atom1, atom2, [sig, eps])
+    vfswitch14.setName('vfswitch14')
     system.addForce(vfswitch14)
     return system
 
@@ -337,6 +528,7 @@ def restraints(system, crd, inputs):
                     posresPROT.addParticle(atom1, [inputs.fc_bb, xpos, ypos, zpos]); count += 1
                 if state == 'SC' and inputs.fc_sc > 0: 
                     posresPROT.addParticle(atom1, [inputs.fc_sc, xpos, ypos, zpos]); count += 1
+            posresPROT.setName('posres_prot')
             system.addForce(posresPROT)
             log_message("INFO", f"Applied CHARMM-GUI positional restraints: {count} protein atoms.")
     
@@ -348,15 +540,15 @@ def restraints(system, crd, inputs):
                 segments = line.strip().split(); atom1 = int(segments[0])
                 zpos  = crd.positions[atom1].value_in_unit(nanometers)[2]
                 posresMEMB.addParticle(atom1, [zpos])
+            posresMEMB.setName('posres_memb')
             system.addForce(posresMEMB)
     return system
 
-def apply_mdanalysis_restraints(system, psf_path, pdb_path, inputs, debug_mode=False):
+def apply_mdanalysis_restraints(system, psf_path, pdb_path, inputs, debug_mode=False, session=None):
     """ Strict CHARMM-GUI logic applied to custom MDAnalysis selection """
     if not inputs.rest_atom or inputs.rest_k <= 0 or mda is None:
         return system
-    u = mda.Universe(psf_path, pdb_path)
-    selection = u.select_atoms(inputs.rest_atom)
+    selection = (session or StructureSession(psf_path, pdb_path)).select(inputs.rest_atom)
     if len(selection) == 0:
         log_message("ERROR", f"Selection '{inputs.rest_atom}' matched ZERO atoms!")
         return system
@@ -368,12 +560,13 @@ def apply_mdanalysis_restraints(system, psf_path, pdb_path, inputs, debug_mode=F
     for atom in selection:
         pos = atom.position / 10.0
         force.addParticle(int(atom.index), pos)
+    force.setName('posres_mda')
     system.addForce(force)
     log_message("INFO", f"Applied strict restraints (k*r^2) to {len(selection)} atoms with k={inputs.rest_k} kJ/mol/nm^2")
     return system
 
-def rewrap(simulation):
-    """ VERBATIM Original CHARMM-GUI omm_rewrap.py logic """
+def rewrap_legacy(simulation):
+    """ VERBATIM Original CHARMM-GUI omm_rewrap.py logic (kept as reference for rewrap) """
     bonds = simulation.topology.bonds()
     positions = simulation.context.getState(getPositions=True).getPositions()
     box = simulation.context.getState().getPeriodicBoxVectors()
@@ -437,12 +630,846 @@ def rewrap(simulation):
     simulation.context.setPositions(positions)
     return simulation
 
+def rewrap_index(topology):
+    """ Bond and residue membership arrays used by rewrap, cached on the topology """
+    index = getattr(topology, '_mstbx_rewrap_index', None)
+    if index is not None:
+        return index
+
+    atom_res = np.empty(topology.getNumAtoms(), dtype=np.int64)
+    for residue in topology.residues():
+        for atom in residue.atoms():
+            atom_res[atom.index] = residue.index
+    bonds = np.array([(bond[0].index, bond[1].index) for bond in topology.bonds()], dtype=np.int64).reshape(-1, 2)
+
+    # Residue -> atoms (CSR layout)
+    nres = topology.getNumResidues()
+    res_atoms = np.argsort(atom_res, kind='stable')
+    res_ptr = np.zeros(nres + 1, dtype=np.int64)
+    np.cumsum(np.bincount(atom_res, minlength=nres), out=res_ptr[1:])
+
+    # Residue -> bonds touching any of its atoms, in bond order (CSR layout)
+    res1 = atom_res[bonds[:, 0]]
+    res2 = atom_res[bonds[:, 1]]
+    ids = np.arange(len(bonds), dtype=np.int64)
+    inter = res1 != res2
+    touch_res = np.concatenate([res1, res2[inter]])
+    touch_ids = np.concatenate([ids, ids[inter]])
+    order = np.lexsort((touch_ids, touch_res))
+    touch_bonds = touch_ids[order]
+    touch_ptr = np.zeros(nres + 1, dtype=np.int64)
+    np.cumsum(np.bincount(touch_res, minlength=nres), out=touch_ptr[1:])
+
+    index = (bonds, res2, res_atoms, res_ptr, touch_bonds, touch_ptr)
+    try: topology._mstbx_rewrap_index = index
+    except AttributeError: pass
+    return index
+
+def rewrap(simulation):
+    """ NumPy rewrap with the same bond-order semantics as rewrap_legacy.
+
+    Positions are pulled once as an array, all bonds are tested in bulk and
+    only the broken ones are visited, in topology order. Moving a residue can
+    break or heal later bonds, so the bonds touching it are re-tested and
+    queued again, which reproduces the sequential CHARMM-GUI behaviour.
+    """
+    bonds, res2, res_atoms, res_ptr, touch_bonds, touch_ptr = rewrap_index(simulation.topology)
+    state = simulation.context.getState(getPositions=True)
+    pos = np.array(state.getPositions(asNumpy=True).value_in_unit(nanometers), dtype=np.float64)
+    box = state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(nanometers)
+    boxl = np.array([box[0][0], box[1][1], box[2][2]], dtype=np.float64)
+    half = boxl / 2.0
+    cen = (pos.max(axis=0) + pos.min(axis=0)) / 2.0
+
+    atom1 = bonds[:, 0]
+    atom2 = bonds[:, 1]
+    pending = np.flatnonzero((np.abs(pos[atom1] - pos[atom2]) > half).any(axis=1)).tolist()
+    last = -1
+    moved = 0
+    while pending:
+        j = heapq.heappop(pending)
+        if j <= last: continue
+        axes = np.abs(pos[atom1[j]] - pos[atom2[j]]) > half
+        if not axes.any(): continue
+        last = j
+
+        r = res2[j]
+        atoms = res_atoms[res_ptr[r]:res_ptr[r+1]]
+        old = pos[atoms]
+        pos[atoms] = np.where(axes, np.where(old < cen, old + boxl, old - boxl), old)
+        moved += 1
+
+        later = touch_bonds[touch_ptr[r]:touch_ptr[r+1]]
+        later = later[later > j]
+        if len(later):
+            broken = later[(np.abs(pos[atom1[later]] - pos[atom2[later]]) > half).any(axis=1)]
+            for k in broken.tolist(): heapq.heappush(pending, k)
+
+    if moved:
+        simulation.context.setPositions(pos * nanometers)
+    log_message("INFO", f"Rewrap: re-imaged {moved} residue(s) across {len(bonds)} bonds.")
+    return simulation
+
+# ==============================================================================
+# State Reporting
+# ==============================================================================
+
+# StateDataReporter columns that are plain numbers (not progress/speed strings)
+ENERGY_TABLE_COLUMNS = ['Step', 'Time (ps)', 'Potential Energy (kJ/mole)', 'Kinetic Energy (kJ/mole)', 'Total Energy (kJ/mole)',
+                        'Temperature (K)', 'Box Volume (nm^3)', 'Density (g/mL)', 'Elapsed Time (s)']
+# Rows buffered per Parquet row group
+PARQUET_ROW_GROUP = 1000
+
+def energy_table_path(output_prefix, fmt):
+    return f"{output_prefix}_energy.{fmt}"
+
+class EnergyTable(object):
+    """ Numeric StateDataReporter columns as CSV, or Parquet when pyarrow is available """
+    def __init__(self, filename, append=False):
+        if filename.endswith('.parquet') and pyarrow is None:
+            log_message("WARNING", "Parquet output needs pyarrow; writing the energy table as CSV instead.")
+            filename = filename[:-len('.parquet')] + '.csv'
+        self.filename = filename
+        self._append = append
+        self._out = None
+        self._rows = []
+        self._writer = None
+
+    def open(self, columns):
+        self._columns = columns
+        if self.filename.endswith('.parquet'):
+            self._schema = pyarrow.schema([(name, pyarrow.float64()) for name in columns])
+            previous = None
+            if self._append and os.path.exists(self.filename):
+                try: previous = pyarrow.parquet.read_table(self.filename)
+                except Exception: log_message("WARNING", f"{self.filename} is unreadable (unfinished run?); starting it again.")
+            self._writer = pyarrow.parquet.ParquetWriter(self.filename, self._schema)
+            if previous is not None and previous.schema.names == columns:
+                self._writer.write_table(previous.cast(self._schema))
+        else:
+            new = not (self._append and os.path.exists(self.filename))
+            self._out = open(self.filename, 'w' if new else 'a')
+            if new: print(','.join(f'"{name}"' for name in columns), file=self._out)
+
+    def write(self, values):
+        if self._writer is not None:
+            self._rows.append(values)
+            if len(self._rows) >= PARQUET_ROW_GROUP: self._flush_rows()
+        else:
+            print(','.join(str(v) for v in values), file=self._out)
+            self._out.flush()
+
+    def _flush_rows(self):
+        if self._rows:
+            columns = list(zip(*self._rows))
+            self._writer.write_table(pyarrow.table({name: [float(v) for v in col] for name, col in zip(self._columns, columns)}, schema=self._schema))
+            self._rows = []
+
+    def close(self):
+        if self._writer is not None:
+            self._flush_rows(); self._writer.close(); self._writer = None
+        if self._out is not None:
+            self._out.close(); self._out = None
+
+# name: (StateDataReporter column or None, help text); None is filled in by MetricsExporter
+METRICS = {
+    'mstbx_openmm_ns_per_day':              (None, 'Simulated ns per wall-clock day since the stage (or resume) started'),
+    'mstbx_openmm_steps':                   ('Step', 'Current step'),
+    'mstbx_openmm_target_steps':            (None, 'Step at which the stage ends'),
+    'mstbx_openmm_eta_seconds':             (None, 'Estimated wall-clock seconds to the end of the stage'),
+    'mstbx_openmm_potential_energy_kj_mol': ('Potential Energy (kJ/mole)', 'Potential energy'),
+    'mstbx_openmm_temperature_kelvin':      ('Temperature (K)', 'Instantaneous temperature'),
+    'mstbx_openmm_volume_nm3':              ('Box Volume (nm^3)', 'Periodic box volume'),
+    'mstbx_openmm_peak_rss_bytes':          (None, 'Peak resident set size of this process'),
+    'mstbx_openmm_checkpoint_age_seconds':  (None, 'Seconds since the binary checkpoint was last written'),
+    'mstbx_openmm_last_update_seconds':     (None, 'Unix time of this update'),
+}
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes, or None where unsupported """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class MetricsExporter(object):
+    """ Progress metrics for dashboards, rewritten atomically on every log row.
+
+    Fed by FanOutStateReporter with the row it already computed, so it costs
+    no extra getState. Files ending in .json get a JSON document; anything
+    else is written in the Prometheus textfile format with `system` and
+    `stage` labels.
+    """
+    def __init__(self, filename, system, stage):
+        self.filename = filename
+        if os.path.dirname(filename): os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.labels = {'system': system, 'stage': stage}
+        self.target = None
+        self.checkpoint = None
+        self._start = None
+
+    def begin(self, stage, target_steps, checkpoint=None):
+        """ Start timing a new run_dynamics call """
+        self.labels['stage'] = stage
+        self.target = target_steps
+        self.checkpoint = checkpoint
+        self._start = None
+
+    def update(self, row):
+        now = time.time()
+        if self._start is None:
+            self._start = (now, row['Step'], row['Time (ps)'])
+        wall, steps, ps = now - self._start[0], row['Step'] - self._start[1], row['Time (ps)'] - self._start[2]
+        values = {name: row.get(column) for name, (column, _) in METRICS.items() if column}
+        values['mstbx_openmm_ns_per_day'] = ps / 1000.0 * 86400.0 / wall if wall > 0 else None
+        values['mstbx_openmm_target_steps'] = self.target
+        values['mstbx_openmm_eta_seconds'] = (self.target - row['Step']) * wall / steps if self.target and steps > 0 else None
+        values['mstbx_openmm_peak_rss_bytes'] = peak_rss()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            values['mstbx_openmm_checkpoint_age_seconds'] = now - os.path.getmtime(self.checkpoint)
+        values['mstbx_openmm_last_update_seconds'] = now
+        self.write({name: value for name, value in values.items() if value is not None})
+
+    def write(self, values):
+        if self.filename.endswith('.json'):
+            text = json.dumps({'labels': self.labels, 'metrics': values}, indent=2, sort_keys=True)
+        else:
+            labels = ','.join(f'{key}="{value}"' for key, value in self.labels.items())
+            lines = []
+            for name, value in values.items():
+                lines += [f"# HELP {name} {METRICS[name][1]}", f"# TYPE {name} gauge", f"{name}{{{labels}}} {value}"]
+            text = '\n'.join(lines) + '\n'
+        Cache.atomic_write(self.filename, text, mode='w')
+
+def metrics_exporter(filename, psf_path, output_prefix):
+    """ MetricsExporter labelled with the PSF's directory and the stage's output name, or None.
+    Outputs laid out by replica_prefix (.../rep{i}/name) also get a `replica` label. """
+    if not filename:
+        return None
+    system = os.path.basename(os.path.dirname(os.path.abspath(psf_path)))
+    exporter = MetricsExporter(filename, system, os.path.basename(output_prefix))
+    parent = os.path.basename(os.path.dirname(output_prefix))
+    if parent.startswith('rep') and parent[3:].isdigit(): exporter.labels['replica'] = parent[3:]
+    return exporter
+
+# Observables whose stationarity ends an EQ_ADAPTIVE stage
+EQ_OBSERVABLES = ['Density (g/mL)', 'Box Volume (nm^3)', 'Potential Energy (kJ/mole)']
+# Log rows needed in the tested window (the newer half of the stage so far)
+EQ_MIN_SAMPLES = 20
+
+class EquilibrationMonitor(object):
+    """ Stationarity test of density, volume and potential energy from log rows.
+
+    The newer half of the rows seen so far is tested with an augmented
+    Dickey-Fuller test (null: unit root) and KPSS (null: level-stationary);
+    an observable counts as converged when ADF rejects and KPSS does not at
+    significance alpha. Observables that do not vary (NVT volume) pass.
+    """
+    def __init__(self, alpha=0.05):
+        self.alpha = alpha
+        self.rows = []
+
+    def update(self, row):
+        self.rows.append([row.get(name, 0.0) for name in EQ_OBSERVABLES])
+
+    def test(self):
+        """ (converged, {observable: evidence string}) for the rows collected so far """
+        window = np.asarray(self.rows[len(self.rows) // 2:], dtype=float)
+        if len(window) < EQ_MIN_SAMPLES:
+            return False, {'samples': f"{len(window)} < {EQ_MIN_SAMPLES} in the test window"}
+        converged, evidence = True, {}
+        for name, series in zip(EQ_OBSERVABLES, window.T):
+            if np.ptp(series) <= 1e-9 * max(1.0, np.max(np.abs(series))):
+                evidence[name] = "constant"
+                continue
+            with warnings.catch_warnings():
+                # KPSS warns when its p-value is clipped to its table range
+                warnings.simplefilter("ignore")
+                adf_p = adfuller(series, autolag='AIC')[1]
+                kpss_p = kpss(series, regression='c', nlags='auto')[1]
+            ok = bool(adf_p < self.alpha and kpss_p > self.alpha)
+            converged = converged and ok
+            evidence[name] = f"ADF p={adf_p:.3g}, KPSS p={kpss_p:.3g}{'' if ok else ' (drifting)'}"
+        return converged, evidence
+
+def equilibrate_adaptively(sim, steps, block, min_step, monitor, writer=None, deadline=None):
+    """ Step in blocks of `block` until the monitor reports convergence at or
+    after absolute step min_step, or `steps` have been run. Returns True if it
+    stopped early. `writer` is anything with a drain() (AsyncWriter, StageReporters). """
+    end = sim.currentStep + steps
+    while sim.currentStep < end:
+        n = min(block, end - sim.currentStep)
+        if deadline: step_until(sim, n, deadline)
+        else: sim.step(n)
+        if sim.currentStep < min_step or sim.currentStep >= end:
+            continue
+        # Rows reported by the background writer must be in before testing
+        if writer: writer.drain()
+        converged, evidence = monitor.test()
+        summary = '; '.join(f"{name}: {value}" for name, value in evidence.items())
+        log_message("INFO", f"Adaptive EQ at step {sim.currentStep}: {'converged' if converged else 'not converged'} ({summary})")
+        if converged:
+            return True
+    return False
+
+class FanOutStateReporter(StateDataReporter):
+    """ StateDataReporter that computes each row once and writes it to several sinks.
+
+    `sinks` is a list of (file, append) pairs, each a path or an open file;
+    the header goes to every sink that is not appended to. `table`, if given,
+    is an EnergyTable receiving the numeric columns of the same row, and each
+    of `observers` (MetricsExporter, EquilibrationMonitor) gets the whole row
+    as a {column: value} dict through update().
+    """
+    def __init__(self, sinks, reportInterval, table=None, observers=(), **kwargs):
+        super().__init__(io.StringIO(), reportInterval, **kwargs)
+        self._sinks = []
+        for target, append in sinks:
+            if isinstance(target, str):
+                self._sinks.append((open(target, 'a' if append else 'w'), True, not append))
+            else:
+                self._sinks.append((target, False, True))
+        self._table = table
+        self._observers = [observer for observer in observers if observer is not None]
+
+    def report(self, simulation, state):
+        if not self._hasInitialized:
+            self._initializeConstants(simulation)
+            headers = self._constructHeaders()
+            header = '#"%s"' % ('"'+self._separator+'"').join(headers)
+            for out, _, write_header in self._sinks:
+                if write_header: print(header, file=out); out.flush()
+            self._headers = headers
+            self._columns = [i for i, name in enumerate(headers) if name in ENERGY_TABLE_COLUMNS]
+            if self._table is not None: self._table.open([headers[i] for i in self._columns])
+            self._initialClockTime = time.time()
+            self._initialSimulationTime = state.getTime()
+            self._initialSteps = simulation.currentStep
+            self._hasInitialized = True
+
+        self._checkForErrors(simulation, state)
+        values = self._constructReportValues(simulation, state)
+        line = self._separator.join(str(v) for v in values)
+        for out, _, _ in self._sinks:
+            print(line, file=out); out.flush()
+        if self._table is not None: self._table.write([values[i] for i in self._columns])
+        for observer in self._observers: observer.update(dict(zip(self._headers, values)))
+
+    def close(self):
+        for out, owned, _ in self._sinks:
+            if owned: out.close()
+        self._sinks = []
+        if self._table is not None: self._table.close()
+
+# ==============================================================================
+# Asynchronous Reporting
+# ==============================================================================
+
+# States held in flight per writer; each holds a full copy of the positions
+ASYNC_QUEUE_SIZE = 8
+
+class SimulationSnapshot(object):
+    """ Frozen currentStep for a report handled off the main thread; everything else is read from the Simulation """
+    def __init__(self, simulation):
+        self._simulation = simulation
+        self.currentStep = simulation.currentStep
+    def __getattr__(self, name):
+        return getattr(self._simulation, name)
+
+class AsyncWriter(object):
+    """ One background thread running the report() calls of wrapped reporters in order.
+
+    Simulation already fetches a single State per report step; wrapped
+    reporters only queue it, so dynamics overlaps with formatting and disk
+    I/O. The queue is bounded: when the disk falls ASYNC_QUEUE_SIZE reports
+    behind, the integrator waits instead of buffering States without limit.
+    """
+    def __init__(self, maxsize=ASYNC_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="mstbx-async-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                reporter, snapshot, state = item
+                if self._error is None:
+                    reporter.report(snapshot, state)
+            except BaseException as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def wrap(self, reporter):
+        return AsyncReporter(reporter, self)
+
+    def submit(self, reporter, simulation, state):
+        self._raise()
+        self._queue.put((reporter, SimulationSnapshot(simulation), state))
+
+    def drain(self):
+        """ Block until every queued report has been written """
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+class AsyncReporter(object):
+    """ Reporter proxy that hands report() to an AsyncWriter """
+    def __init__(self, reporter, writer):
+        self.reporter = reporter
+        self._writer = writer
+    def describeNextReport(self, simulation):
+        return self.reporter.describeNextReport(simulation)
+    def report(self, simulation, state):
+        self._writer.submit(self.reporter, simulation, state)
+
+# ==============================================================================
+# Checkpointing and Crash-resume
+# ==============================================================================
+
+class AtomicCheckpointReporter(object):
+    """ Binary Simulation checkpoint every reportInterval steps, replaced by atomic rename """
+    def __init__(self, file, reportInterval, writer=None):
+        self._file = file
+        self._reportInterval = reportInterval
+        self._writer = writer
+
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep % self._reportInterval
+        return {'steps': steps, 'periodic': None, 'include': []}
+
+    def report(self, simulation, state):
+        # Frames up to this step must be on disk before a checkpoint claims them
+        if self._writer is not None: self._writer.drain()
+        Cache.atomic_write(self._file, simulation.context.createCheckpoint())
+
+def truncate_dcd(filename, keep):
+    """ Keep only the first `keep` frames of a DCD written by openmm.app.DCDFile.
+
+    DCDReporter stores its report interval, not the absolute step, as the
+    header's first step, so the caller works out how many frames to keep.
+    """
+    if not os.path.exists(filename) or os.path.getsize(filename) < 276:
+        return 0
+    with open(filename, 'r+b') as f:
+        f.seek(8); nframes, first_step, interval = struct.unpack('<3i', f.read(12))
+        f.seek(48); box_flag = struct.unpack('<i', f.read(4))[0]
+        f.seek(92); comments = struct.unpack('<i', f.read(4))[0]
+        f.seek(104 + comments); natoms = struct.unpack('<i', f.read(4))[0]
+        header = 112 + comments
+        frame = (56 if box_flag else 0) + 3 * (8 + 4 * natoms)
+        on_disk = min(nframes, (os.path.getsize(filename) - header) // frame)
+        keep = max(0, min(on_disk, keep))
+        f.truncate(header + keep * frame)
+        f.seek(8); f.write(struct.pack('<i', keep))
+        f.seek(20); f.write(struct.pack('<i', first_step + max(keep - 1, 0) * interval))
+    return keep
+
+def truncate_log(filename, last_step, separator='\t'):
+    """ Drop StateDataReporter (or CSV energy table) rows written after last_step """
+    if filename.endswith('.parquet'):
+        return truncate_parquet(filename, last_step)
+    if not os.path.exists(filename):
+        return 0
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+    if not lines:
+        return 0
+    headers = [h.strip('"') for h in lines[0].lstrip('#').rstrip('\n').split(separator)]
+    if 'Step' not in headers:
+        return 0
+    col = headers.index('Step')
+    kept = [lines[0]]
+    for line in lines[1:]:
+        fields = line.rstrip('\n').split(separator)
+        try:
+            if len(fields) > col and int(fields[col]) <= last_step:
+                kept.append(line)
+        except ValueError:
+            continue
+    with open(filename, 'w') as f:
+        f.writelines(kept)
+    return len(kept) - 1
+
+def truncate_subset_trajectory(filename, keep):
+    """ Rewrite an XTC/HDF5 trajectory with only its first `keep` frames; neither format can be cut in place """
+    if not os.path.exists(filename) or XTCReporter is None:
+        return 0
+    tmp = f"{filename}.tmp{os.path.splitext(filename)[1]}"
+    if filename.endswith('.h5'):
+        with HDF5TrajectoryFile(filename, 'r') as f:
+            topology = f.topology
+            frames = f.read(n_frames=max(keep, 0)) if keep > 0 else None
+        with HDF5TrajectoryFile(tmp, 'w') as f:
+            if topology is not None: f.topology = topology
+            if frames is not None and len(frames.coordinates):
+                f.write(frames.coordinates, time=frames.time, cell_lengths=frames.cell_lengths, cell_angles=frames.cell_angles)
+        kept = 0 if frames is None else len(frames.coordinates)
+    else:
+        with XTCTrajectoryFile(filename, 'r') as f:
+            xyz, time, step, box = f.read(n_frames=keep) if keep > 0 else (np.empty((0, 0, 3)), None, None, None)
+        if len(xyz) == 0:
+            os.remove(filename)
+            return 0
+        with XTCTrajectoryFile(tmp, 'w') as f:
+            f.write(xyz, time=time, step=step, box=box)
+        kept = len(xyz)
+    os.replace(tmp, filename)
+    return kept
+
+def truncate_parquet(filename, last_step):
+    """ Rewrite a Parquet energy table without the rows after last_step """
+    if pyarrow is None or not os.path.exists(filename):
+        return 0
+    try: table = pyarrow.parquet.read_table(filename)
+    except Exception:
+        os.remove(filename)
+        return 0
+    steps = table.column('Step').to_numpy()
+    table = table.filter(pyarrow.array(steps <= last_step))
+    pyarrow.parquet.write_table(table, filename)
+    return table.num_rows
+
+def stage_completed(output_prefix, rst=None):
+    """ True when the final restart is newer than any checkpoint of this stage """
+    rst, chk = rst or f"{output_prefix}.rst", f"{output_prefix}.chk"
+    return os.path.exists(rst) and (not os.path.exists(chk) or os.path.getmtime(rst) >= os.path.getmtime(chk))
+
+def trim_outputs(output_prefix, inputs, step, start_step=0, energy_table=None):
+    """ Cut a stage's .dcd, .log, energy table and subset trajectory back to `step`.
+    Returns the (DCD frames, log rows, subset frames) kept """
+    # Frames are written at multiples of nstdcd after the stage's start step
+    frames = truncate_dcd(f"{output_prefix}.dcd", step // inputs.nstdcd - start_step // inputs.nstdcd) if inputs.nstdcd > 0 else 0
+    # DCDFile cannot append to a header without frames; the reporter starts a new file instead
+    if frames == 0 and os.path.exists(f"{output_prefix}.dcd"): os.remove(f"{output_prefix}.dcd")
+    rows = truncate_log(f"{output_prefix}.log", step)
+    if energy_table:
+        table = energy_table_path(output_prefix, energy_table)
+        if not os.path.exists(table) and energy_table == 'parquet': table = energy_table_path(output_prefix, 'csv')
+        truncate_log(table, step, separator=',')
+    subset = 0
+    if inputs.nstxtc > 0:
+        subset = truncate_subset_trajectory(f"{output_prefix}.{inputs.xtc_fmt}", step // inputs.nstxtc - start_step // inputs.nstxtc)
+    return frames, rows, subset
+
+def resume_from_checkpoint(sim, output_prefix, inputs, start_step=0, energy_table=None):
+    """ Restore the newest {prefix}.chk and cut .dcd/.log back to its step. Returns True on success """
+    chk = f"{output_prefix}.chk"
+    if not os.path.exists(chk):
+        log_message("INFO", f"--resume: no checkpoint {chk} found, starting the stage from scratch.")
+        return False
+    with open(chk, 'rb') as f:
+        sim.context.loadCheckpoint(f.read())
+    step = sim.currentStep
+    time_ps = sim.context.getState().getTime().value_in_unit(picoseconds)
+    frames, rows, subset = trim_outputs(output_prefix, inputs, step, start_step, energy_table)
+    log_message("INFO", f"--resume: restored {chk} at step {step} ({time_ps:.3f} ps); keeping {frames} DCD frames and {rows} log rows.")
+    if inputs.nstxtc > 0:
+        log_message("INFO", f"--resume: keeping {subset} frames of {output_prefix}.{inputs.xtc_fmt}.")
+    return True
+
+# ==============================================================================
+# Walltime Limits
+# ==============================================================================
+
+# Exit status of openmm-run when it stopped for the walltime (EX_TEMPFAIL: rerun with --resume)
+WALLTIME_EXIT_CODE = 75
+# Seconds kept free before the deadline for the checkpoint, restart and file flushes
+WALLTIME_MARGIN = 120.0
+# Steps before the first throughput measurement, then chunks of about this many seconds
+WALLTIME_FIRST_CHUNK = 100
+WALLTIME_CHUNK_SECONDS = 60.0
+
+class WalltimeReached(Exception):
+    """ Raised by run_dynamics when the next chunk of steps would overrun the deadline """
+    def __init__(self, step, seconds):
+        super().__init__(f"walltime reached at step {step}")
+        self.step = step
+        self.seconds = seconds
+
+def walltime_deadline(max_hours=None, start=None):
+    """ Earliest of start + max_hours and SLURM_JOB_END_TIME (Unix time), or None """
+    deadlines = []
+    if max_hours:
+        deadlines.append((start or time.time()) + max_hours * 3600.0)
+    end = os.environ.get('SLURM_JOB_END_TIME')
+    if end:
+        try: deadlines.append(float(end))
+        except ValueError: log_message("WARNING", f"Ignoring non-numeric SLURM_JOB_END_TIME={end!r}")
+    return min(deadlines) if deadlines else None
+
+def step_until(sim, steps, deadline):
+    """ sim.step(steps) in chunks that finish WALLTIME_MARGIN seconds before deadline.
+
+    The chunk size follows the measured throughput. Raises WalltimeReached,
+    with the steps already taken, when not even one more step fits.
+    """
+    remaining, rate, chunk = steps, None, WALLTIME_FIRST_CHUNK
+    while remaining > 0:
+        available = deadline - WALLTIME_MARGIN - time.time()
+        fit = int(available * rate) if rate else (chunk if available > 0 else 0)
+        n = min(remaining, chunk, fit)
+        if n <= 0:
+            raise WalltimeReached(sim.currentStep, available + WALLTIME_MARGIN)
+        start = time.time()
+        sim.step(n)
+        elapsed = time.time() - start
+        rate = n / elapsed if elapsed > 0 else rate
+        chunk = max(1, int(rate * WALLTIME_CHUNK_SECONDS)) if rate else chunk
+        remaining -= n
+
+# ==============================================================================
+# Instability Guard
+# ==============================================================================
+
+# Clean guard checks at a reduced dt before the stage's own dt is restored
+GUARD_RESTORE_CHECKS = 10
+# Iteration cap of the re-minimization after a repeated blow-up
+GUARD_MINI_STEPS = 1000
+
+class SimulationUnstable(Exception):
+    """ Raised by GuardedStepper when a stage keeps blowing up after guard_retries rollbacks """
+
+class GuardedStepper(object):
+    """ Stand-in for the Simulation in run_dynamics whose step() advances in
+    guard_nstep segments, keeping the state after the last clean segment as an
+    in-memory checkpoint.
+
+    A segment fails when OpenMM or a reporter reports NaN coordinates or
+    energies, or the potential energy rose by more than guard_de kJ/mol per
+    atom since the last good state. The context is then rolled back, rewind
+    (if given) is called with the good step so the outputs can be cut back to
+    it, and the segment is retried with dt scaled by guard_dt_scale; from the
+    second retry on the structure is also re-minimized. The stage's dt comes
+    back after GUARD_RESTORE_CHECKS clean segments. More than guard_retries
+    rollbacks in one call, with fewer than GUARD_RESTORE_CHECKS clean segments
+    between them, raise SimulationUnstable.
+    """
+    def __init__(self, sim, inputs, rewind=None):
+        self.sim = sim
+        self.inputs = inputs
+        self.rewind = rewind
+        self.retries = 0
+        self.clean = 0
+        self.scale = 1.0
+        self.natoms = sim.system.getNumParticles()
+        self.save(self.energy())
+
+    @property
+    def currentStep(self):
+        return self.sim.currentStep
+
+    def energy(self):
+        state = self.sim.context.getState(getEnergy=True)
+        return state.getPotentialEnergy().value_in_unit(kilojoule_per_mole), state.getKineticEnergy().value_in_unit(kilojoule_per_mole)
+
+    def save(self, energies):
+        self.good = self.sim.context.createCheckpoint()
+        self.good_step = self.sim.currentStep
+        self.good_energy = energies[0]
+
+    def check(self):
+        """ (what is wrong with the current state or None, (PE, KE) in kJ/mol) """
+        energies = self.energy()
+        if not all(isfinite(e) for e in energies):
+            return f"non-finite energy (PE {energies[0]}, KE {energies[1]})", energies
+        jump = (energies[0] - self.good_energy) / self.natoms
+        if jump > self.inputs.guard_de:
+            return f"potential energy rose by {jump:.1f} kJ/mol per atom", energies
+        return None, energies
+
+    def set_scale(self, scale):
+        self.scale = scale
+        scaled = copy.copy(self.inputs)
+        scaled.dt = self.inputs.dt * scale
+        update_integrator(self.sim.integrator, scaled)
+
+    def step(self, steps):
+        # Each call (run_dynamics may step in chunks) gets the full retry budget
+        self.retries = 0
+        end = self.sim.currentStep + steps
+        while self.sim.currentStep < end:
+            try:
+                self.sim.step(min(self.inputs.guard_nstep, end - self.sim.currentStep))
+                problem, energies = self.check()
+            except OpenMMException as error:
+                problem = str(error).strip().splitlines()[0]
+            except ValueError as error:
+                # StateDataReporter's NaN/infinite energy check; anything else is not a blow-up
+                if 'Energy is' not in str(error): raise
+                problem = str(error).strip().splitlines()[0]
+            if problem is not None:
+                self.recover(problem)
+                continue
+            self.save(energies)
+            self.clean += 1
+            if self.clean >= GUARD_RESTORE_CHECKS:
+                # The incident is over; a later one starts from the first retry again
+                self.retries = 0
+            if self.scale < 1.0 and self.clean >= GUARD_RESTORE_CHECKS:
+                self.set_scale(1.0)
+                log_message("INFO", f"Guard: {self.clean} clean segments at step {self.sim.currentStep}; dt restored to {self.inputs.dt} ps.")
+
+    def recover(self, problem):
+        failed = self.sim.currentStep
+        self.retries += 1
+        if self.retries > self.inputs.guard_retries:
+            log_message("ERROR", f"Guard: {problem} near step {failed}; giving up after {self.inputs.guard_retries} rollbacks.")
+            raise SimulationUnstable(f"simulation unstable near step {failed}: {problem}")
+        self.sim.context.loadCheckpoint(self.good)
+        if self.rewind: self.rewind(self.good_step)
+        self.set_scale(self.scale * self.inputs.guard_dt_scale)
+        action = f"dt {self.inputs.dt * self.scale:g} ps"
+        if self.retries > 1:
+            self.sim.minimizeEnergy(tolerance=self.inputs.mini_tol*kilojoule_per_mole/nanometer, maxIterations=GUARD_MINI_STEPS)
+            action += " after re-minimizing"
+            self.save(self.energy())
+        self.clean = 0
+        log_message("WARNING", f"Guard: {problem} near step {failed}; rolled back to step {self.good_step}, retry {self.retries}/{self.inputs.guard_retries} with {action}.")
+
+# ==============================================================================
+# Restart Files
+# ==============================================================================
+
+# Bumped if the .npz layout changes; readers reject versions they do not know
+NPZ_RESTART_VERSION = 1
+
+class NpzRestart(object):
+    """ State-like view of a .npz restart (positions, velocities, box, time, step) """
+    def __init__(self, positions, velocities, box, time, step):
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.velocities = np.asarray(velocities, dtype=np.float64)
+        self.box = np.asarray(box, dtype=np.float64)
+        self.time = float(time)
+        self.step = int(step)
+    @classmethod
+    def from_state(cls, state):
+        return cls(state.getPositions(asNumpy=True).value_in_unit(nanometers),
+                   state.getVelocities(asNumpy=True).value_in_unit(nanometers/picosecond),
+                   state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(nanometers),
+                   state.getTime().value_in_unit(picoseconds), state.getStepCount())
+    def getPositions(self, asNumpy=False):
+        return self.positions*nanometers if asNumpy else [Vec3(*xyz) for xyz in self.positions]*nanometers
+    def getVelocities(self, asNumpy=False):
+        return self.velocities*nanometers/picosecond if asNumpy else [Vec3(*v) for v in self.velocities]*nanometers/picosecond
+    def getPeriodicBoxVectors(self, asNumpy=False):
+        return self.box*nanometers if asNumpy else [Vec3(*v) for v in self.box]*nanometers
+    def getTime(self):
+        return self.time*picoseconds
+    def getStepCount(self):
+        return self.step
+
+def restart_path_from(args_orst, output_prefix):
+    """ -orst ending in .npz selects the binary restart, anything else the XML one """
+    return f"{output_prefix}.npz" if str(args_orst).lower().endswith('.npz') else f"{output_prefix}.rst"
+
+def read_restart(filename):
+    """ Read an XML (.rst) or binary (.npz) restart; returns a State or an NpzRestart """
+    if filename.lower().endswith('.npz'):
+        with np.load(filename) as data:
+            version = int(data['version']) if 'version' in data else 0
+            if version > NPZ_RESTART_VERSION:
+                raise ValueError(f"{filename}: restart format version {version} is newer than this MSTBx supports ({NPZ_RESTART_VERSION})")
+            return NpzRestart(data['positions'], data['velocities'], data['box'], data['time'], data['step'])
+    with open(filename, 'r') as f:
+        return XmlSerializer.deserialize(f.read())
+
+def state_to_xml(restart):
+    """ Serialize an NpzRestart as the XML State that XmlSerializer would write """
+    system = System()
+    for _ in range(len(restart.positions)):
+        system.addParticle(1.0)
+    system.setDefaultPeriodicBoxVectors(*restart.getPeriodicBoxVectors())
+    context = Context(system, VerletIntegrator(0.001), Platform.getPlatformByName('Reference'))
+    apply_restart(context, restart)
+    return XmlSerializer.serialize(context.getState(getPositions=True, getVelocities=True))
+
+def write_restart_file(state, filename, compress=False):
+    """ Write a State (or NpzRestart) to .npz (float64 arrays) or XML, by extension """
+    if filename.lower().endswith('.npz'):
+        restart = state if isinstance(state, NpzRestart) else NpzRestart.from_state(state)
+        buffer = io.BytesIO()
+        (np.savez_compressed if compress else np.savez)(
+            buffer, version=np.int32(NPZ_RESTART_VERSION), positions=restart.positions, velocities=restart.velocities,
+            box=restart.box, time=np.float64(restart.time), step=np.int64(restart.step))
+        Cache.atomic_write(filename, buffer.getvalue())
+    else:
+        xml = state_to_xml(state) if isinstance(state, NpzRestart) else XmlSerializer.serialize(state)
+        with open(filename, 'w') as f:
+            f.write(xml)
+
+def apply_restart(context, state):
+    """ Load a restart into a Context; XML States also restore context parameters """
+    if isinstance(state, NpzRestart):
+        context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+        context.setPositions(state.getPositions(asNumpy=True))
+        context.setVelocities(state.getVelocities(asNumpy=True))
+        context.setTime(state.time)
+        context.setStepCount(state.step)
+        return
+    try: context.setState(state)
+    except:
+        context.setPositions(state.getPositions()); context.setVelocities(state.getVelocities()); context.setTime(state.getTime())
+
+def convert_restart(src, dst, compress=False):
+    """ Convert a restart between the XML (.rst) and binary (.npz) formats """
+    state = read_restart(src)
+    write_restart_file(state, dst, compress=compress)
+    natoms = len(state.positions) if isinstance(state, NpzRestart) else state.getPositions(asNumpy=True).shape[0]
+    log_message("INFO", f"Converted restart {src} -> {dst} ({natoms} atoms, {os.path.getsize(src)} -> {os.path.getsize(dst)} bytes)")
+
 # ==============================================================================
 # Input Generation
 # ==============================================================================
 
-def generate_default_inps():
-    """ Generates default .inp files following the unified protocol (Min+EQ1) """
+# 4 fs profile written by generate_default_inps(hmr=True)
+HMR_HMASS = 3.024
+HMR_DT = 0.004
+# At 4 fs the middle scheme gives more accurate configurational sampling than plain Langevin
+HMR_INTEGRATOR = 'LangevinMiddle'
+
+def hmr_profile(content, hmass=HMR_HMASS, dt=HMR_DT):
+    """ Rewrite a 2 fs template for HMR: new dt and hmass, integrator Langevin
+    switched to HMR_INTEGRATOR, and step counts (nstep, nstout, nstdcd, nstchk,
+    nstxtc, eq_*_nstep, eq_block, guard_nstep) scaled so simulated time and
+    output spacing in ps stay the same """
+    def parse(line):
+        key, _, rest = line.partition('=')
+        return key.strip().lower(), rest.split('#')[0].strip()
+    old_dt = next((float(value) for key, value in map(parse, content.splitlines()) if key == 'dt'), 0.002)
+    lines = []
+    for line in content.splitlines(keepends=True):
+        key, value = parse(line)
+        if key == 'dt':
+            lines.append(line.replace(value, f"{dt}", 1))
+            lines.append(f"{'hmass':<12s}= {hmass:<34}# Hydrogen mass repartitioning (amu)\n")
+            continue
+        if key == 'integrator' and value.lower() == 'langevin':
+            # Eat the padding the longer name needs so trailing comments stay aligned
+            padded = value + ' ' * (len(HMR_INTEGRATOR) - len(value))
+            line = line.replace(padded if padded in line else value, HMR_INTEGRATOR, 1)
+        if key in ('nstep', 'nstout', 'nstdcd', 'nstchk', 'nstxtc', 'eq_min_nstep', 'eq_max_nstep', 'eq_block', 'guard_nstep'):
+            line = line.replace(value, str(int(round(int(value) * old_dt / dt))), 1)
+        lines.append(line)
+    return ''.join(lines)
+
+def generate_default_inps(hmr=False):
+    """ Generates default .inp files following the unified protocol (Min+EQ1).
+    With hmr=True the stages use hydrogen mass repartitioning and a 4 fs step. """
     legacy_folders = ['min', 'eq1', 'eq2', 'prod', '02min', '03eq1', '04eq2', '05prod', '02eq1', '03eq2', '04prod']
     for folder in legacy_folders:
         if os.path.exists(folder):
@@ -456,6 +1483,9 @@ def generate_default_inps():
         '02eq1':  ('eq1.inp', (
             "mini_nstep  = 100000                            # Number of steps for minimization\n"
             "mini_tol    = 100.0                             # Minimization energy tolerance\n"
+            "mini_de     = 1.0                               # Stop once E drops less than this over 10 iterations (kJ/mol)...\n"
+            "mini_fmax   = 1000.0                            # ...and the largest atomic force is below this (kJ/mol/nm)\n"
+            "mini_sd_nstep = 0                               # Steepest-descent pre-pass steps for clash-heavy structures\n"
             "\n"
             "gen_vel     = yes                               # Generate initial velocities after minimization\n"
             "gen_temp    = 310                               # Temperature for generating initial velocities (K)\n"
@@ -477,7 +1507,7 @@ def generate_default_inps():
             "\n"
             "temp        = 310                               # Temperature (K)\n"
             "fric_coeff  = 1                                 # Friction coefficient for Langevin dynamics (ps^-1)\n"
-            "integrator  = Langevin                          # Integrator (Langevin or LangevinMiddle)\n"
+            "integrator  = Langevin                          # Integrator (Langevin, LangevinMiddle or MTSLangevin)\n"
             "\n"
             "pcouple     = no                                # Turn on/off pressure coupling\n"
             "p_ref       = 1.0                               # Pressure (bar)\n"
@@ -497,6 +1527,9 @@ def generate_default_inps():
             "nstout      = 5000                              # Writing output frequency (steps)\n"
             "nstdcd      = 5000                              # Writing coordinates trajectory frequency (steps)\n"
             "\n"
+            "eq_adaptive = no                                # End early once density, volume and PE are stationary\n"
+            "eq_min_nstep = 250000                           # Adaptive: minimum steps before stopping (0.5 ns)\n"
+            "\n"
             "gen_vel     = no                                # Use velocities from previous stage\n"
             "\n"
             "coulomb     = PME\n"
@@ -527,6 +1560,9 @@ def generate_default_inps():
             "\n"
             "nstout      = 25000\n"
             "nstdcd      = 25000\n"
+            "nstchk      = 250000                            # Binary checkpoint frequency for --resume (steps)\n"
+            "nstxtc      = 0                                 # Solute-only XTC frequency (steps, 0 = off)\n"
+            f"xtc_sel     = \"{DEFAULT_XTC_SEL}\"\n"
             "\n"
             "gen_vel     = no\n"
             "\n"
@@ -560,6 +1596,7 @@ def generate_default_inps():
         os.makedirs(folder, exist_ok=True)
         if data:
             filename, content = data
+            if hmr: content = hmr_profile(content)
             path = os.path.join(folder, filename)
             if not os.path.exists(path):
                 with open(path, 'w') as f:
@@ -577,37 +1614,50 @@ def read_top(filename):
     elif filename.endswith('.prmtop'): return AmberPrmtopFile(filename)
     return None
 
-def read_crd(filename, psf_path=None):
-    if filename.endswith('.pdb'):
-        crd_filename = filename.replace('.pdb', '.crd')
-        if os.path.exists(crd_filename):
-            log_message("INFO", f"Using existing internal CHARMM CRD: {crd_filename}")
-            return CharmmCrdFile(crd_filename)
-
-        if mda is not None:
-            try:
-                log_message("INFO", f"Internally converting {filename} to {crd_filename} (CHARMM EXT format)...")
-                if psf_path and os.path.exists(psf_path):
-                    u = mda.Universe(psf_path, filename)
-                else:
-                    u = mda.Universe(filename)
-                u.atoms.write(crd_filename, extended=True)
-                return CharmmCrdFile(crd_filename)
-            except Exception as e:
-                log_message("WARNING", f"Internal CRD conversion failed: {e}. Falling back to standard PDBFile.")
-                return PDBFile(filename)
-        return PDBFile(filename)
-    if filename.endswith('.crd'): return CharmmCrdFile(filename)
-    if filename.endswith('.inpcrd'): return AmberInpcrdFile(filename)
-    return None
+def read_crd(filename, psf_path=None, session=None):
+    """ Coordinates for a run; a .pdb goes through the session's validated .crd """
+    return (session or StructureSession(psf_path, filename)).coordinates()
 
-def read_params_from_dir(topdir):
+def toppar_files(topdir):
     rtfs = glob.glob(os.path.join(topdir, '*.rtf'))
     prms = glob.glob(os.path.join(topdir, '*.prm'))
     strs = glob.glob(os.path.join(topdir, '*.str'))
+    return rtfs + prms + strs
+
+def read_params_from_dir(topdir, use_cache=True):
+    """ Parse all CHARMM .rtf/.prm/.str files in topdir into a CharmmParameterSet.
+
+    With use_cache the parsed set is pickled under the MSTBx cache directory,
+    keyed by the content (and order) of every toppar file plus the OpenMM
+    version, so later stages and systems sharing the same toppar skip parsing.
+    """
+    files = toppar_files(topdir)
+
+    cache_path = None
+    if use_cache and files:
+        try:
+            cache_path = os.path.join(Cache.cache_dir('params'), f"{Cache.content_key(files, Platform.getOpenMMVersion())}.pkl")
+        except OSError as e:
+            log_message("WARNING", f"Parameter cache disabled, cannot create the cache directory: {e}")
+    if cache_path:
+        params = Cache.load_pickle(cache_path)
+        if params is not None:
+            # Unpickling copies the NoUreyBradley singleton that CharmmPsfFile tests by identity
+            for ubkey, ubt in params.urey_bradley_types.items():
+                if ubt.k is None and ubt.req is None: params.urey_bradley_types[ubkey] = NoUreyBradley
+            log_message("INFO", f"Parameter cache HIT: {len(files)} toppar files ({cache_path})")
+            return params
+        log_message("INFO", f"Parameter cache MISS: parsing {len(files)} toppar files from {topdir}")
+
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=UserWarning)
-        params = CharmmParameterSet(*(rtfs + prms + strs))
+        params = CharmmParameterSet(*files)
+
+    if cache_path:
+        try:
+            Cache.dump_pickle(cache_path, params)
+        except Exception as e:
+            log_message("WARNING", f"Could not write parameter cache {cache_path}: {e}")
     return params
 
 def read_box_from_str(filename, psf):
@@ -624,47 +1674,13 @@ def read_box_from_str(filename, psf):
     log_message("INFO", f"Taking PBC from {filename}: {box[0]:.3f} x {box[1]:.3f} x {box[2]:.3f}")
     return psf
 
-def run_simulation(args_psf, args_pdb, args_inp, args_irst=None, args_orst='output', args_toppar='toppar/', args_pbc=None, args_platform=None, args_ns=None, args_rewrap=False, args_debug=False):
-    # Extension stripping
-    output_prefix = args_orst
-    for ext in ['.rst', '.dcd', '.xtc', '.log', '.pdb']:
-        if output_prefix.lower().endswith(ext):
-            output_prefix = output_prefix[: -len(ext)]; break
-
-    out_dir = os.path.dirname(output_prefix)
-    if out_dir: os.makedirs(out_dir, exist_ok=True)
-
-    log_message("INFO", f"Loading topology/coords: {args_psf}, {args_pdb}")
-    psf = read_top(args_psf)
-    
-    state = None
-    if args_irst:
-        if os.path.exists(args_irst):
-            log_message("INFO", f"Reading restart file for PBC and state: {args_irst}")
-            with open(args_irst, 'r') as f:
-                state = XmlSerializer.deserialize(f.read())
-            box_vectors = state.getPeriodicBoxVectors()
-            a = box_vectors[0][0].value_in_unit(nanometers) * 10.0
-            b = box_vectors[1][1].value_in_unit(nanometers) * 10.0
-            c = box_vectors[2][2].value_in_unit(nanometers) * 10.0
-            psf.setBox(a*angstroms, b*angstroms, c*angstroms)
-            log_message("INFO", f"Taking PBC from restart file: {a:.3f} x {b:.3f} x {c:.3f}")
-        else:
-            log_message("ERROR", f"Restart file {args_irst} NOT FOUND! Cannot continue safely.")
-            sys.exit(1)
-    else:
-        if not args_pbc:
-            args_pbc = '01build/step3_pbcsetup.str'
-        psf = read_box_from_str(args_pbc, psf)
-        
-    crd = read_crd(args_pdb, args_psf)
-    params = read_params_from_dir(args_toppar)
-    
-    inputs = read_inputs(args_inp)
-    if args_ns: inputs.nstep = int(args_ns * 1000 / inputs.dt)
-    
+def create_system(psf, params, inputs):
+    """ Stage-independent System: createSystem + vfswitch + LJ long-range correction """
+    # hmass > 0 repartitions mass from each heavy atom onto its bonded hydrogens
+    hydrogen_mass = inputs.hmass*amu if inputs.hmass > 0 else None
     system = psf.createSystem(params, nonbondedMethod=inputs.coulomb, nonbondedCutoff=inputs.r_off*nanometers,
-                             constraints=inputs.cons, ewaldErrorTolerance=inputs.ewald_Tol)
+                             constraints=inputs.cons, ewaldErrorTolerance=inputs.ewald_Tol, hydrogenMass=hydrogen_mass)
+    if hydrogen_mass: log_message("INFO", f"Hydrogen mass repartitioning: {inputs.hmass} amu")
     
     if inputs.vdw == 'Force-switch': system = vfswitch(system, psf, inputs)
     
@@ -673,8 +1689,71 @@ def run_simulation(args_psf, args_pdb, args_inp, args_irst=None, args_orst='outp
             if isinstance(force, NonbondedForce): force.setUseDispersionCorrection(True)
             if isinstance(force, CustomNonbondedForce) and force.getNumTabulatedFunctions() != 1:
                 force.setUseLongRangeCorrection(True)
-                
-    if inputs.pcouple == 'yes': system = barostat(system, inputs)
+    return system
+
+def system_cache_key(psf_path, topdir, inputs):
+    """ Content key of everything create_system depends on """
+    fields = (str(inputs.coulomb), inputs.r_on, inputs.r_off, inputs.ewald_Tol, str(inputs.cons), inputs.vdw, inputs.lj_lrc, inputs.hmass)
+    return Cache.content_key([psf_path] + toppar_files(topdir), Platform.getOpenMMVersion(), fields)
+
+def load_system(psf, psf_path, topdir, inputs, use_cache=True, param_cache=True, shared=None):
+    """ Return the stage-independent System, from the serialized cache when possible.
+
+    Stage-specific forces (barostat, restraints) are not part of the cached
+    System and must be added by the caller. On a cache hit the toppar files
+    are not parsed at all. The default box is always taken from the current
+    psf so a System cached in an earlier stage picks up the new box.
+    """
+    if shared:
+        # Serialized once by the ensemble launcher for all of its replicas
+        with open(shared, 'r') as f:
+            system = XmlSerializer.deserialize(f.read())
+        if getattr(psf, "boxVectors", None) is not None:
+            system.setDefaultPeriodicBoxVectors(*psf.boxVectors)
+        log_message("INFO", f"Shared System: {system.getNumParticles()} particles ({shared})")
+        return system
+
+    cache_path = None
+    if use_cache:
+        try:
+            cache_path = os.path.join(Cache.cache_dir('systems'), f"{system_cache_key(psf_path, topdir, inputs)}.xml")
+        except OSError as e:
+            log_message("WARNING", f"System cache disabled, cannot create the cache directory: {e}")
+    if cache_path:
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r') as f:
+                    system = XmlSerializer.deserialize(f.read())
+                if getattr(psf, "boxVectors", None) is not None:
+                    system.setDefaultPeriodicBoxVectors(*psf.boxVectors)
+                log_message("INFO", f"System cache HIT: {system.getNumParticles()} particles ({cache_path})")
+                return system
+            except Exception as e:
+                log_message("WARNING", f"Ignoring unreadable System cache {cache_path}: {e}")
+        log_message("INFO", "System cache MISS: building System from PSF and parameters")
+
+    params = read_params_from_dir(topdir, use_cache=param_cache)
+    system = create_system(psf, params, inputs)
+
+    if cache_path:
+        try:
+            Cache.atomic_write(cache_path, XmlSerializer.serialize(system), mode='w')
+        except Exception as e:
+            log_message("WARNING", f"Could not write System cache {cache_path}: {e}")
+    return system
+
+def output_prefix_from(args_orst):
+    """ Strip a known output extension from -orst and create its directory """
+    output_prefix = args_orst
+    for ext in ['.rst', '.npz', '.dcd', '.xtc', '.h5', '.log', '.pdb']:
+        if output_prefix.lower().endswith(ext):
+            output_prefix = output_prefix[: -len(ext)]; break
+
+    out_dir = os.path.dirname(output_prefix)
+    if out_dir: os.makedirs(out_dir, exist_ok=True)
+    return output_prefix
+
+def add_restraints(system, crd, inputs, args_psf, args_pdb, args_debug=False, session=None):
     if inputs.rest == 'yes':
         has_classic_restraints = os.path.exists('restraints/prot_pos.txt') or os.path.exists('restraints/lipid_pos.txt')
         if has_classic_restraints and (inputs.fc_bb > 0 or inputs.fc_sc > 0 or inputs.fc_lpos > 0 or inputs.fc_mpos > 0):
@@ -682,56 +1761,408 @@ def run_simulation(args_psf, args_pdb, args_inp, args_irst=None, args_orst='outp
             system = restraints(system, crd, inputs)
         elif inputs.rest_atom and inputs.rest_k > 0:
             log_message("INFO", "Applying MDAnalysis-based Restraints.")
-            system = apply_mdanalysis_restraints(system, args_psf, args_pdb, inputs, args_debug)
+            system = apply_mdanalysis_restraints(system, args_psf, args_pdb, inputs, args_debug, session)
         else:
             log_message("WARNING", "Restraints turned ON (rest=yes) but no valid configuration (Classic or MDA) found.")
-            
+    return system
+
+# ==============================================================================
+# Multiple Time Stepping
+# ==============================================================================
+
+# MTSLangevin evaluates MTS_SLOW_GROUP once per dt and MTS_FAST_GROUP mts_ratio times
+MTS_FAST_GROUP = 0
+MTS_SLOW_GROUP = 1
+
+def mts_force_groups(system, inputs):
+    """ Move every force of the final System into the MTSLangevin fast or slow group.
+
+    The reciprocal space of a PME/Ewald/LJPME NonbondedForce is always slow; the
+    vfswitch CustomNonbondedForce is slow only with mts_vdw = yes. Returns the
+    (group, evaluations per step) list for MTSLangevinIntegrator.
+    """
+    layout = {MTS_FAST_GROUP: [], MTS_SLOW_GROUP: []}
+    for force in system.getForces():
+        slow = inputs.mts_vdw == 'yes' and isinstance(force, CustomNonbondedForce)
+        force.setForceGroup(MTS_SLOW_GROUP if slow else MTS_FAST_GROUP)
+        if isinstance(force, NonbondedForce) and force.getNonbondedMethod() in (NonbondedForce.PME, NonbondedForce.Ewald, NonbondedForce.LJPME):
+            force.setReciprocalSpaceForceGroup(MTS_SLOW_GROUP)
+            layout[MTS_FAST_GROUP].append(f"{force.getName()} (direct)")
+            layout[MTS_SLOW_GROUP].append(f"{force.getName()} (reciprocal)")
+        else:
+            layout[force.getForceGroup()].append(force.getName())
+
+    inner = inputs.dt / inputs.mts_ratio
+    log_message("INFO", f"MTS force group {MTS_FAST_GROUP} (every {inner*1000:g} fs): {', '.join(layout[MTS_FAST_GROUP]) or 'none'}")
+    log_message("INFO", f"MTS force group {MTS_SLOW_GROUP} (every {inputs.dt*1000:g} fs): {', '.join(layout[MTS_SLOW_GROUP]) or 'none'}")
+    if not layout[MTS_SLOW_GROUP]:
+        log_message("WARNING", "MTSLangevin: no slow forces (no PME and mts_vdw = no); every force runs at the inner step.")
+    return [(MTS_SLOW_GROUP, 1), (MTS_FAST_GROUP, inputs.mts_ratio)]
+
+def make_integrator(inputs, system=None):
+    """ Integrator for one stage; MTSLangevin also assigns force groups on system """
     if inputs.integrator == 'LangevinMiddle':
         integrator = LangevinMiddleIntegrator(inputs.temp*kelvin, inputs.fric_coeff/picosecond, inputs.dt*picoseconds)
+    elif inputs.integrator == 'MTSLangevin':
+        if inputs.mts_ratio < 1:
+            log_message("ERROR", f"mts_ratio must be a positive integer, got {inputs.mts_ratio}")
+            sys.exit(1)
+        groups = mts_force_groups(system, inputs)
+        integrator = MTSLangevinIntegrator(inputs.temp*kelvin, inputs.fric_coeff/picosecond, inputs.dt*picoseconds, groups)
     else:
         integrator = LangevinIntegrator(inputs.temp*kelvin, inputs.fric_coeff/picosecond, inputs.dt*picoseconds)
     
     log_message("INFO", f"Integrator: {inputs.integrator} ({type(integrator).__name__})")
     log_message("INFO", f"Time step (dt): {inputs.dt} ps ({int(inputs.dt*1000)} fs)")
-    
+    return integrator
+
+def update_integrator(integrator, inputs):
+    """ Apply a stage's dt, temperature and friction to an integrator from make_integrator """
+    integrator.setStepSize(inputs.dt*picoseconds)
+    if inputs.integrator == 'MTSLangevin':
+        # MTSLangevinIntegrator bakes these into global variables at the inner step
+        inner = inputs.dt / inputs.mts_ratio
+        integrator.setGlobalVariableByName('a', exp(-inputs.fric_coeff*inner))
+        integrator.setGlobalVariableByName('b', sqrt(1 - exp(-2*inputs.fric_coeff*inner)))
+        integrator.setGlobalVariableByName('kT', (MOLAR_GAS_CONSTANT_R*inputs.temp*kelvin).value_in_unit(kilojoule_per_mole))
+    else:
+        integrator.setTemperature(inputs.temp*kelvin)
+        integrator.setFriction(inputs.fric_coeff/picosecond)
+
+def resolve_platform(args_platform=None):
+    """ The requested platform, or the first of CUDA -> OpenCL -> CPU that is available """
     platform = Platform.getPlatformByName(args_platform) if args_platform else None
     if not platform:
         for p in ['CUDA', 'OpenCL', 'CPU']:
             try: platform = Platform.getPlatformByName(p); break
             except: continue
+    return platform
+
+def make_simulation(topology, system, integrator, args_platform=None, tuning=None):
+    platform = resolve_platform(args_platform)
     
     prop = {'Precision': 'mixed'} if platform and platform.getName() in ['CUDA', 'OpenCL'] else {}
+    if tuning and platform and platform.getName() == 'CPU':
+        apply_pme_grid(system, tuning.get('pme', 'default'))
+        prop['Threads'] = str(tuning['Threads'])
     
     try:
-        sim = Simulation(psf.topology, system, integrator, platform, prop)
+        sim = Simulation(topology, system, integrator, platform, prop)
     except Exception as e:
         if platform and platform.getName() != 'CPU':
             log_message("WARNING", f"Falling back to CPU: {e}")
-            sim = Simulation(psf.topology, system, integrator, Platform.getPlatformByName('CPU'), {})
+            sim = Simulation(topology, system, integrator, Platform.getPlatformByName('CPU'), {})
         else: raise e
+    return sim
+
+# ==============================================================================
+# CPU Auto-tuning
+# ==============================================================================
+
+# Timed steps per candidate, after AUTOTUNE_WARMUP untimed ones
+AUTOTUNE_STEPS = 50
+AUTOTUNE_WARMUP = 10
+# L-BFGS iterations that relax clashes in the input before any candidate is timed
+AUTOTUNE_MINI_STEPS = 100
+
+def available_cpus():
+    try: return len(os.sched_getaffinity(0))
+    except AttributeError: return os.cpu_count() or 1
+
+def thread_candidates(ncpu):
+    """ Powers of two up to ncpu, plus ncpu itself """
+    counts, n = set([ncpu]), 1
+    while n < ncpu:
+        counts.add(n); n *= 2
+    return sorted(counts)
+
+def smooth_size(n):
+    """ Smallest size >= n whose only prime factors are 2 and 3 """
+    best = 1 << max(0, (n - 1).bit_length())
+    p3 = 1
+    while p3 < best:
+        p2 = p3
+        while p2 < n: p2 *= 2
+        best = min(best, p2); p3 *= 3
+    return best
+
+def pme_force(system):
+    for force in system.getForces():
+        if isinstance(force, NonbondedForce) and force.getNonbondedMethod() in (NonbondedForce.PME, NonbondedForce.LJPME):
+            return force
+    return None
+
+def default_pme_parameters(system):
+    """ (alpha, nx, ny, nz) that OpenMM derives from the cutoff and ewald_Tol """
+    force = pme_force(system)
+    if force is None: return None
+    alpha, nx, ny, nz = force.getPMEParameters()
+    if nx <= 0:
+        context = Context(system, VerletIntegrator(0.001), Platform.getPlatformByName('Reference'))
+        alpha, nx, ny, nz = force.getPMEParametersInContext(context)
+        del context
+    return (alpha.value_in_unit(nanometer**-1) if is_quantity(alpha) else alpha), nx, ny, nz
+
+def apply_pme_grid(system, mode):
+    """ 'smooth' keeps OpenMM's alpha and rounds each grid dimension up to a 2^a*3^b size.
+    A grid at least as fine at the same alpha never loses accuracy against ewald_Tol. """
+    if mode != 'smooth' or pme_force(system) is None:
+        return
+    alpha, nx, ny, nz = default_pme_parameters(system)
+    pme_force(system).setPMEParameters(alpha, smooth_size(nx), smooth_size(ny), smooth_size(nz))
+
+def autotune_key(system, inputs, ncpu):
+    """ Systems within ~19% of each other in size (quarter powers of two) share an entry """
+    natoms = system.getNumParticles()
+    return f"n{int(round(4 * log2(max(natoms, 1))))}_rc{inputs.r_off}_tol{inputs.ewald_Tol}_cpu{ncpu}_omm{Platform.getOpenMMVersion()}"
+
+def relax_positions(system, integrator, positions, steps=AUTOTUNE_MINI_STEPS):
+    """ Positions after a short minimization, which is closer to where dynamics starts
+    than a clashing .crd and keeps the timed steps finite """
+    context = Context(XmlSerializer.clone(system), XmlSerializer.clone(integrator), Platform.getPlatformByName('CPU'))
+    context.setPositions(positions)
+    LocalEnergyMinimizer.minimize(context, 10.0, steps)
+    relaxed = context.getState(getPositions=True).getPositions(asNumpy=True)
+    del context
+    if not np.all(np.isfinite(relaxed.value_in_unit(nanometers))):
+        raise ValueError("minimization produced non-finite positions")
+    return relaxed
+
+def time_candidate(system, integrator, positions, tuning, steps=AUTOTUNE_STEPS):
+    """ Steps per second of one CPU configuration on throw-away copies of system and integrator """
+    system = XmlSerializer.clone(system)
+    apply_pme_grid(system, tuning['pme'])
+    context = Context(system, XmlSerializer.clone(integrator), Platform.getPlatformByName('CPU'), {'Threads': str(tuning['Threads'])})
+    context.setPositions(positions)
+    context.getIntegrator().step(AUTOTUNE_WARMUP)
+    context.getState(getEnergy=True)
+    start = time.perf_counter()
+    context.getIntegrator().step(steps)
+    energy = context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+    rate = steps / (time.perf_counter() - start)
+    if not np.isfinite(energy):
+        raise ValueError("dynamics blew up (non-finite energy)")
+    return rate
+
+def autotune(system, integrator, positions, inputs, args_platform=None, use_cache=True):
+    """ Pick the fastest CPU Threads/PME-grid configuration, cached per host and system size.
+    Candidates are timed from the positions after AUTOTUNE_MINI_STEPS of minimization. """
+    platform = resolve_platform(args_platform)
+    if platform is None or platform.getName() != 'CPU':
+        log_message("INFO", f"--autotune: tunes the CPU platform only; using {platform.getName() if platform else 'default'} as is.")
+        return None
+
+    ncpu = available_cpus()
+    cache_path = None
+    if use_cache:
+        try:
+            cache_path = os.path.join(Cache.cache_dir('autotune'), f"{socket.gethostname()}.json")
+        except OSError as e:
+            log_message("WARNING", f"Autotune cache disabled, cannot create the cache directory: {e}")
+    key = autotune_key(system, inputs, ncpu)
+    table = (Cache.load_json(cache_path) or {}) if cache_path else {}
+    if key in table:
+        tuning = table[key]
+        log_message("INFO", f"Autotune cache HIT ({key}): Threads={tuning['Threads']}, PME grid={tuning['pme']}")
+        return tuning
+
+    try:
+        positions = relax_positions(system, integrator, positions)
+    except Exception as e:
+        log_message("WARNING", f"Autotune: could not minimize the input ({e}); timing the raw coordinates.")
+    modes = ['default', 'smooth'] if pme_force(system) is not None else ['default']
+    results = []
+    for threads in thread_candidates(ncpu):
+        for mode in modes:
+            tuning = {'Threads': threads, 'pme': mode}
+            try:
+                rate = time_candidate(system, integrator, positions, tuning)
+            except Exception as e:
+                log_message("WARNING", f"Autotune candidate Threads={threads}, PME grid={mode} failed: {e}")
+                continue
+            log_message("INFO", f"Autotune: Threads={threads:3d} | PME grid={mode:<7s} | {rate:10.1f} steps/s")
+            results.append((rate, tuning))
+    if not results:
+        return None
+    rate, best = max(results, key=lambda r: r[0])
+    best = dict(best, steps_per_s=round(rate, 1), natoms=system.getNumParticles())
+    log_message("INFO", f"Autotune MISS ({key}): picked Threads={best['Threads']}, PME grid={best['pme']} ({rate:.1f} steps/s)")
+    if cache_path:
+        try:
+            table = Cache.load_json(cache_path) or {}
+            table[key] = best
+            Cache.dump_json(cache_path, table)
+        except Exception as e:
+            log_message("WARNING", f"Could not write autotune cache {cache_path}: {e}")
+    return best
+
+# ==============================================================================
+# Force Profiling
+# ==============================================================================
+
+# Configurations sampled by --profile-forces, PROFILE_INTERVAL steps apart
+PROFILE_SAMPLES = 10
+PROFILE_INTERVAL = 10
+PROFILE_COLUMNS = ['group', 'force', 'ms_per_eval', 'percent', 'energy_kj_mol']
+
+def force_label(force):
+    """ Class name, plus the name set by vfswitch/restraints when there is one """
+    kind = type(force).__name__
+    return kind if force.getName() == kind else f"{force.getName()} ({kind})"
+
+def profile_groups(system):
+    """ Give every force, and PME reciprocal space, its own force group.
+
+    Returns {group: label}. OpenMM has 32 groups, so anything past the 31st
+    shares the last one.
+    """
+    labels = {}
+    for force in system.getForces():
+        group = min(len(labels), 31)
+        force.setForceGroup(group)
+        labels[group] = f"{labels[group]} + {force_label(force)}" if group in labels else force_label(force)
+        if isinstance(force, NonbondedForce) and force.getNonbondedMethod() in (NonbondedForce.PME, NonbondedForce.Ewald, NonbondedForce.LJPME):
+            labels[group] += ' direct'
+            group = min(len(labels), 31)
+            force.setReciprocalSpaceForceGroup(group)
+            labels[group] = f"{labels[group]} + reciprocal" if group in labels else f"{force_label(force)} reciprocal"
+    return labels
+
+def profile_forces(sim, output_prefix, inputs, samples=PROFILE_SAMPLES, interval=PROFILE_INTERVAL):
+    """ Time force/energy evaluations of each force group of sim's System.
+
+    A copy of the System with one group per force runs PROFILE_INTERVAL
+    LangevinMiddle steps between samples, starting from sim's current state on
+    the same platform. At each sample every group is evaluated alone with
+    getState(groups=...). Mean time and energy per group are logged and
+    written to {output_prefix}_forces.csv, costliest first.
+    """
+    system = XmlSerializer.clone(sim.system)
+    labels = profile_groups(system)
+    # The stage integrator may depend on the original groups (MTSLangevin)
+    integrator = LangevinMiddleIntegrator(inputs.temp*kelvin, inputs.fric_coeff/picosecond, inputs.dt*picoseconds)
+    platform = sim.context.getPlatform()
+    properties = {name: platform.getPropertyValue(sim.context, name) for name in platform.getPropertyNames()}
+    context = Context(system, integrator, platform, properties)
+    context.setState(sim.context.getState(getPositions=True, getVelocities=True, getParameters=True))
+
+    costs = {group: 0.0 for group in labels}
+    energies = {group: 0.0 for group in labels}
+    total = 0.0
+    for group in labels:
+        context.getState(getForces=True, getEnergy=True, groups={group})
+    for _ in range(samples):
+        integrator.step(interval)
+        start = time.perf_counter()
+        context.getState(getForces=True, getEnergy=True)
+        total += time.perf_counter() - start
+        for group in labels:
+            start = time.perf_counter()
+            state = context.getState(getForces=True, getEnergy=True, groups={group})
+            costs[group] += time.perf_counter() - start
+            energies[group] += state.getPotentialEnergy().value_in_unit(kilojoule_per_mole)
+
+    grand = np.sum(list(costs.values())) or 1.0
+    rows = [{'group': group, 'force': labels[group], 'ms_per_eval': costs[group] / samples * 1000.0,
+             'percent': 100.0 * costs[group] / grand, 'energy_kj_mol': energies[group] / samples}
+            for group in sorted(labels, key=lambda g: -costs[g])]
+
+    filename = f"{output_prefix}_forces.csv"
+    with open(filename, 'w') as f:
+        f.write(','.join(PROFILE_COLUMNS) + '\n')
+        for row in rows:
+            f.write(f"{row['group']},\"{row['force']}\",{row['ms_per_eval']:.4f},{row['percent']:.2f},{row['energy_kj_mol']:.4f}\n")
+
+    log_message("INFO", f"Force profile over {samples} samples ({platform.getName()}):")
+    log_message("INFO", f"{'group':>5s} | {'ms/eval':>9s} | {'share':>6s} | {'energy (kJ/mol)':>16s} | force")
+    for row in rows:
+        log_message("INFO", f"{row['group']:5d} | {row['ms_per_eval']:9.3f} | {row['percent']:5.1f}% | {row['energy_kj_mol']:16.3f} | {row['force']}")
+    log_message("INFO", f"  all | {total / samples * 1000.0:9.3f} | one evaluation of every group together")
+    log_message("INFO", f"Force profile written to {filename}")
+    return rows
+
+class ConvergenceReporter(MinimizationReporter):
+    """ Logs L-BFGS progress and stops it once the energy change over `window`
+    iterations is below `de` and the largest atomic force is below `fmax`.
+    A threshold of 0 is not checked; with both at 0 OpenMM's tolerance decides. """
+    def __init__(self, de=0.0, fmax=0.0, nprint=100, window=10):
+        MinimizationReporter.__init__(self)
+        self.de, self.fmax, self.nprint, self.window = de, fmax, nprint, window
+        self.energies = []
+        self.iterations = 0
+        self.converged = False
+
+    def report(self, iteration, x, grad, args):
+        energy = args['system energy']
+        self.iterations += 1
+        self.energies = (self.energies + [energy])[-(self.window + 1):]
+        check = (self.de > 0 or self.fmax > 0) and len(self.energies) > self.window and iteration % self.window == 0
+        show = self.nprint > 0 and iteration % self.nprint == 0
+        if not (check or show):
+            return False
+        # Only convert the 3N gradient when it is needed
+        fmax = float(np.sqrt((np.asarray(grad).reshape(-1, 3)**2).sum(axis=1)).max()) if len(grad) else 0.0
+        if show:
+            log_message("INFO", f"L-BFGS iter {iteration:6d} | Energy: {energy:.4f} kJ/mol | Max force: {fmax:.2f} kJ/mol/nm")
+        if check:
+            de = abs(self.energies[0] - self.energies[-1])
+            if (self.de <= 0 or de < self.de) and (self.fmax <= 0 or fmax < self.fmax):
+                log_message("INFO", f"L-BFGS converged at iter {iteration}: |dE| = {de:.4f} kJ/mol over {self.window} iterations, max force {fmax:.2f} kJ/mol/nm")
+                self.converged = True
+                return True
+        return False
+
+def steepest_descent(context, nsteps, max_step=0.01):
+    """ Steepest descent moving the highest-force atom by at most `max_step` nm,
+    growing the step by 1.2 after a downhill move and shrinking it by 0.2 otherwise.
+    Returns (final energy in kJ/mol, accepted steps). """
+    state = context.getState(getPositions=True, getEnergy=True, getForces=True)
+    positions = state.getPositions(asNumpy=True).value_in_unit(nanometers)
+    energy = state.getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+    forces = state.getForces(asNumpy=True).value_in_unit(kilojoules_per_mole/nanometer)
+    step, accepted = max_step, 0
+    for _ in range(nsteps):
+        fmax = np.sqrt((forces**2).sum(axis=1)).max()
+        if fmax == 0 or step < 1e-6: break
+        context.setPositions((positions + forces * (step / fmax)) * nanometers)
+        context.applyConstraints(1e-5)
+        trial = context.getState(getPositions=True, getEnergy=True, getForces=True)
+        trial_energy = trial.getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+        if trial_energy < energy:
+            positions = trial.getPositions(asNumpy=True).value_in_unit(nanometers)
+            forces = trial.getForces(asNumpy=True).value_in_unit(kilojoules_per_mole/nanometer)
+            energy, step, accepted = trial_energy, min(step * 1.2, max_step), accepted + 1
+        else:
+            step *= 0.2
+    context.setPositions(positions * nanometers)
+    return energy, accepted
+
+def minimize(sim, inputs):
+    if inputs.mini_nstep <= 0 and inputs.mini_sd_nstep <= 0:
+        return
+    log_message("INFO", f"Starting minimization ({inputs.mini_sd_nstep} steepest-descent + {inputs.mini_nstep} L-BFGS steps max)...")
+    e_init = sim.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+    log_message("INFO", f"Initial Energy: {e_init:.4f} kJ/mol")
+
+    energy = e_init
+    if inputs.mini_sd_nstep > 0:
+        start = time.time()
+        e_sd, accepted = steepest_descent(sim.context, inputs.mini_sd_nstep, inputs.mini_sd_step)
+        log_message("INFO", f"Steepest descent: {accepted}/{inputs.mini_sd_nstep} steps accepted | Energy: {energy:.4f} -> {e_sd:.4f} kJ/mol | {time.time()-start:.2f} s")
+        energy = e_sd
 
-    sim.context.setPositions(crd.positions)
-    if state:
-        log_message("INFO", f"Applying state from restart: {args_irst}")
-        try: sim.context.setState(state)
-        except:
-            sim.context.setPositions(state.getPositions()); sim.context.setVelocities(state.getVelocities()); sim.context.setTime(state.getTime())
-    
     if inputs.mini_nstep > 0:
-        log_message("INFO", f"Starting minimization ({inputs.mini_nstep} steps max)...")
-        e_init = sim.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
-        log_message("INFO", f"Initial Energy: {e_init:.4f} kJ/mol")
-        
-        n_blocks = 10
-        steps_per_block = max(1, inputs.mini_nstep // n_blocks)
-        for i in range(n_blocks):
-            sim.minimizeEnergy(tolerance=inputs.mini_tol*kilojoule/mole/nanometers, maxIterations=steps_per_block)
-            e_current = sim.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
-            log_message("INFO", f"Minimization Block {i+1}/{n_blocks} | Energy: {e_current:.4f} kJ/mol")
-        
-        e_final = sim.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
-        log_message("INFO", f"Final Minimization Energy: {e_final:.4f} kJ/mol")
+        start = time.time()
+        reporter = ConvergenceReporter(inputs.mini_de, inputs.mini_fmax, inputs.mini_nprint)
+        sim.minimizeEnergy(tolerance=inputs.mini_tol*kilojoule/mole/nanometers, maxIterations=inputs.mini_nstep, reporter=reporter)
+        e_lbfgs = sim.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoules_per_mole)
+        stop = "dE/max-force thresholds" if reporter.converged else "tolerance or iteration limit"
+        log_message("INFO", f"L-BFGS: {reporter.iterations} iterations, stopped by {stop} | Energy: {energy:.4f} -> {e_lbfgs:.4f} kJ/mol | {time.time()-start:.2f} s")
+        energy = e_lbfgs
+
+    log_message("INFO", f"Final Minimization Energy: {energy:.4f} kJ/mol")
 
+def generate_velocities(sim, inputs, restarted=False):
     if inputs.gen_vel == 'yes':
         log_message("INFO", f"Generating initial velocities at {inputs.gen_temp} K...")
         if inputs.gen_seed:
@@ -739,9 +2170,113 @@ def run_simulation(args_psf, args_pdb, args_inp, args_irst=None, args_orst='outp
         else:
             sim.context.setVelocitiesToTemperature(inputs.gen_temp*kelvin)
             
-        if not args_irst:
+        if not restarted:
             sim.context.setTime(0.0)
-    
+
+def select_trajectory_atoms(psf_path, pdb_path, inputs, session=None):
+    """ Zero-based indices of the XTC_SEL atoms, or None if the subset trajectory cannot be written """
+    if XTCReporter is None:
+        log_message("WARNING", "NSTXTC is set but MDTraj is not installed; skipping the subset trajectory.")
+        return None
+    if mda is None:
+        log_message("WARNING", "NSTXTC is set but MDAnalysis is not installed; cannot evaluate XTC_SEL.")
+        return None
+    session = session or StructureSession(psf_path, pdb_path)
+    selection = session.select(inputs.xtc_sel)
+    if len(selection) == 0:
+        log_message("ERROR", f"XTC_SEL '{inputs.xtc_sel}' matched ZERO atoms! Skipping the subset trajectory.")
+        return None
+    log_message("INFO", f"Subset trajectory: {len(selection)} of {session.universe.atoms.n_atoms} atoms ('{inputs.xtc_sel}') every {inputs.nstxtc} steps.")
+    return selection.indices
+
+def subset_trajectory_reporter(filename, interval, atoms, append=False):
+    """ MDTraj XTC (or chunked, compressed HDF5 for .h5) reporter for an atom subset """
+    append = append and os.path.exists(filename)
+    if filename.endswith('.h5'):
+        try:
+            handle = HDF5TrajectoryFile(filename, 'a' if append else 'w')
+        except ImportError:
+            log_message("WARNING", "HDF5 output needs PyTables; writing XTC instead.")
+            return subset_trajectory_reporter(filename[:-3] + '.xtc', interval, atoms, append)
+        return HDF5Reporter(handle, interval, potentialEnergy=False, kineticEnergy=False, temperature=False, atomSubset=atoms)
+    return XTCReporter(filename, interval, atomSubset=atoms, append=append)
+
+def close_reporter(reporter):
+    """ Close the file behind a (possibly AsyncReporter-wrapped) trajectory reporter """
+    reporter = getattr(reporter, 'reporter', reporter)
+    if hasattr(reporter, 'close'): reporter.close()
+    elif hasattr(reporter, '_out'): reporter._out.close()
+
+class StageReporters(object):
+    """ The log, energy table, DCD, subset trajectory and checkpoint reporters of
+    one run_dynamics call. rewind() detaches them, cuts their files back to a
+    step and attaches them again in append mode. """
+    def __init__(self, sim, inputs, output_prefix, rep_args, xtc_atoms=None, async_io=False, energy_table=None, terminal=True, observers=(), start_step=0):
+        self.sim = sim
+        self.inputs = inputs
+        self.output_prefix = output_prefix
+        self.rep_args = rep_args
+        self.xtc_atoms = xtc_atoms
+        self.async_io = async_io
+        self.energy_table = energy_table
+        self.terminal = terminal
+        self.observers = observers
+        self.start_step = start_step
+        self.attached = []
+
+    def attach(self, append=False):
+        inputs, prefix = self.inputs, self.output_prefix
+        self.writer = AsyncWriter() if self.async_io else None
+        table = EnergyTable(energy_table_path(prefix, self.energy_table), append=append) if self.energy_table else None
+        # One row per report, written to the terminal, the .log and the optional energy table
+        sinks = ([(sys.stdout, False)] if self.terminal else []) + [(f"{prefix}.log", append)]
+        self.state_reporter = FanOutStateReporter(sinks, inputs.nstout, table=table, observers=self.observers, **self.rep_args)
+        output = [self.state_reporter]
+        if inputs.nstdcd > 0: output.append(DCDReporter(f"{prefix}.dcd", inputs.nstdcd, append=append and os.path.exists(f"{prefix}.dcd")))
+        if inputs.nstxtc > 0 and self.xtc_atoms is not None:
+            output.append(subset_trajectory_reporter(f"{prefix}.{inputs.xtc_fmt}", inputs.nstxtc, self.xtc_atoms, append=append))
+        if self.writer: output = [self.writer.wrap(reporter) for reporter in output]
+        # After the DCD so a frame and the checkpoint of the same step land in that order
+        if inputs.nstchk > 0: output.append(AtomicCheckpointReporter(f"{prefix}.chk", inputs.nstchk, self.writer))
+        self.sim.reporters.extend(output)
+        self.attached = output
+
+    def drain(self):
+        if self.writer: self.writer.drain()
+
+    def detach(self, close_files=False, discard=False):
+        """ Flush the writer and close the log; close_files also closes and
+        removes the trajectory reporters. discard drops pending write errors. """
+        try:
+            if self.writer: self.writer.close()
+        except Exception:
+            if not discard: raise
+        finally:
+            self.state_reporter.close()
+            if close_files:
+                for reporter in self.attached[1:]: close_reporter(reporter)
+                for reporter in self.attached:
+                    if reporter in self.sim.reporters: self.sim.reporters.remove(reporter)
+                self.attached = []
+
+    def rewind(self, step):
+        """ Drop everything reported after `step` (the context was rolled back to it) """
+        self.detach(close_files=True, discard=True)
+        trim_outputs(self.output_prefix, self.inputs, step, self.start_step, self.energy_table)
+        chk = f"{self.output_prefix}.chk"
+        if self.inputs.nstchk > 0 and os.path.exists(chk):
+            # A checkpoint from the failed segment would resume past the trimmed outputs
+            Cache.atomic_write(chk, self.sim.context.createCheckpoint())
+        self.attach(append=True)
+
+def run_dynamics(sim, inputs, output_prefix, steps=None, append=False, xtc_atoms=None, async_io=False, energy_table=None, terminal=True, metrics=None, deadline=None, stage_start=None):
+    """ Attach the stage reporters and step; returns the wall time spent stepping (s).
+    Every reporter file is flushed and closed before returning. With a deadline
+    (Unix time) steps in chunks and raises WalltimeReached if the stage cannot
+    finish in time. With eq_adaptive
+    the stage may end early; stage_start (absolute step) anchors eq_min_nstep.
+    With guard_nstep > 0 steps through a GuardedStepper. """
+    if steps is None: steps = inputs.nstep
     rep_args = {
         'step': True,
         'time': True,
@@ -754,21 +2289,370 @@ def run_simulation(args_psf, args_pdb, args_inp, args_irst=None, args_orst='outp
         'progress': True,
         'remainingTime': True,
         'speed': True,
-        'totalSteps': sim.currentStep + inputs.nstep,
+        'totalSteps': sim.currentStep + steps,
         'separator': '\t'
     }
     
-    if inputs.nstep > 0:
-        sim.reporters.append(StateDataReporter(sys.stdout, inputs.nstout, **rep_args))
-        sim.reporters.append(StateDataReporter(f"{output_prefix}.log", inputs.nstout, **rep_args))
-        if inputs.nstdcd > 0: sim.reporters.append(DCDReporter(f"{output_prefix}.dcd", inputs.nstdcd))
+    if steps > 0:
+        if stage_start is None: stage_start = sim.currentStep
+        if metrics: metrics.begin(os.path.basename(output_prefix), rep_args['totalSteps'], f"{output_prefix}.chk" if inputs.nstchk > 0 else None)
+        monitor = None
+        if inputs.eq_adaptive == 'yes':
+            if adfuller is None: log_message("WARNING", "EQ_ADAPTIVE needs statsmodels; running the full stage.")
+            else: monitor = EquilibrationMonitor(inputs.eq_alpha)
+        reporters = StageReporters(sim, inputs, output_prefix, rep_args, xtc_atoms, async_io, energy_table, terminal, [metrics, monitor], stage_start if append else sim.currentStep)
+        reporters.attach(append)
+        stepper = sim
+        if inputs.guard_nstep > 0:
+            log_message("INFO", f"Guard: checking every {inputs.guard_nstep} steps, up to {inputs.guard_retries} rollbacks (dt x{inputs.guard_dt_scale} per retry)")
+            stepper = GuardedStepper(sim, inputs, reporters.rewind)
         
-        log_message("INFO", f"Running dynamics: {inputs.nstep} steps...")
-        sim.step(inputs.nstep)
+        log_message("INFO", f"Running dynamics: {steps} steps{' (asynchronous output)' if async_io else ''}...")
+        start = time.time()
+        try:
+            if monitor:
+                min_step = stage_start + inputs.eq_min_nstep
+                block = inputs.eq_block or 10 * inputs.nstout
+                log_message("INFO", f"Adaptive EQ: testing {', '.join(EQ_OBSERVABLES)} every {block} steps from step {min_step} (alpha {inputs.eq_alpha})")
+                if equilibrate_adaptively(stepper, steps, block, min_step, monitor, reporters, deadline):
+                    log_message("INFO", f"Adaptive EQ: stationary at step {sim.currentStep}; ending the stage {rep_args['totalSteps'] - sim.currentStep} steps early.")
+                else:
+                    log_message("INFO", f"Adaptive EQ: not stationary by step {sim.currentStep}; stage ran its full step budget.")
+            elif deadline: step_until(stepper, steps, deadline)
+            else: stepper.step(steps)
+        finally:
+            # Close the .dcd/subset files now: the next stage or a resume trims and reopens them
+            reporters.detach(close_files=True)
+        return time.time() - start
+    return 0.0
+
+def set_box_from_state(psf, state):
+    box_vectors = state.getPeriodicBoxVectors()
+    a = box_vectors[0][0].value_in_unit(nanometers) * 10.0
+    b = box_vectors[1][1].value_in_unit(nanometers) * 10.0
+    c = box_vectors[2][2].value_in_unit(nanometers) * 10.0
+    psf.setBox(a*angstroms, b*angstroms, c*angstroms)
+    log_message("INFO", f"Taking PBC from restart file: {a:.3f} x {b:.3f} x {c:.3f}")
+
+def write_restart(sim, output_prefix, filename=None, compress=False):
+    filename = filename or f"{output_prefix}.rst"
+    write_restart_file(sim.context.getState(getPositions=True, getVelocities=True), filename, compress=compress)
+    log_message("INFO", f"Restart written: {filename}")
+
+def run_simulation(args_psf, args_pdb, args_inp, args_irst=None, args_orst='output', args_toppar='toppar/', args_pbc=None, args_platform=None, args_ns=None, args_rewrap=False, args_debug=False, args_param_cache=True, args_system_cache=True, args_resume=False, args_rst_compress=False, args_async_io=False, args_energy_table=None, args_autotune=False, args_seed=None, args_shared_system=None, args_threads=None, args_quiet=False, args_profile_forces=False, args_metrics=None, args_max_hours=None):
+    """ Run one stage. args_seed to args_quiet are set by run_ensemble for each replica.
+    Returns {'steps', 'seconds', 'ns_per_day'} for the dynamics just run.
+    With args_profile_forces the stage is only set up, minimized and profiled.
+    If args_max_hours or SLURM_JOB_END_TIME would cut the stage short it stops
+    with a checkpoint and partial restart and the result has 'walltime': True. """
+    deadline = walltime_deadline(args_max_hours)
+    output_prefix = output_prefix_from(args_orst)
+    restart_file = restart_path_from(args_orst, output_prefix)
+    if args_resume and stage_completed(output_prefix, restart_file):
+        log_message("INFO", f"--resume: {restart_file} is newer than any checkpoint; stage already complete.")
+        return {'steps': 0, 'seconds': 0.0, 'ns_per_day': 0.0}
+
+    log_message("INFO", f"Loading topology/coords: {args_psf}, {args_pdb}")
+    psf = read_top(args_psf)
     
+    state = None
+    if args_irst:
+        if os.path.exists(args_irst):
+            log_message("INFO", f"Reading restart file for PBC and state: {args_irst}")
+            state = read_restart(args_irst)
+            set_box_from_state(psf, state)
+        else:
+            log_message("ERROR", f"Restart file {args_irst} NOT FOUND! Cannot continue safely.")
+            sys.exit(1)
+    else:
+        if not args_pbc:
+            args_pbc = '01build/step3_pbcsetup.str'
+        psf = read_box_from_str(args_pbc, psf)
+        
+    session = StructureSession(args_psf, args_pdb)
+    crd = read_crd(args_pdb, args_psf, session)
+    
+    inputs = read_inputs(args_inp)
+    if inputs.eq_adaptive == 'yes' and inputs.eq_max_nstep > 0: inputs.nstep = inputs.eq_max_nstep
+    if args_ns: inputs.nstep = int(args_ns * 1000 / inputs.dt)
+    if args_seed is not None: inputs.gen_seed = args_seed
+    
+    system = load_system(psf, args_psf, args_toppar, inputs, use_cache=args_system_cache, param_cache=args_param_cache, shared=args_shared_system)
+                
+    if inputs.pcouple == 'yes': system = barostat(system, inputs)
+    system = add_restraints(system, crd, inputs, args_psf, args_pdb, args_debug, session)
+            
+    integrator = make_integrator(inputs, system)
+    if args_seed is not None: integrator.setRandomNumberSeed(args_seed)
+    tuning = autotune(system, integrator, crd.positions, inputs, args_platform) if args_autotune else None
+    if args_threads: tuning = {'Threads': args_threads, 'pme': (tuning or {}).get('pme', 'default')}
+    sim = make_simulation(psf.topology, system, integrator, args_platform, tuning)
+
+    sim.context.setPositions(crd.positions)
+    if state:
+        log_message("INFO", f"Applying state from restart: {args_irst}")
+        apply_restart(sim.context, state)
+    
+    xtc_atoms = select_trajectory_atoms(args_psf, args_pdb, inputs, session) if inputs.nstxtc > 0 else None
+
+    if args_profile_forces:
+        minimize(sim, inputs)
+        generate_velocities(sim, inputs, restarted=bool(args_irst))
+        profile_forces(sim, output_prefix, inputs)
+        return {'steps': 0, 'seconds': 0.0, 'ns_per_day': 0.0}
+
+    metrics = metrics_exporter(args_metrics, args_psf, output_prefix)
+
+    # Step count restored from -irst; the stage ends at start_step + nstep
+    start_step = sim.currentStep
+    resumed = resume_from_checkpoint(sim, output_prefix, inputs, start_step, args_energy_table) if args_resume else False
+    if deadline: log_message("INFO", f"Walltime: stopping by {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(deadline))} ({(deadline - time.time()) / 3600.0:.2f} h left)")
+    try:
+        if resumed:
+            first = sim.currentStep
+            seconds = run_dynamics(sim, inputs, output_prefix, steps=start_step + inputs.nstep - first, append=True, xtc_atoms=xtc_atoms, async_io=args_async_io, energy_table=args_energy_table, terminal=not args_quiet, metrics=metrics, deadline=deadline, stage_start=start_step)
+        else:
+            minimize(sim, inputs)
+            generate_velocities(sim, inputs, restarted=bool(args_irst))
+            first = sim.currentStep
+            seconds = run_dynamics(sim, inputs, output_prefix, xtc_atoms=xtc_atoms, async_io=args_async_io, energy_table=args_energy_table, terminal=not args_quiet, metrics=metrics, deadline=deadline, stage_start=start_step)
+    except WalltimeReached as stop:
+        # Reporters are closed, so every frame and log row up to this step is on disk
+        Cache.atomic_write(f"{output_prefix}.chk", sim.context.createCheckpoint())
+        root, ext = os.path.splitext(restart_file)
+        write_restart(sim, output_prefix, f"{root}.part{ext}", compress=args_rst_compress)
+        done = stop.step - start_step
+        log_message("WARNING", f"Walltime: stopped at step {stop.step} ({done}/{inputs.nstep} steps, {stop.seconds:.0f} s before the deadline). "
+                               f"Checkpoint {output_prefix}.chk written; rerun with --resume to continue.")
+        return {'steps': done, 'seconds': 0.0, 'ns_per_day': 0.0, 'walltime': True}
+    
+    # Fewer than nstep when EQ_ADAPTIVE ended the stage early
+    steps = sim.currentStep - first
     if args_rewrap: rewrap(sim)
     
-    with open(f"{output_prefix}.rst", 'w') as f:
-        f.write(XmlSerializer.serialize(sim.context.getState(getPositions=True, getVelocities=True)))
+    write_restart(sim, output_prefix, restart_file, compress=args_rst_compress)
     
     log_message("INFO", "Done.")
+    ns_per_day = steps * inputs.dt / 1000.0 / (seconds / 86400.0) if seconds > 0 else 0.0
+    return {'steps': steps, 'seconds': seconds, 'ns_per_day': ns_per_day}
+
+# ==============================================================================
+# Multi-replica Ensemble
+# ==============================================================================
+
+def replica_prefix(args_orst, index):
+    """ {dir}/rep{i}/{name}: each replica keeps the -orst file name in its own directory """
+    return os.path.join(os.path.dirname(args_orst), f"rep{index}", os.path.basename(args_orst))
+
+def replica_cpus(index, nreplicas, cpus):
+    """ Contiguous, equal share of the allowed CPUs for one replica """
+    share = max(1, len(cpus) // nreplicas)
+    start = (index * share) % len(cpus)
+    return cpus[start:start + share]
+
+def _replica_worker(index, cpus, kwargs):
+    """ Process-pool entry point: pin to this replica's CPUs, then run the stage """
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        try: os.sched_setaffinity(0, cpus)
+        except OSError as e: log_message("WARNING", f"Replica {index}: could not pin to CPUs {cpus}: {e}")
+    result = run_simulation(**kwargs)
+    return dict(result, replica=index, seed=kwargs['args_seed'], cpus=len(cpus))
+
+def run_ensemble(nreplicas, args_psf, args_pdb, args_inp, args_irst=None, args_orst='output', args_toppar='toppar/', args_pbc=None, args_platform=None, **kwargs):
+    """ Run nreplicas copies of one stage in a process pool, one gen_seed each.
+
+    The System is built (or loaded from the cache) once here and handed to the
+    replicas as serialized XML. Replica i writes {dir}/rep{i}/{name}.*, gets
+    gen_seed + i (also used as the integrator seed; a gen_seed <= 0 counts as
+    unset and the seeds start at 1), and on CPU uses an equal,
+    pinned share of the allowed cores. A per-replica and aggregate ns/day
+    table is logged and written to {dir}/ensemble.csv.
+    """
+    inputs = read_inputs(args_inp)
+    # Seed 0 means "random" to OpenMM and the template's -1 would hand it to replica 1
+    base_seed = inputs.gen_seed if inputs.gen_seed is not None and inputs.gen_seed > 0 else 1
+    psf = read_top(args_psf)
+    if args_irst:
+        set_box_from_state(psf, read_restart(args_irst))
+    else:
+        psf = read_box_from_str(args_pbc or '01build/step3_pbcsetup.str', psf)
+    system = load_system(psf, args_psf, args_toppar, inputs, use_cache=kwargs.get('args_system_cache', True), param_cache=kwargs.get('args_param_cache', True))
+
+    out_dir = os.path.dirname(output_prefix_from(args_orst)) or '.'
+    shared = os.path.join(out_dir, 'ensemble_system.xml')
+    Cache.atomic_write(shared, XmlSerializer.serialize(system), mode='w')
+
+    platform = resolve_platform(args_platform)
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(available_cpus()))
+    threads = max(1, len(cpus) // nreplicas)
+    log_message("INFO", f"Ensemble: {nreplicas} replicas of {args_inp} on {platform.getName()}, {threads} CPU thread(s) each, seeds {base_seed}..{base_seed + nreplicas - 1}")
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = []
+    try:
+        # spawn: OpenMM platforms are not safe to use across fork()
+        with ProcessPoolExecutor(max_workers=nreplicas, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for i in range(nreplicas):
+                job = dict(kwargs, args_psf=args_psf, args_pdb=args_pdb, args_inp=args_inp, args_irst=args_irst,
+                           args_orst=replica_prefix(args_orst, i), args_toppar=args_toppar, args_pbc=args_pbc,
+                           args_platform=platform.getName(), args_seed=base_seed + i, args_shared_system=shared,
+                           args_threads=threads, args_quiet=True)
+                if kwargs.get('args_metrics'): job['args_metrics'] = replica_prefix(kwargs['args_metrics'], i)
+                jobs.append(pool.submit(_replica_worker, i, replica_cpus(i, nreplicas, cpus), job))
+            results = [job.result() for job in jobs]
+    finally:
+        os.remove(shared)
+
+    rows = ["replica,seed,cpus,steps,seconds,ns_per_day"]
+    for r in results:
+        log_message("INFO", f"Replica {r['replica']:3d} | seed {r['seed']} | {r['cpus']} CPU(s) | {r['ns_per_day']:.2f} ns/day")
+        rows.append(f"{r['replica']},{r['seed']},{r['cpus']},{r['steps']},{r['seconds']:.3f},{r['ns_per_day']:.4f}")
+    # openmm.unit's star import shadows the builtin sum()
+    total = float(np.sum([r['ns_per_day'] for r in results]))
+    steps = int(np.sum([r['steps'] for r in results]))
+    rows.append(f"all,,{len(cpus)},{steps},{np.max([r['seconds'] for r in results]):.3f},{total:.4f}")
+    log_message("INFO", f"Ensemble aggregate throughput: {total:.2f} ns/day over {nreplicas} replicas")
+    with open(os.path.join(out_dir, 'ensemble.csv'), 'w') as f:
+        f.write("\n".join(rows) + "\n")
+    return results
+
+# ==============================================================================
+# In-process Multi-stage Protocol
+# ==============================================================================
+
+# Stage layout written by generate_default_inps: (input file, output prefix)
+PROTOCOL_STAGES = [
+    ('02eq1/eq1.inp', '02eq1/eq1'),
+    ('03eq2/eq2.inp', '03eq2/eq2'),
+    ('04prod/prod.inp', '04prod/prod'),
+]
+
+def restraint_signature(inputs):
+    """ Restraint-relevant inputs; stages with equal signatures share one gated force set """
+    if inputs.rest != 'yes':
+        return None
+    return (inputs.fc_bb, inputs.fc_sc, inputs.fc_lpos, inputs.fc_mpos, inputs.rest_atom, inputs.rest_k)
+
+def barostat_signature(inputs):
+    """ Barostat settings that need a new force when they change (p_freq is changed live) """
+    if inputs.pcouple != 'yes':
+        return None
+    return (inputs.p_type, inputs.p_ref, inputs.p_tens, str(inputs.p_XYMode), str(inputs.p_ZMode), inputs.p_scale, inputs.temp)
+
+def gate_force(force, gate):
+    """ Copy a CustomExternalForce with its energy multiplied by the global parameter gate.
+
+    The force's own global parameters (e.g. the MDAnalysis restraint k) are
+    folded into the expression as constants, so several restraint sets can
+    coexist in one System without clashing global names.
+    """
+    parts = [p for p in force.getEnergyFunction().split(';') if p.strip()]
+    consts = [f"{force.getGlobalParameterName(i)} = {force.getGlobalParameterDefaultValue(i)!r}" for i in range(force.getNumGlobalParameters())]
+    gated = CustomExternalForce('; '.join([f"{gate}*({parts[0]})"] + parts[1:] + consts))
+    gated.addGlobalParameter(gate, 0.0)
+    for i in range(force.getNumPerParticleParameters()):
+        gated.addPerParticleParameter(force.getPerParticleParameterName(i))
+    for i in range(force.getNumParticles()):
+        atom, params = force.getParticleParameters(i)
+        gated.addParticle(atom, params)
+    gated.setForceGroup(force.getForceGroup())
+    gated.setName(f"{force.getName()} ({gate})")
+    return gated
+
+def run_protocol(args_psf, args_pdb, stages=None, args_toppar='toppar/', args_pbc=None, args_platform=None, args_rewrap=False, args_debug=False, args_param_cache=True, args_system_cache=True, args_async_io=False, args_energy_table=None, args_autotune=False, args_metrics=None):
+    """ Run several .inp stages (default min/eq1 -> eq2 -> prod) in one process and one Context.
+
+    The PSF, coordinates, parameters and System are loaded once. Between
+    stages only what differs is changed: restraint sets are switched through
+    global gate parameters, the barostat through its frequency (0 = off),
+    and the integrator's dt/temperature/friction in place. Each stage writes
+    the same {prefix}.log/.dcd/.rst files as a separate openmm-run would.
+    """
+    stages = [(inp, orst) for inp, orst in (stages or PROTOCOL_STAGES) if os.path.exists(inp)]
+    if not stages:
+        log_message("ERROR", "No protocol stage inputs found. Run 'openmm-run --mk-inp' first.")
+        sys.exit(1)
+    all_inputs = [read_inputs(inp) for inp, _ in stages]
+    for inputs in all_inputs:
+        if inputs.eq_adaptive == 'yes' and inputs.eq_max_nstep > 0: inputs.nstep = inputs.eq_max_nstep
+    log_message("INFO", f"Protocol stages: {' -> '.join(inp for inp, _ in stages)}")
+
+    first = all_inputs[0]
+    for (inp, _), inputs in zip(stages[1:], all_inputs[1:]):
+        if system_cache_key(args_psf, args_toppar, inputs) != system_cache_key(args_psf, args_toppar, first):
+            log_message("ERROR", f"{inp}: nonbonded/constraint settings differ from {stages[0][0]}; run these stages separately.")
+            sys.exit(1)
+        if (inputs.integrator, inputs.mts_ratio, inputs.mts_vdw) != (first.integrator, first.mts_ratio, first.mts_vdw):
+            log_message("ERROR", f"{inp}: integrator {inputs.integrator} differs from {first.integrator}; run these stages separately.")
+            sys.exit(1)
+
+    log_message("INFO", f"Loading topology/coords: {args_psf}, {args_pdb}")
+    psf = read_top(args_psf)
+    psf = read_box_from_str(args_pbc or '01build/step3_pbcsetup.str', psf)
+    session = StructureSession(args_psf, args_pdb)
+    crd = read_crd(args_pdb, args_psf, session)
+    system = load_system(psf, args_psf, args_toppar, first, use_cache=args_system_cache, param_cache=args_param_cache)
+
+    # One gated copy of every distinct restraint set used by any stage
+    gates = {}
+    for inputs in all_inputs:
+        signature = restraint_signature(inputs)
+        if signature is None or signature in gates:
+            continue
+        gate = f"mstbx_rest{len(gates)}"
+        scratch = add_restraints(System(), crd, inputs, args_psf, args_pdb, args_debug, session)
+        for force in scratch.getForces():
+            system.addForce(gate_force(force, gate))
+        gates[signature] = gate
+
+    baro_force = None
+    baro_signature = None
+    for inputs in all_inputs:
+        if inputs.pcouple == 'yes':
+            system = barostat(system, inputs)
+            baro_force = system.getForce(system.getNumForces() - 1)
+            baro_force.setFrequency(0)
+            baro_signature = barostat_signature(inputs)
+            break
+
+    integrator = make_integrator(first, system)
+    tuning = autotune(system, integrator, crd.positions, first, args_platform) if args_autotune else None
+    sim = make_simulation(psf.topology, system, integrator, args_platform, tuning)
+    sim.context.setPositions(crd.positions)
+    # One metrics file for the whole protocol; its stage label follows the running stage
+    metrics = metrics_exporter(args_metrics, args_psf, stages[0][1])
+
+    for index, ((inp, orst), inputs) in enumerate(zip(stages, all_inputs)):
+        log_message("INFO", f"=== Stage {index+1}/{len(stages)}: {inp} -> {orst} ===")
+        output_prefix = output_prefix_from(orst)
+
+        active = gates.get(restraint_signature(inputs))
+        for gate in gates.values():
+            sim.context.setParameter(gate, 1.0 if gate == active else 0.0)
+
+        if inputs.pcouple == 'yes' and barostat_signature(inputs) != baro_signature:
+            log_message("INFO", "Barostat settings changed; replacing barostat and reinitializing the Context.")
+            system.removeForce(list(system.getForces()).index(baro_force))
+            system = barostat(system, inputs)
+            baro_force = system.getForce(system.getNumForces() - 1)
+            baro_signature = barostat_signature(inputs)
+            sim.context.reinitialize(preserveState=True)
+        if baro_force is not None:
+            baro_force.setFrequency(inputs.p_freq if inputs.pcouple == 'yes' else 0)
+        log_message("INFO", f"Barostat: {'ON (' + inputs.p_type + ')' if inputs.pcouple == 'yes' else 'OFF'}")
+
+        update_integrator(integrator, inputs)
+        if index > 0:
+            log_message("INFO", f"Time step (dt): {inputs.dt} ps ({int(inputs.dt*1000)} fs)")
+
+        # The step counter carries over between stages, as it does through -irst
+        minimize(sim, inputs)
+        generate_velocities(sim, inputs, restarted=index > 0)
+        xtc_atoms = select_trajectory_atoms(args_psf, args_pdb, inputs, session) if inputs.nstxtc > 0 else None
+        run_dynamics(sim, inputs, output_prefix, xtc_atoms=xtc_atoms, async_io=args_async_io, energy_table=args_energy_table, metrics=metrics)
+
+        if args_rewrap: rewrap(sim)
+        write_restart(sim, output_prefix)
+
+    log_message("INFO", "Done.")
@@ -0,0 +1,222 @@
+"""Native writer for the flagged PDB files read by NAMD.
+
+NAMD positional restraints (``consref``/``conskfile``) and colvars
+``atomsFile`` groups read a per-atom value from the B-factor column of a
+copy of the system PDB. The protocols used to produce those copies with a
+VMD Tcl script, loading the whole PSF/PDB once per call. ``StructureFlags``
+parses the PSF and PDB once with MDAnalysis, evaluates the protocols' VMD
+selections through ``vmd_to_mda`` and writes every output in one pass over
+the original PDB lines, replacing only columns 61-66.
+"""
+
+import re
+
+import numpy as np
+
+try:
+    import MDAnalysis as mda
+    from MDAnalysis.exceptions import NoDataError, SelectionError
+except ImportError:
+    mda = None
+
+# VMD singleword macros, spelled out with VMD's own definitions
+VMD_MACROS = {
+    "all": "all",
+    "protein": "protein",
+    "nucleic": "nucleic",
+    # VMD counts terminal oxygens as protein backbone and includes the nucleic acid backbone
+    "backbone": "((protein and name N CA C O OT1 OT2 OXT O1 O2) or "
+                "(nucleic and name P O1P O2P OP1 OP2 O3' O5' C3' C4' C5'))",
+    "water": "(resname H2O HHO OHH HOH OH2 SOL WAT TIP TIP2 TIP3 TIP4)",
+    "ion": "(resname AL BA CA Ca CAL CD CES CLA CL Cl- Cl CO CS CU Cu CU1 CUA HG IN IOD K K+ MG MN3 MO3 "
+           "MO4 MO5 MO6 NA Na Na+ NAW OC7 PB POT PT RB SOD TB TL WO4 YB ZN ZN1 ZN2)",
+    "hydrogen": "(name H* [0-9]H*)",
+    "noh": "(not name H* [0-9]H*)",
+}
+VMD_MACROS["waters"] = VMD_MACROS["water"]
+VMD_MACROS["ions"] = VMD_MACROS["ion"]
+
+# VMD keywords that take a list of values, with their MDAnalysis spelling
+VMD_KEYWORDS = {
+    "name": "name", "type": "type", "resname": "resname", "segname": "segid", "segid": "segid",
+    "resid": "resid", "index": "index", "serial": "bynum", "residue": "resindex",
+}
+VMD_INTEGER_KEYWORDS = {"resid", "index", "serial", "residue"}
+VMD_OPERATORS = {"and", "or", "not", "(", ")"}
+VMD_COMPARISONS = {"<", "<=", ">", ">=", "=="}
+
+_TOKEN = re.compile(r'\s*(\(|\)|"[^"]*"|<=|>=|==|<|>|[^\s()"<>=]+)')
+_INTEGER = re.compile(r"-?\d+")
+_NUMBER = re.compile(r"-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+_LITERAL = re.compile(r"[\w'+-]+")
+
+
+class UnsupportedSelection(ValueError):
+    """A VMD selection outside the subset ``vmd_to_mda`` translates exactly."""
+
+
+class StructureMismatch(ValueError):
+    """The PSF and PDB do not describe the same atoms."""
+
+
+# Failures for which the protocols fall back to their VMD scripts
+NATIVE_FALLBACK_ERRORS = (ImportError, UnsupportedSelection, StructureMismatch)
+
+
+def _tokens(selection):
+    tokens, position = [], 0
+    selection = selection.strip()
+    while position < len(selection):
+        match = _TOKEN.match(selection, position)
+        if match is None:
+            raise UnsupportedSelection(f"Cannot parse VMD selection: {selection}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def _value(token, keyword, selection):
+    """One keyword value in MDAnalysis syntax."""
+    if token.startswith('"'):
+        text = token[1:-1]
+        # VMD matches anchored regular expressions; only literals and .* / . map onto globs
+        if keyword in VMD_INTEGER_KEYWORDS or re.fullmatch(r"[\w'.*]*", text) is None:
+            raise UnsupportedSelection(f"Unsupported VMD regular expression {token} in: {selection}")
+        return text.replace(".*", "*").replace(".", "?")
+    pattern = _INTEGER if keyword in VMD_INTEGER_KEYWORDS else _LITERAL
+    if pattern.fullmatch(token) is None:
+        raise UnsupportedSelection(f"Unsupported value '{token}' for {keyword} in: {selection}")
+    return token
+
+
+def vmd_to_mda(selection):
+    """Translate the VMD atom selection subset used by the protocols to MDAnalysis.
+
+    Accepted are ``and``/``or``/``not`` and parentheses, the singleword
+    macros in ``VMD_MACROS`` (expanded with VMD's definitions), the keywords
+    in ``VMD_KEYWORDS`` followed by literal values, integer ``N to M`` ranges
+    or double-quoted regular expressions of the simple ``"CAR.*"`` kind, and
+    ``x``/``y``/``z`` compared with a number. Anything else raises
+    ``UnsupportedSelection`` rather than being passed through, since
+    MDAnalysis could read it differently from VMD.
+    """
+    tokens = _tokens(selection)
+    output, i = [], 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in VMD_OPERATORS:
+            output.append(token)
+            i += 1
+        elif token in VMD_MACROS:
+            output.append(VMD_MACROS[token])
+            i += 1
+        elif token in ("x", "y", "z"):
+            if i + 2 >= len(tokens) or tokens[i + 1] not in VMD_COMPARISONS or _NUMBER.fullmatch(tokens[i + 2]) is None:
+                raise UnsupportedSelection(f"Unsupported coordinate comparison in: {selection}")
+            output.append(f"prop {token} {tokens[i + 1]} {tokens[i + 2]}")
+            i += 3
+        elif token in VMD_KEYWORDS:
+            values = []
+            i += 1
+            while i < len(tokens) and tokens[i] not in VMD_OPERATORS and tokens[i] not in VMD_MACROS \
+                    and tokens[i] not in VMD_KEYWORDS and tokens[i] not in ("x", "y", "z"):
+                if tokens[i] == "to":
+                    if token not in VMD_INTEGER_KEYWORDS or not values or i + 1 >= len(tokens) \
+                            or _INTEGER.fullmatch(tokens[i + 1]) is None:
+                        raise UnsupportedSelection(f"Unsupported range in: {selection}")
+                    values[-1] = f"{values[-1]}:{tokens[i + 1]}"
+                    i += 2
+                    continue
+                values.append(_value(tokens[i], token, selection))
+                i += 1
+            if not values:
+                raise UnsupportedSelection(f"'{token}' without values in: {selection}")
+            output.append(f"{VMD_KEYWORDS[token]} {' '.join(values)}")
+        else:
+            raise UnsupportedSelection(f"Unsupported VMD keyword '{token}' in: {selection}")
+    return re.sub(r"\s+\)", ")", re.sub(r"\(\s+", "(", " ".join(output)))
+
+
+def patch_beta(line, value):
+    """Return a PDB ATOM/HETATM line with ``value`` in the B-factor field (columns 61-66)."""
+    body = line.rstrip("\r\n")
+    return f"{body[:60].ljust(60)}{value:6.2f}{body[66:]}\n"
+
+
+class StructureFlags:
+    """A PSF/PDB pair parsed once, answering selections and writing flagged copies.
+
+    Parameters
+    ----------
+    psf : str
+        CHARMM/X-PLOR PSF; atom order must match the PDB.
+    pdb : str
+        Coordinates whose lines are copied into the flagged outputs.
+    """
+
+    def __init__(self, psf, pdb):
+        if mda is None:
+            raise ImportError("MDAnalysis is required for the native PDB flag writer")
+        try:
+            self.universe = mda.Universe(psf, pdb)
+        except ValueError as error:
+            # MDAnalysis refuses coordinates whose atom count differs from the PSF
+            raise StructureMismatch(f"{psf} and {pdb} do not load as one structure: {error}") from error
+        with open(pdb, "r") as handle:
+            self.lines = handle.readlines()
+        self.atom_lines = [i for i, line in enumerate(self.lines) if line.startswith(("ATOM  ", "HETATM"))]
+        if len(self.atom_lines) != self.universe.atoms.n_atoms:
+            raise StructureMismatch(f"{pdb} has {len(self.atom_lines)} atom records but {psf} has {self.universe.atoms.n_atoms} atoms")
+
+    def select(self, selection):
+        """AtomGroup of a VMD selection string."""
+        translated = vmd_to_mda(selection)
+        try:
+            return self.universe.select_atoms(translated)
+        except (SelectionError, NoDataError) as error:
+            raise UnsupportedSelection(f"MDAnalysis rejected '{translated}' (from '{selection}'): {error}") from error
+
+    def mask(self, selection):
+        """Boolean per-atom array of a VMD selection string."""
+        mask = np.zeros(self.universe.atoms.n_atoms, dtype=bool)
+        mask[self.select(selection).indices] = True
+        return mask
+
+    def center(self, selection):
+        """Unweighted centre of a selection in Angstrom, like VMD ``measure center``."""
+        atoms = self.select(selection)
+        if len(atoms) == 0:
+            raise ValueError(f"Selection matched no atoms: {selection}")
+        return atoms.positions.astype(float).mean(axis=0)
+
+    def write(self, outputs):
+        """Write flagged copies of the PDB in a single pass over its lines.
+
+        Parameters
+        ----------
+        outputs : dict
+            ``{path: (selection, value)}``; atoms in the VMD selection get
+            ``value`` in the B-factor column, every other atom ``0.00``.
+            Non-atom records are copied unchanged.
+
+        Returns
+        -------
+        dict
+            Number of flagged atoms per path.
+        """
+        masks = {path: self.mask(selection) for path, (selection, _) in outputs.items()}
+        handles = {path: open(path, "w") for path in outputs}
+        try:
+            atom = 0
+            for number, line in enumerate(self.lines):
+                if atom < len(self.atom_lines) and number == self.atom_lines[atom]:
+                    for path, handle in handles.items():
+                        handle.write(patch_beta(line, outputs[path][1] if masks[path][atom] else 0.0))
+                    atom += 1
+                else:
+                    for handle in handles.values():
+                        handle.write(line)
+        finally:
+            for handle in handles.values():
+                handle.close()
+        return {path: int(mask.sum()) for path, mask in masks.items()}
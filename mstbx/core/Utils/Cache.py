@@ -0,0 +1,103 @@
+"""On-disk cache helpers shared by the OpenMM runner.
+
+Entries are keyed by the content of their inputs, never by path or mtime,
+so one cache directory can safely serve many systems and stages that share
+the same ``toppar/`` files. The location defaults to ``~/.cache/mstbx``
+(honouring ``XDG_CACHE_HOME``) and can be moved with ``MSTBX_CACHE_DIR``.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+
+def cache_dir(kind):
+    """Return (and create) the cache sub-directory for one kind of entry.
+
+    Parameters
+    ----------
+    kind : str
+        Sub-directory name, e.g. ``"params"``.
+    """
+    root = os.environ.get("MSTBX_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.join("~", ".cache"), "mstbx"
+    )
+    path = os.path.join(os.path.expanduser(root), kind)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_digest(path, chunk=1 << 20):
+    """SHA-256 hex digest of one file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(chunk), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_key(paths, *extra):
+    """Stable key for an ordered list of files plus any extra tokens.
+
+    File order is part of the key because later CHARMM files may override
+    parameters read from earlier ones.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        digest.update(file_digest(path).encode())
+    for token in extra:
+        digest.update(repr(token).encode())
+    return digest.hexdigest()
+
+
+def atomic_write(path, data, mode="wb"):
+    """Write ``data`` next to ``path`` and rename it into place.
+
+    Readers (including concurrent runs sharing the cache) see either the old
+    file or the complete new one, never a partial write.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, mode) as handle:
+            handle.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load_pickle(path):
+    """Load a cached pickle, returning ``None`` if it is missing or unreadable."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as handle:
+            return pickle.load(handle)
+    except Exception:
+        return None
+
+
+def dump_pickle(path, obj):
+    """Atomically pickle ``obj`` to ``path``."""
+    atomic_write(path, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_json(path):
+    """Load a cached JSON document, returning ``None`` if it is missing or unreadable."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as handle:
+            return json.load(handle)
+    except Exception:
+        return None
+
+
+def dump_json(path, obj):
+    """Atomically write ``obj`` to ``path`` as indented JSON."""
+    atomic_write(path, json.dumps(obj, indent=2, sort_keys=True), mode="w")
@@ -0,0 +1,287 @@
+"""Long-lived VMD text-mode workers for the Tcl-driven builders.
+
+Every ``vmd -dispdev text -e script.tcl`` pays for VMD start-up and, on the
+first ``package require``, for loading solvate, autoionize and psfgen.
+``VMDPool`` keeps N of those processes alive and feeds them jobs over
+stdin. A job is a Tcl file sourced inside ``catch`` from its own working
+directory; a per-job sentinel line printed afterwards marks completion and
+carries the status. Between jobs the worker deletes all molecules, resets
+psfgen and unsets the globals the job created. A worker whose job failed,
+timed out or died is replaced by a fresh process, so a half-built system
+never leaks into the next job.
+
+``run_tcl`` is the entry point for every VMD job: the builders, the VMD
+fallbacks of the MD protocols, ``resetpsf`` and ``md-translate``. The shared
+pool is sized by ``MSTBX_VMD_WORKERS`` (default 1) and grows when a caller
+such as ``topopsfgen --manifest --jobs N`` runs N jobs at once; ``0`` runs
+every job as a one-shot ``vmd -dispdev text -e`` process as before.
+"""
+
+import atexit
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds to wait for a fresh worker to answer, and for a closing one to exit
+VMD_START_TIMEOUT = 120.0
+VMD_STOP_TIMEOUT = 10.0
+
+# Sent once per worker: a job's trailing ``quit`` ends the job, not VMD
+VMD_PREAMBLE = [
+    "namespace eval ::mstbx {}",
+    "if {[llength [info commands quit]]} { rename quit ::mstbx::quit }",
+    "proc quit {args} { return -code return }",
+]
+
+
+class VMDJobError(RuntimeError):
+    """A Tcl job failed, timed out, or its VMD worker died."""
+
+    def __init__(self, message, output=""):
+        super().__init__(message)
+        self.output = output
+
+
+def tcl_quote(text):
+    """Quote a string (e.g. a path) as one Tcl word."""
+    return '"' + re.sub(r'([\\"$\[\]{}])', r"\\\1", str(text)) + '"'
+
+
+def _write_log(log, lines):
+    if log:
+        with open(log, "w") as handle:
+            handle.writelines(lines)
+
+
+class VMDWorker:
+    """One ``vmd -dispdev text`` process reading Tcl from stdin.
+
+    Parameters
+    ----------
+    vmd : str
+        VMD executable.
+    """
+
+    def __init__(self, vmd="vmd"):
+        self.vmd = vmd
+        self.process = None
+        self.lines = None
+        self.jobs = 0
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [self.vmd, "-dispdev", "text"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, text=True, bufsize=1,
+        )
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read, args=(self.process.stdout, self.lines), daemon=True).start()
+        self.jobs = 0
+        self._exchange(VMD_PREAMBLE, VMD_START_TIMEOUT)
+
+    @staticmethod
+    def _read(stream, lines):
+        for line in stream:
+            lines.put(line)
+        lines.put(None)
+
+    def _exchange(self, commands, timeout, echo=False, status="0"):
+        """Send commands, then a sentinel line carrying ``status``; return (status, output lines)."""
+        sentinel = f"MSTBX-DONE-{uuid.uuid4().hex}"
+        try:
+            for command in commands + [f'puts "{sentinel} {status}"', "flush stdout"]:
+                self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as error:
+            raise VMDJobError(f"VMD worker is not accepting input: {error}")
+        output = []
+        while True:
+            try:
+                line = self.lines.get(timeout=timeout)
+            except queue.Empty:
+                raise VMDJobError(f"VMD job did not finish within {timeout} s", "".join(output))
+            if line is None:
+                raise VMDJobError("VMD worker exited before the job finished", "".join(output))
+            if sentinel in line:
+                return int(line.split(sentinel, 1)[1].split()[0]), output
+            output.append(line)
+            if echo:
+                sys.stdout.write(line)
+
+    def run(self, script, cwd=".", log=None, echo=False, timeout=None):
+        """Source ``script`` with ``cwd`` as working directory and return its output.
+
+        Raises
+        ------
+        VMDJobError
+            The script raised a Tcl error, timed out, or VMD died; the worker
+            must then be recycled.
+        """
+        if not self.alive:
+            self.start()
+        home = os.getcwd()
+        commands = [
+            "set ::mstbx::globals [info globals]",
+            f"set ::mstbx::status [catch {{cd {tcl_quote(os.path.abspath(cwd))}; "
+            f"source {tcl_quote(os.path.abspath(os.path.join(cwd, script)))}}} ::mstbx::result]",
+            'if {$::mstbx::status} { puts "ERROR) $::errorInfo" }',
+            f"cd {tcl_quote(home)}",
+            "catch {mol delete all}",
+            "catch {psfcontext reset}",
+            "foreach ::mstbx::name [info globals] { if {[lsearch -exact $::mstbx::globals $::mstbx::name] < 0} "
+            "{ catch {unset ::$::mstbx::name} } }",
+        ]
+        try:
+            status, output = self._exchange(commands, timeout, echo, status="$::mstbx::status")
+        except VMDJobError as error:
+            _write_log(log, [error.output])
+            raise
+        finally:
+            self.jobs += 1
+        _write_log(log, output)
+        if status != 0:
+            raise VMDJobError(f"Tcl error in {script}", "".join(output))
+        return "".join(output)
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            if self.alive:
+                self.process.stdin.write("::mstbx::quit\n")
+                self.process.stdin.close()
+            self.process.wait(timeout=VMD_STOP_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        finally:
+            self.process = None
+
+
+class VMDPool:
+    """N VMD text-mode workers serving Tcl jobs concurrently.
+
+    Parameters
+    ----------
+    size : int
+        Number of VMD processes; they are started on first use.
+    vmd : str
+        VMD executable.
+    timeout : float, optional
+        Seconds a job may run before its worker is killed.
+    """
+
+    def __init__(self, size=1, vmd="vmd", timeout=None):
+        self.size = max(int(size), 1)
+        self.vmd = vmd
+        self.timeout = timeout
+        self.idle = queue.Queue()
+        for _ in range(self.size):
+            self.idle.put(VMDWorker(vmd))
+        self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="vmd")
+        self.recycled = 0
+        self.lock = threading.Lock()
+
+    def grow(self, size):
+        """Add workers until the pool has at least ``size``; running jobs are not disturbed."""
+        with self.lock:
+            if size <= self.size:
+                return
+            for _ in range(size - self.size):
+                self.idle.put(VMDWorker(self.vmd))
+            previous = self.executor
+            self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="vmd")
+            self.size = size
+        previous.shutdown(wait=False)
+
+    def _run(self, script, cwd, log, echo):
+        worker = self.idle.get()
+        try:
+            return worker.run(script, cwd=cwd, log=log, echo=echo, timeout=self.timeout)
+        except VMDJobError:
+            worker.stop()
+            self.recycled += 1
+            raise
+        finally:
+            self.idle.put(worker)
+
+    def submit(self, script, cwd=".", log=None, echo=False):
+        """Queue ``script`` (relative to ``cwd``) and return a Future of its output."""
+        with self.lock:
+            return self.executor.submit(self._run, script, cwd, log, echo)
+
+    def run(self, script, cwd=".", log=None, echo=False):
+        """Run ``script`` and wait for it."""
+        return self.submit(script, cwd, log, echo).result()
+
+    def close(self):
+        with self.lock:
+            executor = self.executor
+        executor.shutdown(wait=True)
+        while not self.idle.empty():
+            self.idle.get().stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def vmd_pool(size=None):
+    """The process-wide pool, created on first use with ``MSTBX_VMD_WORKERS`` workers.
+
+    ``size`` grows it to at least that many workers, for callers that submit
+    jobs from several threads at once.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = VMDPool(int(os.environ.get("MSTBX_VMD_WORKERS", "1")))
+            atexit.register(_POOL.close)
+        if size is not None:
+            _POOL.grow(size)
+        return _POOL
+
+
+def run_tcl(script, cwd=".", log=None, echo=True):
+    """Run a Tcl script on the shared VMD pool (or one-shot with ``MSTBX_VMD_WORKERS=0``).
+
+    Parameters
+    ----------
+    script : str
+        Tcl file, relative to ``cwd``.
+    cwd : str
+        Working directory of the job.
+    log : str, optional
+        File that receives the job's VMD output, relative to the caller.
+    echo : bool
+        Also print the output as it arrives, like ``| tee``.
+
+    Raises
+    ------
+    VMDJobError
+        The script failed; its output is in ``log`` and ``error.output``.
+    """
+    if os.environ.get("MSTBX_VMD_WORKERS", "1").strip() == "0":
+        result = subprocess.run(["vmd", "-dispdev", "text", "-e", script], cwd=cwd, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        _write_log(log, [result.stdout])
+        if echo:
+            sys.stdout.write(result.stdout)
+        if result.returncode != 0:
+            raise VMDJobError(f"VMD exited with status {result.returncode} on {script}", result.stdout)
+        return result.stdout
+    return vmd_pool().run(script, cwd=cwd, log=log, echo=echo)
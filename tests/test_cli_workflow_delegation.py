@@ -175,17 +175,17 @@ def test_resetpsf_and_md_translate_generate_external_scripts(tmp_path, monkeypat
     import mstbx.commands.resetpsf as reset_command
     import mstbx.commands.md_translate as translate_command
 
-    def fake_vmd(command, **kwargs):
-        if command[0] == "vmd":
+    def fake_vmd(script, **kwargs):
+        if script == "resetpsf_run.tcl":
             Path("reset.psf").write_text("       2 !NATOM\n")
             Path("reset.pdb").write_text("END\n")
-        return object()
+        return ""
 
     monkeypatch.chdir(tmp_path)
-    monkeypatch.setattr(reset_command.subprocess, "run", fake_vmd)
+    monkeypatch.setattr(reset_command, "run_tcl", fake_vmd)
     reset = CliRunner().invoke(cli, ["resetpsf", "--psf", str(psf), "--pdb", str(pdb)])
 
-    monkeypatch.setattr(translate_command.os, "system", lambda command: 0)
+    monkeypatch.setattr(translate_command, "run_tcl", fake_vmd)
     translate = CliRunner().invoke(
         cli,
         ["md-translate", "--psf", str(psf), "--coor", str(coor), "--xsc", str(xsc), "--toppar-dir", str(toppar)],
@@ -205,13 +205,13 @@ def test_resetpsf_fails_on_atom_count_mismatch(tmp_path, monkeypatch):
     psf, pdb = _inputs(tmp_path)
     import mstbx.commands.resetpsf as reset_command
 
-    def fake_vmd(command, **kwargs):
+    def fake_vmd(script, **kwargs):
         Path("reset.psf").write_text("       1 !NATOM\n")  # input had 2
         Path("reset.pdb").write_text("END\n")
-        return object()
+        return ""
 
     monkeypatch.chdir(tmp_path)
-    monkeypatch.setattr(reset_command.subprocess, "run", fake_vmd)
+    monkeypatch.setattr(reset_command, "run_tcl", fake_vmd)
     result = CliRunner().invoke(cli, ["resetpsf", "--psf", str(psf), "--pdb", str(pdb)])
 
     assert result.exit_code != 0
@@ -222,17 +222,18 @@ def test_resetpsf_fails_on_atom_count_mismatch(tmp_path, monkeypatch):
 def test_resetpsf_fails_when_vmd_errors(tmp_path, monkeypatch):
     psf, pdb = _inputs(tmp_path)
     import mstbx.commands.resetpsf as reset_command
-    import subprocess
+    from mstbx.core.Utils.VMDSession import VMDJobError
 
-    def fake_vmd(command, **kwargs):
-        raise subprocess.CalledProcessError(1, command, output="boom")
+    def fake_vmd(script, **kwargs):
+        raise VMDJobError(f"Tcl error in {script}", "boom")
 
     monkeypatch.chdir(tmp_path)
-    monkeypatch.setattr(reset_command.subprocess, "run", fake_vmd)
+    monkeypatch.setattr(reset_command, "run_tcl", fake_vmd)
     result = CliRunner().invoke(cli, ["resetpsf", "--psf", str(psf), "--pdb", str(pdb)])
 
     assert result.exit_code != 0
     assert "Traceback" not in result.output
+    assert (tmp_path / "resetpsf_vmd.log").read_text() == "boom"
 
 
 def test_md_translate_fails_when_vmd_exits_nonzero(tmp_path, monkeypatch):
@@ -244,9 +245,13 @@ def test_md_translate_fails_when_vmd_exits_nonzero(tmp_path, monkeypatch):
     xsc.write_text("cellBasisVector1 1 0 0\n")
     toppar.mkdir()
     import mstbx.commands.md_translate as translate_command
+    from mstbx.core.Utils.VMDSession import VMDJobError
+
+    def fake_vmd(script, **kwargs):
+        raise VMDJobError(f"VMD exited with status 1 on {script}")
 
     monkeypatch.chdir(tmp_path)
-    monkeypatch.setattr(translate_command.os, "system", lambda command: 256)
+    monkeypatch.setattr(translate_command, "run_tcl", fake_vmd)
     result = CliRunner().invoke(
         cli,
         ["md-translate", "--psf", str(psf), "--coor", str(coor), "--xsc", str(xsc), "--toppar-dir", str(toppar)],
@@ -254,6 +259,7 @@ def test_md_translate_fails_when_vmd_exits_nonzero(tmp_path, monkeypatch):
 
     assert result.exit_code != 0
     assert "Traceback" not in result.output
+    assert not (tmp_path / "translate.tcl").exists()
 
 
 def test_smd_and_metad_inputs_reject_non_namd_engine(tmp_path):
@@ -294,12 +300,103 @@ def test_openmm_mk_inp_dispatches_generator(monkeypatch):
     """OpenMM template mode is testable without importing a GPU platform."""
     import mstbx.commands.openmm_run as command
     called = []
-    monkeypatch.setattr(command, "generate_default_inps", lambda: called.append(True))
+    monkeypatch.setattr(command, "generate_default_inps", lambda hmr=False: called.append(hmr))
 
     result = CliRunner().invoke(cli, ["openmm-run", "--mk-inp"])
 
     assert result.exit_code == 0, result.output
-    assert called == [True]
+    assert called == [False]
+
+    result = CliRunner().invoke(cli, ["openmm-run", "--mk-inp", "--hmr"])
+
+    assert result.exit_code == 0, result.output
+    assert called == [False, True]
+
+
+def test_openmm_protocol_dispatches_runner_and_rejects_stage_options(tmp_path, monkeypatch):
+    """--protocol forwards shared inputs and refuses per-stage flags."""
+    import mstbx.commands.openmm_run as command
+    psf, pdb = _inputs(tmp_path)
+    inp = tmp_path / "eq1.inp"
+    inp.write_text("nstep = 10\n")
+    seen = []
+    monkeypatch.setattr(command, "run_protocol", lambda **kwargs: seen.append(kwargs))
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ["openmm-run", "--protocol", "-p", str(psf), "-c", str(pdb), "--platform", "CPU"])
+    assert result.exit_code == 0, result.output
+    assert seen[0]["args_psf"] == str(psf)
+    assert seen[0]["args_platform"] == "CPU"
+
+    for extra in [["-i", str(inp)], ["--ns", "1.0"], ["-orst", "prod"]]:
+        result = runner.invoke(cli, ["openmm-run", "--protocol", "-p", str(psf), "-c", str(pdb), *extra])
+        assert result.exit_code != 0, extra
+        assert "does not accept" in result.output
+    assert len(seen) == 1
+
+
+def test_openmm_replicas_dispatches_ensemble(tmp_path, monkeypatch):
+    """--replicas hands the stage to the ensemble launcher."""
+    import mstbx.commands.openmm_run as command
+    psf, pdb = _inputs(tmp_path)
+    inp = tmp_path / "prod.inp"
+    inp.write_text("nstep = 10\n")
+    seen = []
+    monkeypatch.setattr(command, "run_ensemble", lambda n, **kwargs: seen.append((n, kwargs)))
+    monkeypatch.setattr(command, "run_simulation", lambda **kwargs: seen.append(("single", kwargs)))
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ["openmm-run", "--replicas", "4", "-i", str(inp), "-p", str(psf), "-c", str(pdb), "-orst", "prod",
+                                 "--metrics", "prod.prom"])
+    assert result.exit_code == 0, result.output
+    assert seen[0][0] == 4
+    assert seen[0][1]["args_orst"] == "prod"
+    assert seen[0][1]["args_metrics"] == "prod.prom"
+
+    result = runner.invoke(cli, ["openmm-run", "--replicas", "2", "--autotune", "-i", str(inp), "-p", str(psf), "-c", str(pdb)])
+    assert result.exit_code != 0
+    result = runner.invoke(cli, ["openmm-run", "--protocol", "--replicas", "2", "-p", str(psf), "-c", str(pdb)])
+    assert "does not accept --replicas" in result.output
+    assert len(seen) == 1
+
+
+def test_openmm_profile_forces_is_forwarded_to_the_single_stage_runner(tmp_path, monkeypatch):
+    import mstbx.commands.openmm_run as command
+    psf, pdb = _inputs(tmp_path)
+    inp = tmp_path / "prod.inp"
+    inp.write_text("nstep = 10\n")
+    seen = []
+    monkeypatch.setattr(command, "run_simulation", lambda **kwargs: seen.append(kwargs))
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ["openmm-run", "--profile-forces", "-i", str(inp), "-p", str(psf), "-c", str(pdb)])
+    assert result.exit_code == 0, result.output
+    assert seen[0]["args_profile_forces"] is True
+
+    result = runner.invoke(cli, ["openmm-run", "--profile-forces", "--replicas", "2", "-i", str(inp), "-p", str(psf), "-c", str(pdb)])
+    assert result.exit_code != 0
+    result = runner.invoke(cli, ["openmm-run", "--protocol", "--profile-forces", "-p", str(psf), "-c", str(pdb)])
+    assert "does not accept --profile-forces" in result.output
+    assert len(seen) == 1
+
+
+def test_openmm_max_hours_exits_with_the_walltime_status(tmp_path, monkeypatch):
+    """A walltime stop exits with a distinct status so job chains can resubmit."""
+    import mstbx.commands.openmm_run as command
+    psf, pdb = _inputs(tmp_path)
+    inp = tmp_path / "prod.inp"
+    inp.write_text("nstep = 10\n")
+    seen = []
+    monkeypatch.setattr(command, "run_simulation", lambda **kwargs: seen.append(kwargs) or {"walltime": True})
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ["openmm-run", "--max-hours", "0.5", "-i", str(inp), "-p", str(psf), "-c", str(pdb)])
+    assert result.exit_code == command.WALLTIME_EXIT_CODE
+    assert seen[0]["args_max_hours"] == 0.5
+
+    result = runner.invoke(cli, ["openmm-run", "--protocol", "--max-hours", "1", "-p", str(psf), "-c", str(pdb)])
+    assert "does not accept --max-hours" in result.output
+    assert len(seen) == 1
 
 
 def test_topogmx_forwards_protein_only_and_ligand_combinations(tmp_path, monkeypatch):
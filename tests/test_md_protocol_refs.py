@@ -0,0 +1,165 @@
+"""Native NAMD reference/flag PDB writer used by the MD protocol generators."""
+
+import pytest
+
+pytest.importorskip("MDAnalysis")
+
+from mstbx.core.MDProtocols import MDMembProtocol, MDSolProtocol
+from mstbx.core.MDProtocols.RefWriter import StructureFlags, UnsupportedSelection, vmd_to_mda
+
+ATOMS = [
+    ("PROA", "ALA", "N", "NH1"),
+    ("PROA", "ALA", "CA", "CT1"),
+    ("PROA", "ALA", "HA", "HB1"),
+    ("PROA", "ALA", "C", "C"),
+    ("PROA", "ALA", "OT1", "OC"),
+    ("HETA", "LIG", "C1", "CG331"),
+    ("HETA", "LIG", "H11", "HGA3"),
+    ("CARA", "BGLC", "C1", "CC3162"),
+    ("CARA", "BGLC", "H1", "HCA1"),
+    ("MEMB", "POPC", "P", "PL"),
+    ("MEMB", "POPC", "C2", "CTL1"),
+    ("WAT", "TIP3", "OH2", "OT"),
+    ("IONS", "SOD", "SOD", "SOD"),
+]
+
+
+@pytest.fixture
+def system(tmp_path, monkeypatch):
+    """A one-of-everything PSF/PDB pair: protein, ligand, sugar, lipid, water, ion."""
+    psf = ["PSF", "", "       1 !NTITLE", " REMARKS flags", "", f"{len(ATOMS):8d} !NATOM"]
+    pdb = ["CRYST1   30.000   30.000   30.000  90.00  90.00  90.00 P 1           1"]
+    for index, (segid, resname, name, kind) in enumerate(ATOMS, start=1):
+        psf.append(f"{index:8d} {segid:<4s} 1    {resname:<4s} {name:<4s} {kind:<6s} 0.000000 12.0110 0")
+        pdb.append(f"ATOM  {index:5d} {name:<4s} {resname:<4s}   1    {index:8.3f}{0:8.3f}{-index:8.3f}  1.00  0.00      {segid:<4s}")
+    psf += ["", "       0 !NBOND: bonds", "", "       0 !NTHETA: angles", "", "       0 !NPHI: dihedrals", "",
+            "       0 !NIMPHI: impropers", "", "       0 !NDON: donors", "", "       0 !NACC: acceptors", "",
+            "       0 !NNB", ""]
+    (tmp_path / "system.psf").write_text("\n".join(psf) + "\n")
+    (tmp_path / "system.pdb").write_text("\n".join(pdb + ["END"]) + "\n")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _flagged(path):
+    lines = [line for line in path.read_text().splitlines() if line.startswith("ATOM")]
+    return [i for i, line in enumerate(lines) if float(line[60:66]) > 0]
+
+
+def test_vmd_selections_translate_to_mdanalysis():
+    assert vmd_to_mda('segname "CAR.*" and noh') == "segid CAR* and (not name H* [0-9]H*)"
+    assert vmd_to_mda("resid 3 to 7 and z > 10") == "resid 3:7 and prop z > 10"
+    assert vmd_to_mda("backbone").startswith("((protein and name N CA C O ")
+
+
+@pytest.mark.parametrize("selection", [
+    'name "C[0-9]+"', "within 5 of protein", "sidechain", "chain A", "name H*", "resid A", "x >",
+])
+def test_vmd_selections_outside_the_whitelist_are_rejected(selection):
+    with pytest.raises(UnsupportedSelection):
+        vmd_to_mda(selection)
+
+
+def test_macros_follow_vmd_not_name_lists(system):
+    flags = StructureFlags("system.psf", "system.pdb")
+    # Only protein atoms are backbone, and SOD is an ion
+    assert list(flags.select("backbone").indices) == [0, 1, 3, 4]
+    assert list(flags.select("ions").indices) == [12]
+    assert list(flags.select("waters").indices) == [11]
+
+
+def test_solution_restraint_patches_only_the_beta_column(system, monkeypatch):
+    monkeypatch.setattr(MDSolProtocol, "run_tcl", lambda script, **kwargs: pytest.fail(f"ran {script}"))
+    MDSolProtocol.MDProtocolSol("system.psf", "system.pdb", 310, 1.0).restraint()
+
+    ref = (system / "restraints/prot_posres.ref").read_text().splitlines()
+    source = (system / "system.pdb").read_text().splitlines()
+    assert _flagged(system / "restraints/prot_posres.ref") == [0, 1, 3, 4, 5, 7]
+    assert ref[0] == source[0] and ref[-1] == "END"
+    for written, original in zip(ref[1:-1], source[1:-1]):
+        assert written[:60] + written[66:] == original[:60] + original[66:]
+    assert ref[1][60:66] == "  5.00"
+
+
+def test_membrane_restraint_writes_every_reference_in_one_pass(system, monkeypatch):
+    monkeypatch.setattr(MDMembProtocol, "run_tcl", lambda script, **kwargs: pytest.fail(f"ran {script}"))
+    parses = []
+    init = StructureFlags.__init__
+
+    def counting_init(self, psf, pdb):
+        parses.append(psf)
+        init(self, psf, pdb)
+
+    monkeypatch.setattr(MDMembProtocol.StructureFlags, "__init__", counting_init)
+    MDMembProtocol.MDProtocolMemb("system.psf", "system.pdb", 310, 1.0).restraint()
+
+    assert parses == ["system.psf"]
+    assert _flagged(system / "restraints/meltlipid.ref") == [0, 1, 2, 3, 4, 5, 9, 11, 12]
+    assert _flagged(system / "restraints/protein.ref") == [0, 1, 2, 3, 4, 5]
+    assert _flagged(system / "restraints/backbone.ref") == [0, 1, 3, 4, 5, 7]
+
+
+def test_restraint_falls_back_to_vmd_when_the_structure_does_not_match(system, monkeypatch):
+    (system / "system.pdb").write_text("ATOM      1  N   ALA     1       0.000   0.000   0.000  1.00  0.00      PROA\n")
+    commands = []
+    monkeypatch.setattr(MDSolProtocol, "run_tcl", lambda script, **kwargs: commands.append((script, kwargs)))
+    MDSolProtocol.MDProtocolSol("system.psf", "system.pdb", 310, 1.0).restraint()
+
+    assert commands == [("makerest.tcl", {"log": "rest.log"})]
+    assert 'segname \\"CAR.*\\"' in (system / "makerest.tcl").read_text()
+
+
+def test_restraint_native_writer_bugs_are_not_hidden_behind_vmd(system, monkeypatch):
+    monkeypatch.setattr(MDSolProtocol, "run_tcl", lambda script, **kwargs: pytest.fail(f"ran {script}"))
+    monkeypatch.setattr(StructureFlags, "write", lambda self, outputs: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        MDSolProtocol.MDProtocolSol("system.psf", "system.pdb", 310, 1.0).restraint()
+
+
+def test_smd_colvars_render_the_centres_without_vmd(system, monkeypatch):
+    monkeypatch.setattr(MDSolProtocol, "run_tcl", lambda script, **kwargs: pytest.fail(f"ran {script}"))
+    (system / "04md").mkdir()
+    smd = MDSolProtocol.SMDProtocolSol("system.psf", "system.pdb", 310, 1.0, "segid HETA", "backbone", 20.0)
+    smd.colvars()
+    assert "centers  xcenter" in (system / "04md/smd.in").read_text()
+    smd.makecolvarspdb()
+
+    assert _flagged(system / "04md/PullAtom.pdb") == [5, 6]
+    assert _flagged(system / "04md/AnchorAtom.pdb") == [0, 1, 3, 4]
+    assert (system / "04md/AnchorAtom.pdb").read_text().splitlines()[1][60:66] == "  5.00"
+    config = (system / "04md/smd.in").read_text()
+    assert "centers  -6.500000 " in config and "targetCenters 13.500000 " in config
+    assert "xcenter" not in config and "xtarget" not in config
+
+
+def test_wtmetad_walls_fill_a_custom_config(system, monkeypatch):
+    monkeypatch.setattr(MDSolProtocol, "run_tcl", lambda script, **kwargs: pytest.fail(f"ran {script}"))
+    (system / "04md").mkdir()
+    (system / "custom").mkdir()
+    (system / "custom/colvars.in").write_text("lowerWalls xc\nupperWalls xd\natomsFile colvars_sel1.pdb\n")
+    meta = MDSolProtocol.WTMetaDProtocolSol("system.psf", "system.pdb", 310, 1.0, sel1="name P", sel2="name SOD",
+                                            dunbind=20.0, colvar_input="custom")
+    meta.colvars()
+    meta.makecolvarspdb()
+
+    assert _flagged(system / "04md/colvars_sel1.pdb") == [9]
+    assert _flagged(system / "04md/colvars_sel2.pdb") == [12]
+    distance = 3 * 2 ** 0.5
+    assert (system / "04md/wtmetad.in").read_text() == (
+        f"lowerWalls {0.0:.6f}\nupperWalls {distance + 20.0:.6f}\natomsFile colvars_sel1.pdb\n")
+
+
+def test_colvars_fall_back_to_vmd_only_for_untranslatable_selections(system, monkeypatch):
+    commands = []
+    monkeypatch.setattr(MDSolProtocol, "run_tcl", lambda script, **kwargs: commands.append((script, kwargs)))
+    (system / "04md").mkdir()
+    smd = MDSolProtocol.SMDProtocolSol("system.psf", "system.pdb", 310, 1.0, "same residue as segid HETA", "backbone", 20.0)
+    smd.colvars()
+    smd.makecolvarspdb()
+    assert commands == [("makePDBcolvars.tcl", {"log": "colvars.log"})]
+
+    meta = MDSolProtocol.WTMetaDProtocolSol("system.psf", "system.pdb", 310, 1.0, sel1="name P", sel2="resname NONE",
+                                            dunbind=20.0)
+    meta.colvars()
+    with pytest.raises(ValueError, match="matched no atoms"):
+        meta.makecolvarspdb()
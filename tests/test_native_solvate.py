@@ -0,0 +1,79 @@
+"""NumPy/cKDTree solvation backend used by topopsfgen --solvate-backend native."""
+
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("openmm")
+pytest.importorskip("scipy")
+
+from mstbx.core.Build.NativeSolvate import read_pdb_coordinates, read_psf, solvate, solvation_box
+from mstbx.core.Build.PSFGenSol import BuildSolution
+
+UBIQUITIN = os.path.join(os.path.dirname(__file__), os.pardir, "mstbx", "testing", "ubiquitin")
+PSF = os.path.join(UBIQUITIN, "step1_pdbreader.psf")
+PDB = os.path.join(UBIQUITIN, "step1_pdbreader.pdb")
+
+
+def test_solvation_box_matches_the_tcl_cubic_and_granular_regions():
+    coordinates = np.array([[0.0, 0.0, 0.0], [10.0, 4.0, 2.0]])
+
+    cubic = solvation_box(coordinates, padding=5.0)
+    assert np.allclose(cubic, [[-6.0, -9.0, -10.0], [16.0, 13.0, 12.0]])
+
+    granular = solvation_box(coordinates, padding=5.0, pad_z_pos=30.0)
+    assert np.allclose(granular, [[-5.0, -5.0, -5.0], [15.0, 9.0, 32.0]])
+
+
+def test_native_solvation_writes_a_readable_clash_free_system(tmp_path):
+    result = solvate(PSF, PDB, output=str(tmp_path / "solvated"), padding=8.0)
+
+    flags, _, atoms, sections = read_psf(str(tmp_path / "solvated.psf"))
+    solute, _ = read_pdb_coordinates(PDB)
+    water, _ = read_pdb_coordinates(str(tmp_path / "solvated.pdb"))
+    n_solute = len(solute)
+    assert result["atoms"] == len(atoms) == len(water) == n_solute + 3 * result["waters"]
+    assert np.allclose(water[:n_solute], solute)
+
+    oxygens = water[n_solute::3]
+    lower, upper = result["minmax"]
+    assert np.all(oxygens >= lower - 1e-3) and np.all(oxygens <= upper + 1e-3)
+    gaps = np.linalg.norm(water[n_solute:, None, :] - solute[None, ::7, :], axis=2)
+    assert gaps.min() >= 2.4 - 1e-3
+
+    mda = pytest.importorskip("MDAnalysis")
+    universe = mda.Universe(str(tmp_path / "solvated.psf"), str(tmp_path / "solvated.pdb"))
+    reference = mda.Universe(PSF, PDB)
+    waters = universe.select_atoms("resname TIP3")
+    assert len(waters) == 3 * result["waters"] and set(waters.names) == {"OH2", "H1", "H2"}
+    assert len(universe.bonds) == len(reference.bonds) + 3 * result["waters"]
+    assert len(universe.angles) == len(reference.angles) + result["waters"]
+    assert abs(universe.atoms.charges.sum() - reference.atoms.charges.sum()) < 1e-3
+    assert "EXT" in flags
+    groups = {name: counts[0] for name, _, counts, _ in sections}
+    original = {name: counts[0] for name, _, counts, _ in read_psf(PSF)[3]}
+    assert groups["NGRP"] == original["NGRP"] + result["waters"]
+    nnb = next(values for name, _, _, values in sections if name == "NNB")
+    assert len(nnb) == groups["NNB"] + len(atoms)
+
+
+def test_native_backend_leaves_only_ionization_to_vmd(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    builder = BuildSolution()
+    builder.build(psf=PSF, pdb=PDB, salt=0.15, ofile="system", hmr=0, solvate_backend="native")
+    script = builder.tcl
+
+    assert "package require solvate" not in script and "mol new $psf" not in script
+    assert "package require autoionize" in script
+    vmd = BuildSolution()
+    vmd.build(psf=PSF, pdb=PDB, salt=0.15, ofile="system", hmr=0)
+    assert vmd.tcl.split("\nmol delete all \npackage require autoionize")[1] == \
+        script.split("\nmol delete all \npackage require autoionize")[1]
+    assert builder.native["psf"] == os.path.abspath(PSF)
+
+    builder.solvate_native(str(tmp_path))
+    assert (tmp_path / "solvated.psf").exists() and (tmp_path / "solvated.pdb").exists()
+
+    with pytest.raises(ValueError):
+        BuildSolution().build(psf=PSF, pdb=PDB, salt=0.15, ofile="system", hmr=0, solvate_backend="gromacs")
@@ -0,0 +1,1139 @@
+"""Unit and regression coverage for OpenMM runner helpers.
+
+Simulations here are tiny Reference-platform contexts built in memory; no
+force field, PSF, or GPU platform is required.
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+openmm = pytest.importorskip("openmm")
+from openmm import app, unit
+
+from mstbx.core.MDProtocols import OpenMMRunner
+
+
+def _toy_simulation(positions, residues, box=3.0):
+    """Build a force-free Reference simulation with one chain of residues.
+
+    ``residues`` is a list of (atom count, intra-residue bonds) and
+    consecutive residues are bonded first-atom to last-atom so inter-residue
+    bonds are exercised too.
+    """
+    topology = app.Topology()
+    chain = topology.addChain()
+    element = app.Element.getBySymbol("C")
+    atoms = []
+    previous = None
+    for count, bonded in residues:
+        residue = topology.addResidue("RES", chain)
+        local = [topology.addAtom(f"C{i}", element, residue) for i in range(count)]
+        for i, j in bonded:
+            topology.addBond(local[i], local[j])
+        if previous is not None:
+            topology.addBond(previous, local[0])
+        previous = local[-1]
+        atoms.extend(local)
+    system = openmm.System()
+    for _ in atoms:
+        system.addParticle(12.0)
+    vectors = [openmm.Vec3(box, 0, 0), openmm.Vec3(0, box, 0), openmm.Vec3(0, 0, box)]
+    system.setDefaultPeriodicBoxVectors(*vectors)
+    topology.setPeriodicBoxVectors(vectors)
+    simulation = app.Simulation(
+        topology, system, openmm.VerletIntegrator(0.001),
+        openmm.Platform.getPlatformByName("Reference"),
+    )
+    simulation.context.setPositions(np.asarray(positions) * unit.nanometers)
+    return simulation
+
+
+def _positions(simulation):
+    state = simulation.context.getState(getPositions=True)
+    return state.getPositions(asNumpy=True).value_in_unit(unit.nanometers)
+
+
+def test_rewrap_matches_legacy_on_broken_residues():
+    """Residues split across the box are re-imaged exactly like CHARMM-GUI."""
+    rng = np.random.default_rng(7)
+    residues = [(3, [(0, 1), (1, 2)]) for _ in range(40)]
+    positions = rng.uniform(0.0, 3.0, size=(120, 3))
+    for start in range(0, 120, 3):
+        positions[start + 1] = positions[start] + rng.normal(0.0, 0.05, 3)
+        positions[start + 2] = positions[start + 1] + rng.normal(0.0, 0.05, 3)
+    # Break a few residues across every axis.
+    positions[4, 0] += 3.0
+    positions[11, 1] -= 3.0
+    positions[30:33, 2] += np.array([0.0, 3.0, 3.0])
+
+    legacy = _toy_simulation(positions, residues)
+    vectorized = _toy_simulation(positions, residues)
+    OpenMMRunner.rewrap_legacy(legacy)
+    OpenMMRunner.rewrap(vectorized)
+
+    assert np.allclose(_positions(vectorized), _positions(legacy), atol=1e-6)
+
+
+def test_rewrap_follows_sequential_bond_order():
+    """A move that breaks a later bond is revisited, as in the legacy loop."""
+    positions = np.array([
+        [0.1, 1.5, 1.5], [2.9, 1.5, 1.5], [2.8, 1.5, 1.5],
+        [1.0, 1.0, 1.0], [1.1, 1.0, 1.0],
+    ])
+    residues = [(3, [(0, 1), (1, 2), (0, 2)]), (2, [(0, 1)])]
+
+    legacy = _toy_simulation(positions, residues)
+    vectorized = _toy_simulation(positions, residues)
+    OpenMMRunner.rewrap_legacy(legacy)
+    OpenMMRunner.rewrap(vectorized)
+
+    assert np.allclose(_positions(vectorized), _positions(legacy), atol=1e-6)
+
+
+def test_rewrap_leaves_intact_systems_untouched_and_caches_index():
+    """Whole molecules keep their coordinates and the index is built once."""
+    positions = np.array([[1.0, 1.0, 1.0], [1.1, 1.0, 1.0], [2.0, 2.0, 2.0]])
+    simulation = _toy_simulation(positions, [(2, [(0, 1)]), (1, [])])
+
+    OpenMMRunner.rewrap(simulation)
+    index = simulation.topology._mstbx_rewrap_index
+    OpenMMRunner.rewrap(simulation)
+
+    assert simulation.topology._mstbx_rewrap_index is index
+    assert np.allclose(_positions(simulation), positions)
+
+
+TOY_RTF = """* toy water topology
+36 1
+MASS  1 HT   1.00800 H
+MASS  2 OT  15.99940 O
+RESI TIP3 0.000
+GROUP
+ATOM OH2 OT -0.834
+ATOM H1  HT  0.417
+ATOM H2  HT  0.417
+BOND OH2 H1 OH2 H2 H1 H2
+END
+"""
+
+TOY_PRM = """* toy water parameters
+BONDS
+OT HT 450.0 0.9572
+HT HT   0.0 1.5139
+ANGLES
+HT OT HT 55.0 104.52
+NONBONDED nbxmod 5 atom cdiel fshift vatom vdistance vfswitch -
+cutnb 14.0 ctofnb 12.0 ctonnb 10.0 eps 1.0 e14fac 1.0 wmin 1.5
+HT 0.0 -0.046 0.2245
+OT 0.0 -0.1521 1.7682
+END
+"""
+
+
+@pytest.fixture
+def toppar(tmp_path, monkeypatch):
+    """A two-file toppar directory and an isolated MSTBx cache."""
+    directory = tmp_path / "toppar"
+    directory.mkdir()
+    (directory / "water.rtf").write_text(TOY_RTF)
+    (directory / "water.prm").write_text(TOY_PRM)
+    monkeypatch.setenv("MSTBX_CACHE_DIR", str(tmp_path / "cache"))
+    return directory
+
+
+def _count_parses(monkeypatch):
+    calls = []
+    original = OpenMMRunner.CharmmParameterSet
+
+    def counting(*files):
+        calls.append(files)
+        return original(*files)
+
+    monkeypatch.setattr(OpenMMRunner, "CharmmParameterSet", counting)
+    return calls
+
+
+def test_param_cache_hits_after_first_parse(toppar, monkeypatch, tmp_path):
+    """The second read of an unchanged toppar comes from the pickle."""
+    calls = _count_parses(monkeypatch)
+
+    first = OpenMMRunner.read_params_from_dir(str(toppar))
+    second = OpenMMRunner.read_params_from_dir(str(toppar))
+
+    assert len(calls) == 1
+    assert set(second.atom_types_str) == set(first.atom_types_str) == {"HT", "OT"}
+    assert second.bond_types[("HT", "OT")].k == pytest.approx(450.0)
+    assert len(list((tmp_path / "cache/params").glob("*.pkl"))) == 1
+
+
+def test_param_cache_invalidates_on_content_change(toppar, monkeypatch):
+    """Editing any toppar file forces a fresh parse."""
+    calls = _count_parses(monkeypatch)
+    OpenMMRunner.read_params_from_dir(str(toppar))
+
+    (toppar / "water.prm").write_text(TOY_PRM.replace("450.0", "451.0"))
+    params = OpenMMRunner.read_params_from_dir(str(toppar))
+
+    assert len(calls) == 2
+    assert params.bond_types[("HT", "OT")].k == pytest.approx(451.0)
+
+
+def test_param_cache_can_be_disabled(toppar, monkeypatch, tmp_path):
+    """use_cache=False always parses and never writes cache entries."""
+    calls = _count_parses(monkeypatch)
+    OpenMMRunner.read_params_from_dir(str(toppar), use_cache=False)
+    OpenMMRunner.read_params_from_dir(str(toppar), use_cache=False)
+
+    assert len(calls) == 2
+    assert not (tmp_path / "cache/params").exists() or not list((tmp_path / "cache/params").iterdir())
+
+
+def test_param_cache_is_skipped_when_the_cache_dir_cannot_be_created(toppar, monkeypatch, tmp_path):
+    """An unusable MSTBX_CACHE_DIR (read-only $HOME, typo) costs the cache, not the run."""
+    (tmp_path / "not-a-dir").write_text("")
+    monkeypatch.setenv("MSTBX_CACHE_DIR", str(tmp_path / "not-a-dir"))
+    calls = _count_parses(monkeypatch)
+
+    OpenMMRunner.read_params_from_dir(str(toppar))
+    params = OpenMMRunner.read_params_from_dir(str(toppar))
+
+    assert len(calls) == 2
+    assert params.bond_types[("HT", "OT")].k == pytest.approx(450.0)
+
+
+def test_param_cache_hit_keeps_the_no_urey_bradley_sentinel(toppar):
+    """CharmmPsfFile tests angles without a U-B term by identity against NoUreyBradley."""
+    from openmm.app.internal.charmm.topologyobjects import NoUreyBradley
+
+    OpenMMRunner.read_params_from_dir(str(toppar))
+    cached = OpenMMRunner.read_params_from_dir(str(toppar))
+
+    assert cached.urey_bradley_types[("HT", "OT", "HT")] is NoUreyBradley
+
+
+TOY_PSF = """PSF
+
+       1 !NTITLE
+ REMARKS toy water
+
+       6 !NATOM
+       1 W    1    TIP3 OH2  OT    -0.834000       15.9994           0
+       2 W    1    TIP3 H1   HT     0.417000        1.0080           0
+       3 W    1    TIP3 H2   HT     0.417000        1.0080           0
+       4 W    2    TIP3 OH2  OT    -0.834000       15.9994           0
+       5 W    2    TIP3 H1   HT     0.417000        1.0080           0
+       6 W    2    TIP3 H2   HT     0.417000        1.0080           0
+
+       6 !NBOND: bonds
+       1       2       1       3       2       3       4       5
+       4       6       5       6
+
+       2 !NTHETA: angles
+       2       1       3       5       4       6
+
+       0 !NPHI: dihedrals
+
+       0 !NIMPHI: impropers
+
+       0 !NDON: donors
+
+       0 !NACC: acceptors
+
+       0 !NNB
+
+       0       0       0       0       0       0
+
+       2       0 !NGRP
+       0       0       0       3       0       0
+"""
+
+
+def _toy_psf(tmp_path, box=3.0):
+    path = tmp_path / "toy.psf"
+    if not path.exists():
+        path.write_text(TOY_PSF)
+    psf = app.CharmmPsfFile(str(path))
+    psf.setBox(box * unit.nanometers, box * unit.nanometers, box * unit.nanometers)
+    return psf, str(path)
+
+
+def _toy_inputs():
+    inputs = OpenMMRunner.OpenMMReadInputs()
+    inputs.init_openmm_defaults()
+    return inputs
+
+
+def test_system_cache_round_trips_vfswitch_system(toppar, tmp_path, monkeypatch):
+    """A cached System serializes identically to a freshly built one."""
+    calls = _count_parses(monkeypatch)
+    inputs = _toy_inputs()
+    psf, psf_path = _toy_psf(tmp_path)
+
+    built = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+    psf, _ = _toy_psf(tmp_path)
+    cached = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+
+    assert len(calls) == 1, "a System cache hit must not parse toppar"
+    assert openmm.XmlSerializer.serialize(cached) == openmm.XmlSerializer.serialize(built)
+    assert any(isinstance(f, openmm.CustomNonbondedForce) for f in cached.getForces())
+
+
+def test_system_cache_is_skipped_when_the_cache_dir_cannot_be_created(toppar, tmp_path, monkeypatch):
+    (tmp_path / "not-a-dir").write_text("")
+    monkeypatch.setenv("MSTBX_CACHE_DIR", str(tmp_path / "not-a-dir"))
+    psf, psf_path = _toy_psf(tmp_path)
+
+    system = OpenMMRunner.load_system(psf, psf_path, str(toppar), _toy_inputs())
+
+    assert system.getNumParticles() == 6
+
+
+def test_system_cache_keys_nonbonded_settings_and_refreshes_box(toppar, tmp_path):
+    """Changing r_off rebuilds; a new PSF box is applied on a cache hit."""
+    inputs = _toy_inputs()
+    psf, psf_path = _toy_psf(tmp_path)
+    first_key = OpenMMRunner.system_cache_key(psf_path, str(toppar), inputs)
+    OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+
+    inputs.r_off = 1.1
+    assert OpenMMRunner.system_cache_key(psf_path, str(toppar), inputs) != first_key
+
+    inputs.r_off = 1.2
+    psf, _ = _toy_psf(tmp_path, box=3.5)
+    system = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+    box = system.getDefaultPeriodicBoxVectors()
+    assert box[0][0].value_in_unit(unit.nanometers) == pytest.approx(3.5)
+
+
+def test_hmass_repartitions_hydrogens_and_keys_the_system_cache(toppar, tmp_path):
+    """HMASS moves mass onto hydrogens, conserves the total and rebuilds the System."""
+    inputs = _toy_inputs()
+    # Rigid water is never repartitioned, so rename the residues
+    (tmp_path / "toy.psf").write_text(TOY_PSF.replace("TIP3", "MOL "))
+    psf, psf_path = _toy_psf(tmp_path)
+    plain_key = OpenMMRunner.system_cache_key(psf_path, str(toppar), inputs)
+    plain = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+
+    (tmp_path / "hmr.inp").write_text("hmass = 3.024\n")
+    inputs = OpenMMRunner.read_inputs(str(tmp_path / "hmr.inp"))
+    assert inputs.hmass == pytest.approx(3.024)
+    assert OpenMMRunner.system_cache_key(psf_path, str(toppar), inputs) != plain_key
+    psf, _ = _toy_psf(tmp_path)
+    system = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+
+    masses = [system.getParticleMass(i).value_in_unit(unit.dalton) for i in range(system.getNumParticles())]
+    before = [plain.getParticleMass(i).value_in_unit(unit.dalton) for i in range(plain.getNumParticles())]
+    assert masses[1] == pytest.approx(3.024) and masses[2] == pytest.approx(3.024)
+    assert masses[0] == pytest.approx(15.9994 - 2 * (3.024 - 1.008))
+    assert np.sum(masses) == pytest.approx(np.sum(before))
+
+
+def test_hmr_profile_doubles_dt_and_keeps_simulated_time():
+    content = ("nstep       = 1000000       # steps\n"
+               "dt          = 0.002         # Time-step (ps)\n"
+               "nstout      = 5000\n"
+               "nstdcd      = 5000\n"
+               "nstxtc      = 0\n"
+               "temp        = 310\n")
+    profile = OpenMMRunner.hmr_profile(content)
+
+    values = {}
+    for line in profile.splitlines():
+        key, _, value = line.partition("=")
+        values[key.strip()] = value.split("#")[0].strip()
+    assert values == {"nstep": "500000", "dt": "0.004", "hmass": "3.024", "nstout": "2500",
+                      "nstdcd": "2500", "nstxtc": "0", "temp": "310"}
+    assert "# steps" in profile
+
+
+def test_hmr_inputs_select_langevin_middle(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    OpenMMRunner.generate_default_inps(hmr=True)
+
+    paths = sorted(tmp_path.glob("*/*.inp"))
+    assert paths
+    for path in paths:
+        inputs = OpenMMRunner.read_inputs(str(path))
+        assert (inputs.integrator, inputs.dt, inputs.hmass) == ("LangevinMiddle", 0.004, 3.024), path.name
+    assert "# Integrator (Langevin, LangevinMiddle or MTSLangevin)" in paths[0].read_text()
+
+
+
+def test_ensemble_from_the_default_template_seeds_every_replica(toy_workspace):
+    """The template's gen_seed = -1 must not give a replica OpenMM's "random" seed 0."""
+    OpenMMRunner.generate_default_inps()
+    seed = next(line for line in (toy_workspace / "02eq1/eq1.inp").read_text().splitlines() if line.startswith("gen_seed"))
+    assert OpenMMRunner.read_inputs(str(toy_workspace / "02eq1/eq1.inp")).gen_seed == -1
+    (toy_workspace / "prod.inp").write_text(f"gen_vel = yes\n{seed}\nnstep = 20\nnstout = 10\n")
+
+    first = OpenMMRunner.run_ensemble(2, "toy.psf", "toy.pdb", "prod.inp", args_orst="a/prod", args_platform="Reference")
+    again = OpenMMRunner.run_ensemble(2, "toy.psf", "toy.pdb", "prod.inp", args_orst="b/prod", args_platform="Reference")
+
+    assert sorted((r["replica"], r["seed"]) for r in first) == [(0, 1), (1, 2)]
+    for i in range(2):
+        assert (toy_workspace / f"a/rep{i}/prod.rst").read_text() == (toy_workspace / f"b/rep{i}/prod.rst").read_text()
+
+TOY_PDB = "".join(
+    f"ATOM  {i + 1:5d} {name:<4s} TIP3 {i // 3 + 1:4d}    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00      W\n"
+    for i, (name, (x, y, z)) in enumerate(zip(
+        ["OH2", "H1", "H2"] * 2,
+        [(0, 0, 0), (0.9572, 0, 0), (-0.24, 0.927, 0), (10, 10, 10), (10.9572, 10, 10), (9.76, 10.927, 10)],
+    ))
+) + "END\n"
+
+
+@pytest.fixture
+def toy_workspace(toppar, tmp_path, monkeypatch):
+    """A runnable toy system laid out like an openmm-run project."""
+    (tmp_path / "toy.psf").write_text(TOY_PSF)
+    (tmp_path / "toy.pdb").write_text(TOY_PDB)
+    (tmp_path / "01build").mkdir()
+    (tmp_path / "01build/step3_pbcsetup.str").write_text("SET A = 30.0\nSET B = 30.0\nSET C = 30.0\n")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_gate_force_preserves_energy_and_switches_off():
+    """A gated restraint equals the original at gate=1 and vanishes at 0."""
+    force = openmm.CustomExternalForce("k*periodicdistance(x, y, z, x0, y0, z0)^2")
+    force.addGlobalParameter("k", 2092.0)
+    for name in ["x0", "y0", "z0"]:
+        force.addPerParticleParameter(name)
+    force.addParticle(0, [0.0, 0.0, 0.0])
+
+    def energy(f, gate=None):
+        system = openmm.System()
+        system.addParticle(1.0)
+        system.addForce(f)
+        context = openmm.Context(system, openmm.VerletIntegrator(0.001), openmm.Platform.getPlatformByName("Reference"))
+        context.setPositions([openmm.Vec3(0.1, 0.0, 0.0)])
+        if gate is not None:
+            context.setParameter("gate", gate)
+        return context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+
+    gated_on = OpenMMRunner.gate_force(force, "gate")
+    gated_off = OpenMMRunner.gate_force(force, "gate")
+    reference = energy(force)
+    assert energy(gated_on, 1.0) == pytest.approx(reference)
+    assert energy(gated_off, 0.0) == 0.0
+
+
+def test_protocol_runs_all_stages_in_one_context(toy_workspace, monkeypatch):
+    """Each stage writes and closes its own outputs; steps carry over as through -irst."""
+    stage = "nstep = 20\nnstout = 10\nnstdcd = 10\n"
+    for folder, name, extra in [
+        ("02eq1", "eq1", "mini_nstep = 10\ngen_vel = yes\ngen_seed = 5\nrest = yes\nrest_atom = 'name OH2'\nrest_k = 2092.0\n"),
+        ("03eq2", "eq2", "pcouple = yes\nrest = yes\nrest_atom = 'name OH2'\nrest_k = 2092.0\n"),
+        ("04prod", "prod", "pcouple = yes\np_freq = 100\ndt = 0.001\n"),
+    ]:
+        (toy_workspace / folder).mkdir()
+        (toy_workspace / folder / f"{name}.inp").write_text(stage + extra)
+
+    closed = []
+    close = OpenMMRunner.close_reporter
+    monkeypatch.setattr(OpenMMRunner, "close_reporter", lambda reporter: (close(reporter), closed.append(reporter)))
+    OpenMMRunner.run_protocol("toy.psf", "toy.pdb", args_platform="Reference", args_async_io=True)
+
+    assert len(closed) == 3
+    assert all(getattr(reporter, "reporter", reporter)._out.closed for reporter in closed)
+    for prefix, steps in [("02eq1/eq1", ["10", "20"]), ("03eq2/eq2", ["30", "40"]), ("04prod/prod", ["50", "60"])]:
+        assert (toy_workspace / f"{prefix}.rst").exists()
+        assert (toy_workspace / f"{prefix}.dcd").stat().st_size > 0
+        rows = [line.split("\t") for line in (toy_workspace / f"{prefix}.log").read_text().splitlines()[1:]]
+        assert [row[1] for row in rows] == steps
+    prod_times = [float(line.split("\t")[2]) for line in (toy_workspace / "04prod/prod.log").read_text().splitlines()[1:]]
+    assert prod_times == pytest.approx([0.09, 0.10])
+
+
+def _dcd_frames(path):
+    import struct
+    with open(path, "rb") as handle:
+        handle.seek(8)
+        return struct.unpack("<i", handle.read(4))[0]
+
+
+def test_resume_continues_from_checkpoint_and_trims_outputs(toy_workspace):
+    """A killed run resumes at its checkpoint step and appends cleanly."""
+    (toy_workspace / "prod.inp").write_text(
+        "gen_vel = yes\ngen_seed = 11\nnstep = 30\nnstout = 10\nnstdcd = 10\nnstchk = 20\n"
+    )
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="run/prod", args_platform="Reference")
+    # Simulate a crash after step 30: the final restart was never written.
+    (toy_workspace / "run/prod.rst").unlink()
+    assert _dcd_frames(toy_workspace / "run/prod.dcd") == 3
+
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="run/prod",
+                                args_platform="Reference", args_resume=True)
+
+    rows = [line.split("\t") for line in (toy_workspace / "run/prod.log").read_text().splitlines()]
+    assert rows[0][0].startswith("#")
+    assert [row[1] for row in rows[1:]] == ["10", "20", "30"]
+    assert float(rows[-1][2]) == pytest.approx(0.06)
+    assert _dcd_frames(toy_workspace / "run/prod.dcd") == 3
+    assert (toy_workspace / "run/prod.rst").exists()
+
+
+def test_resume_after_irst_counts_steps_from_the_restart(toy_workspace):
+    """A resumed continuation stage still ends at its restart step + nstep."""
+    (toy_workspace / "eq.inp").write_text("gen_vel = yes\ngen_seed = 3\nnstep = 20\nnstout = 10\n")
+    (toy_workspace / "prod.inp").write_text("nstep = 30\nnstout = 10\nnstdcd = 10\nnstchk = 20\n")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "eq.inp", args_orst="eq", args_platform="Reference")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_irst="eq.rst", args_orst="prod", args_platform="Reference")
+    (toy_workspace / "prod.rst").unlink()
+
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_irst="eq.rst", args_orst="prod",
+                                args_platform="Reference", args_resume=True)
+
+    steps = [line.split("\t")[1] for line in (toy_workspace / "prod.log").read_text().splitlines()[1:]]
+    assert steps == ["30", "40", "50"]
+    assert _dcd_frames(toy_workspace / "prod.dcd") == 3
+
+
+def test_resume_skips_completed_stage_and_trims_dcd(toy_workspace, tmp_path):
+    """A finished stage is not rerun, and DCD trimming keeps whole frames."""
+    (toy_workspace / "prod.inp").write_text("nstep = 20\nnstout = 10\nnstdcd = 5\nnstchk = 10\n")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="prod", args_platform="Reference")
+    log = (toy_workspace / "prod.log").read_text()
+
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="prod",
+                                args_platform="Reference", args_resume=True)
+    assert (toy_workspace / "prod.log").read_text() == log
+
+    assert OpenMMRunner.truncate_dcd(str(toy_workspace / "prod.dcd"), 2) == 2
+    assert _dcd_frames(toy_workspace / "prod.dcd") == 2
+    import MDAnalysis as mda
+    assert len(mda.Universe("toy.psf", "prod.dcd").trajectory) == 2
+
+
+def test_npz_restart_round_trips_state_exactly(tmp_path):
+    """The binary restart keeps positions, velocities, box, time and step in float64."""
+    sim = _toy_simulation([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]], [(1, []), (1, [])])
+    sim.context.setVelocities(np.array([[0.123456789012, -1.0, 2.0], [3.0, 4.0, -5.0]]) * unit.nanometers / unit.picosecond)
+    sim.context.setTime(12.5)
+    sim.context.setStepCount(6250)
+    state = sim.context.getState(getPositions=True, getVelocities=True)
+
+    for name, compress in [("plain.npz", False), ("small.npz", True)]:
+        OpenMMRunner.write_restart_file(state, str(tmp_path / name), compress=compress)
+        restart = OpenMMRunner.read_restart(str(tmp_path / name))
+        assert restart.positions.dtype == np.float64
+        assert np.array_equal(restart.positions, state.getPositions(asNumpy=True).value_in_unit(unit.nanometers))
+        assert np.array_equal(restart.velocities, state.getVelocities(asNumpy=True).value_in_unit(unit.nanometers / unit.picosecond))
+        assert np.array_equal(restart.box, state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(unit.nanometers))
+        assert (restart.time, restart.step) == (12.5, 6250)
+
+
+def test_convert_restart_between_xml_and_npz(tmp_path):
+    sim = _toy_simulation([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]], [(1, []), (1, [])], box=2.5)
+    sim.context.setVelocities(np.array([[0.1, 0.2, 0.3], [-0.3, -0.2, -0.1]]) * unit.nanometers / unit.picosecond)
+    sim.context.setStepCount(40)
+    OpenMMRunner.write_restart(sim, str(tmp_path / "out"))
+
+    OpenMMRunner.convert_restart(str(tmp_path / "out.rst"), str(tmp_path / "out.npz"))
+    OpenMMRunner.convert_restart(str(tmp_path / "out.npz"), str(tmp_path / "back.rst"))
+
+    original = OpenMMRunner.read_restart(str(tmp_path / "out.rst"))
+    back = OpenMMRunner.read_restart(str(tmp_path / "back.rst"))
+    assert back.getStepCount() == 40
+    assert np.array_equal(back.getPositions(asNumpy=True)._value, original.getPositions(asNumpy=True)._value)
+    assert np.array_equal(back.getVelocities(asNumpy=True)._value, original.getVelocities(asNumpy=True)._value)
+    assert np.allclose(back.getPeriodicBoxVectors(asNumpy=True)._value, np.eye(3) * 2.5)
+
+
+def test_run_simulation_writes_and_continues_from_npz_restart(toy_workspace):
+    (toy_workspace / "eq.inp").write_text("gen_vel = yes\ngen_seed = 3\nnstep = 20\nnstout = 10\n")
+    (toy_workspace / "prod.inp").write_text("nstep = 20\nnstout = 10\n")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "eq.inp", args_orst="eq.npz", args_platform="Reference")
+    assert (toy_workspace / "eq.npz").exists() and not (toy_workspace / "eq.rst").exists()
+
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_irst="eq.npz", args_orst="prod.npz",
+                                args_platform="Reference", args_rst_compress=True)
+
+    restart = OpenMMRunner.read_restart(str(toy_workspace / "prod.npz"))
+    assert restart.step == 40
+    steps = [line.split("\t")[1] for line in (toy_workspace / "prod.log").read_text().splitlines()[1:]]
+    assert steps == ["30", "40"]
+
+
+def test_subset_xtc_replaces_dcd_and_survives_resume(toy_workspace):
+    """NSTXTC writes only the XTC_SEL atoms and is trimmed like the DCD on --resume."""
+    from mdtraj.formats import XTCTrajectoryFile
+
+    (toy_workspace / "prod.inp").write_text(
+        "gen_vel = yes\ngen_seed = 5\nnstep = 30\nnstout = 10\nnstchk = 20\n"
+        "nstxtc = 10\nxtc_sel = \"resid 2\"\n"
+    )
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="prod", args_platform="Reference")
+    assert not (toy_workspace / "prod.dcd").exists()
+    with XTCTrajectoryFile(str(toy_workspace / "prod.xtc")) as handle:
+        xyz, _, steps, _ = handle.read()
+    assert xyz.shape == (3, 3, 3)
+    assert list(steps) == [10, 20, 30]
+
+    (toy_workspace / "prod.rst").unlink()
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="prod",
+                                args_platform="Reference", args_resume=True)
+    with XTCTrajectoryFile(str(toy_workspace / "prod.xtc")) as handle:
+        xyz, _, steps, _ = handle.read()
+    assert list(steps) == [10, 20, 30]
+
+
+def test_xtc_inputs_default_to_solute_selection(tmp_path):
+    path = tmp_path / "run.inp"
+    path.write_text("nstxtc = 500\nxtc_fmt = hdf5\n")
+    inputs = OpenMMRunner.read_inputs(str(path))
+    assert (inputs.nstxtc, inputs.xtc_fmt) == (500, "h5")
+    assert inputs.xtc_sel == OpenMMRunner.DEFAULT_XTC_SEL
+
+
+def test_async_io_writes_the_same_outputs_as_sync(toy_workspace, monkeypatch):
+    """Background writing changes when bytes hit disk, not which bytes."""
+    make_integrator = OpenMMRunner.make_integrator
+
+    def seeded(inputs, system=None):
+        integrator = make_integrator(inputs, system)
+        integrator.setRandomNumberSeed(1234)
+        return integrator
+
+    monkeypatch.setattr(OpenMMRunner, "make_integrator", seeded)
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 9\nnstep = 40\nnstout = 5\nnstdcd = 5\nnstchk = 20\n")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="sync/prod", args_platform="Reference")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="async/prod", args_platform="Reference",
+                                args_async_io=True)
+
+    def columns(path):
+        # Drop wall-clock columns (speed, remaining time)
+        return [line.split("\t")[:8] for line in path.read_text().splitlines()]
+
+    assert columns(toy_workspace / "async/prod.log") == columns(toy_workspace / "sync/prod.log")
+    assert (toy_workspace / "async/prod.dcd").read_bytes() == (toy_workspace / "sync/prod.dcd").read_bytes()
+    assert (toy_workspace / "async/prod.chk").exists()
+
+
+def test_async_writer_reraises_reporter_errors_and_drains_in_order():
+    seen = []
+
+    class Recorder:
+        def report(self, simulation, state):
+            if simulation.currentStep == 3:
+                raise IOError("disk full")
+            seen.append(simulation.currentStep)
+
+    class FakeSimulation:
+        currentStep = 0
+
+    writer = OpenMMRunner.AsyncWriter(maxsize=2)
+    reporter = writer.wrap(Recorder())
+    sim = FakeSimulation()
+    for step in (1, 2):
+        sim.currentStep = step
+        reporter.report(sim, None)
+    writer.drain()
+    assert seen == [1, 2]
+
+    sim.currentStep = 3
+    reporter.report(sim, None)
+    with pytest.raises(IOError, match="disk full"):
+        writer.close()
+
+
+def test_fan_out_reporter_writes_one_row_to_every_sink(tmp_path):
+    import io
+
+    sim = _toy_simulation([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]], [(1, []), (1, [])])
+    terminal = io.StringIO()
+    table = OpenMMRunner.EnergyTable(str(tmp_path / "run_energy.csv"))
+    reporter = OpenMMRunner.FanOutStateReporter(
+        [(terminal, False), (str(tmp_path / "run.log"), False)], 5, table=table,
+        step=True, time=True, potentialEnergy=True, temperature=True, speed=True, separator="\t",
+    )
+    sim.reporters.append(reporter)
+    sim.step(10)
+    reporter.close()
+
+    assert terminal.getvalue() == (tmp_path / "run.log").read_text()
+    assert terminal.getvalue().splitlines()[0].startswith('#"Step"')
+    csv_rows = (tmp_path / "run_energy.csv").read_text().splitlines()
+    assert csv_rows[0] == '"Step","Time (ps)","Potential Energy (kJ/mole)","Temperature (K)"'
+    assert [row.split(",")[0] for row in csv_rows[1:]] == ["5", "10"]
+
+
+def test_energy_table_is_trimmed_and_appended_on_resume(toy_workspace):
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 4\nnstep = 30\nnstout = 10\nnstchk = 20\n")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="prod", args_platform="Reference",
+                                args_energy_table="csv")
+    (toy_workspace / "prod.rst").unlink()
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="prod", args_platform="Reference",
+                                args_energy_table="csv", args_resume=True)
+
+    rows = (toy_workspace / "prod_energy.csv").read_text().splitlines()
+    assert rows[0].startswith('"Step"')
+    assert [row.split(",")[0] for row in rows[1:]] == ["10", "20", "30"]
+
+
+def test_energy_table_parquet(tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    sim = _toy_simulation([[0.1, 0.2, 0.3]], [(1, [])])
+    table = OpenMMRunner.EnergyTable(str(tmp_path / "run_energy.parquet"))
+    reporter = OpenMMRunner.FanOutStateReporter([], 2, table=table, step=True, potentialEnergy=True)
+    sim.reporters.append(reporter)
+    sim.step(6)
+    reporter.close()
+    assert pyarrow.parquet.read_table(str(tmp_path / "run_energy.parquet")).column("Step").to_pylist() == [2, 4, 6]
+
+
+def _lj_cluster(positions):
+    system = openmm.System()
+    force = openmm.NonbondedForce()
+    for _ in positions:
+        system.addParticle(39.9)
+        force.addParticle(0.0, 0.34, 0.99)
+    system.addForce(force)
+    context = openmm.Context(system, openmm.VerletIntegrator(0.001), openmm.Platform.getPlatformByName("Reference"))
+    context.setPositions(np.asarray(positions) * unit.nanometers)
+    return context
+
+
+def _energy(context):
+    return context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+
+
+def test_steepest_descent_relieves_a_clash():
+    context = _lj_cluster([[0, 0, 0], [0.1, 0, 0], [0.5, 0.2, 0]])
+    before = _energy(context)
+    energy, accepted = OpenMMRunner.steepest_descent(context, 200, max_step=0.01)
+    assert accepted > 0
+    assert energy < before
+    assert energy == pytest.approx(_energy(context))
+
+
+def test_convergence_reporter_stops_lbfgs_at_thresholds():
+    grid = np.stack(np.meshgrid(*[np.arange(3)] * 3, indexing="ij"), -1).reshape(-1, 3) * 0.42
+    context = _lj_cluster(grid + np.random.default_rng(1).normal(0, 0.02, grid.shape))
+    loose = OpenMMRunner.ConvergenceReporter(de=1.0, fmax=50.0, nprint=0)
+    openmm.LocalEnergyMinimizer.minimize(context, 1e-6, 5000, loose)
+    assert loose.converged
+    assert loose.iterations < 5000
+
+    tight = OpenMMRunner.ConvergenceReporter(nprint=0)
+    openmm.LocalEnergyMinimizer.minimize(context, 1e-6, 50, tight)
+    assert not tight.converged
+
+
+def test_autotune_helpers():
+    assert OpenMMRunner.thread_candidates(6) == [1, 2, 4, 6]
+    assert OpenMMRunner.thread_candidates(1) == [1]
+    assert [OpenMMRunner.smooth_size(n) for n in (1, 25, 45, 50, 100)] == [1, 27, 48, 54, 108]
+
+
+def test_autotune_picks_fastest_cpu_setting_and_caches_it(toppar, tmp_path, monkeypatch):
+    inputs = _toy_inputs()
+    psf, psf_path = _toy_psf(tmp_path)
+    system = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+    integrator = OpenMMRunner.make_integrator(inputs)
+    # The second water overlaps the first: the timings must start from relaxed positions
+    positions = np.array([[0, 0, 0], [0.09572, 0, 0], [-0.024, 0.0927, 0],
+                          [0, 0, 0.2], [0.09572, 0, 0.2], [-0.024, 0.0927, 0.2]]) * unit.nanometers
+    monkeypatch.setattr(OpenMMRunner, "available_cpus", lambda: 4)
+    timed = []
+
+    def fake_rate(system, integrator, positions, tuning, steps=50):
+        oxygens = positions.value_in_unit(unit.nanometers)[[0, 3]]
+        assert np.linalg.norm(oxygens[0] - oxygens[1]) > 0.25
+        timed.append(dict(tuning))
+        return 100.0 * tuning["Threads"] + (5.0 if tuning["pme"] == "smooth" else 0.0) - (350.0 if tuning["Threads"] == 4 else 0.0)
+
+    monkeypatch.setattr(OpenMMRunner, "time_candidate", fake_rate)
+    best = OpenMMRunner.autotune(system, integrator, positions, inputs, "CPU")
+    assert (best["Threads"], best["pme"]) == (2, "smooth")
+    assert len(timed) == 6
+
+    cached = OpenMMRunner.autotune(system, integrator, positions, inputs, "CPU")
+    assert len(timed) == 6, "a cache hit must not benchmark again"
+    assert (cached["Threads"], cached["pme"]) == (2, "smooth")
+
+    assert OpenMMRunner.autotune(system, integrator, positions, inputs, "Reference") is None
+
+    (tmp_path / "not-a-dir").write_text("")
+    monkeypatch.setenv("MSTBX_CACHE_DIR", str(tmp_path / "not-a-dir"))
+    uncached = OpenMMRunner.autotune(system, integrator, positions, inputs, "CPU")
+    assert len(timed) == 12, "without a usable cache directory autotune benchmarks again"
+    assert (uncached["Threads"], uncached["pme"]) == (2, "smooth")
+
+
+def test_smooth_pme_grid_keeps_alpha_and_rounds_up(toppar, tmp_path):
+    inputs = _toy_inputs()
+    psf, psf_path = _toy_psf(tmp_path)
+    system = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+    alpha, nx, ny, nz = OpenMMRunner.default_pme_parameters(system)
+    OpenMMRunner.apply_pme_grid(system, "smooth")
+    tuned_alpha, *grid = OpenMMRunner.pme_force(system).getPMEParameters()
+    assert tuned_alpha.value_in_unit(unit.nanometer**-1) == pytest.approx(alpha)
+    assert grid == [OpenMMRunner.smooth_size(n) for n in (nx, ny, nz)]
+    assert all(g >= n for g, n in zip(grid, (nx, ny, nz)))
+
+
+def test_mts_puts_pme_reciprocal_space_in_the_slow_group(toppar, tmp_path):
+    (tmp_path / "mts.inp").write_text("integrator = MTSLangevin\nmts_ratio = 4\nmts_vdw = yes\ndt = 0.004\n")
+    inputs = OpenMMRunner.read_inputs(str(tmp_path / "mts.inp"))
+    assert (inputs.integrator, inputs.mts_ratio, inputs.mts_vdw) == ("MTSLangevin", 4, "yes")
+    psf, psf_path = _toy_psf(tmp_path)
+    system = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+
+    integrator = OpenMMRunner.make_integrator(inputs, system)
+
+    assert isinstance(integrator, openmm.MTSLangevinIntegrator)
+    assert integrator.getStepSize().value_in_unit(unit.picoseconds) == pytest.approx(0.004)
+    groups = {type(f).__name__: f.getForceGroup() for f in system.getForces()}
+    assert groups["CustomNonbondedForce"] == OpenMMRunner.MTS_SLOW_GROUP
+    assert groups["HarmonicBondForce"] == groups["NonbondedForce"] == OpenMMRunner.MTS_FAST_GROUP
+    nonbonded = [f for f in system.getForces() if isinstance(f, openmm.NonbondedForce)][0]
+    assert nonbonded.getReciprocalSpaceForceGroup() == OpenMMRunner.MTS_SLOW_GROUP
+
+    context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName("Reference"))
+    context.setPositions(np.array([[0, 0, 0], [0.09572, 0, 0], [-0.024, 0.0927, 0],
+                                   [1, 1, 1], [1.09572, 1, 1], [0.976, 1.0927, 1]]) * unit.nanometers)
+    integrator.step(5)
+    assert np.isfinite(context.getState(getEnergy=True).getPotentialEnergy()._value)
+
+
+def test_update_integrator_matches_a_fresh_mts_integrator(toppar, tmp_path):
+    """Protocol stages change dt/temperature/friction in place."""
+    inputs = _toy_inputs()
+    inputs.integrator = "MTSLangevin"
+    psf, psf_path = _toy_psf(tmp_path)
+    system = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+    integrator = OpenMMRunner.make_integrator(inputs, system)
+
+    inputs.dt, inputs.temp, inputs.fric_coeff = 0.004, 350.0, 5.0
+    OpenMMRunner.update_integrator(integrator, inputs)
+    fresh = OpenMMRunner.make_integrator(inputs, system)
+
+    assert integrator.getStepSize() == fresh.getStepSize()
+    for name in ("a", "b", "kT"):
+        assert integrator.getGlobalVariableByName(name) == pytest.approx(fresh.getGlobalVariableByName(name))
+
+
+def test_profile_groups_split_every_force_and_pme_reciprocal_space(toppar, tmp_path):
+    inputs = _toy_inputs()
+    psf, psf_path = _toy_psf(tmp_path)
+    system = OpenMMRunner.load_system(psf, psf_path, str(toppar), inputs)
+
+    labels = OpenMMRunner.profile_groups(system)
+
+    assert len(labels) == system.getNumForces() + 1
+    assert "vfswitch (CustomNonbondedForce)" in labels.values()
+    assert "vfswitch14 (CustomBondForce)" in labels.values()
+    nonbonded = [f for f in system.getForces() if isinstance(f, openmm.NonbondedForce)][0]
+    assert labels[nonbonded.getForceGroup()] == "NonbondedForce direct"
+    assert labels[nonbonded.getReciprocalSpaceForceGroup()] == "NonbondedForce reciprocal"
+
+
+def test_profile_forces_writes_a_table_instead_of_running_the_stage(toy_workspace):
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 3\nnstep = 20\nnstout = 10\nnstdcd = 10\n")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="prof/prod", args_platform="Reference",
+                                args_profile_forces=True)
+
+    lines = (toy_workspace / "prof/prod_forces.csv").read_text().splitlines()
+    assert lines[0] == ",".join(OpenMMRunner.PROFILE_COLUMNS)
+    rows = [line.split(",") for line in lines[1:]]
+    assert len(rows) == len({row[0] for row in rows}) > 5
+    assert sum(float(row[3]) for row in rows) == pytest.approx(100.0, abs=0.1)
+    assert not (toy_workspace / "prof/prod.rst").exists()
+    assert not (toy_workspace / "prof/prod.dcd").exists()
+
+
+def test_metrics_exporter_writes_prometheus_textfile_without_extra_get_state(toy_workspace, monkeypatch):
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 3\nnstep = 40\nnstout = 10\nnstchk = 20\n")
+    calls = []
+    get_state = openmm.Context.getState
+    monkeypatch.setattr(openmm.Context, "getState", lambda self, *a, **k: calls.append(1) or get_state(self, *a, **k))
+
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="plain/prod", args_platform="Reference")
+    plain = len(calls)
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="watched/prod", args_platform="Reference",
+                                args_metrics="metrics/prod.prom")
+
+    assert len(calls) == 2 * plain
+    text = (toy_workspace / "metrics/prod.prom").read_text()
+    labels = f'{{system="{toy_workspace.name}",stage="prod"}}'
+    assert f"mstbx_openmm_steps{labels} 40" in text
+    assert f"mstbx_openmm_target_steps{labels} 40" in text
+    assert f"mstbx_openmm_eta_seconds{labels} 0.0" in text
+    for name in ("ns_per_day", "potential_energy_kj_mol", "temperature_kelvin", "volume_nm3", "peak_rss_bytes", "checkpoint_age_seconds"):
+        assert f"# TYPE mstbx_openmm_{name} gauge" in text
+
+
+def test_metrics_exporter_json_and_replica_label(tmp_path):
+    exporter = OpenMMRunner.metrics_exporter(str(tmp_path / "m.json"), str(tmp_path / "sys/step5.psf"), "04prod/rep2/prod")
+    exporter.begin("prod", 300)
+    exporter.update({"Step": 100, "Time (ps)": 0.2, "Potential Energy (kJ/mole)": -5.0, "Temperature (K)": 300.0})
+    exporter._start = (exporter._start[0] - 10.0, 0, 0.0)
+    exporter.update({"Step": 200, "Time (ps)": 0.4, "Potential Energy (kJ/mole)": -6.0, "Temperature (K)": 301.0})
+
+    document = json.loads((tmp_path / "m.json").read_text())
+    assert document["labels"] == {"system": "sys", "stage": "prod", "replica": "2"}
+    metrics = document["metrics"]
+    assert metrics["mstbx_openmm_steps"] == 200
+    assert metrics["mstbx_openmm_eta_seconds"] == pytest.approx(5.0, rel=0.05)
+    assert metrics["mstbx_openmm_ns_per_day"] == pytest.approx(0.4e-3 * 86400 / 10.0, rel=0.05)
+    assert "mstbx_openmm_volume_nm3" not in metrics
+
+
+def test_walltime_deadline_honours_slurm_end_time(monkeypatch):
+    monkeypatch.delenv("SLURM_JOB_END_TIME", raising=False)
+    assert OpenMMRunner.walltime_deadline() is None
+    assert OpenMMRunner.walltime_deadline(2.0, start=1000.0) == 1000.0 + 7200.0
+    monkeypatch.setenv("SLURM_JOB_END_TIME", "5000")
+    assert OpenMMRunner.walltime_deadline(2.0, start=1000.0) == 5000.0
+    assert OpenMMRunner.walltime_deadline(0.5, start=1000.0) == 1000.0 + 1800.0
+    monkeypatch.setenv("SLURM_JOB_END_TIME", "Unlimited")
+    assert OpenMMRunner.walltime_deadline() is None
+
+
+def test_step_until_sizes_chunks_from_throughput(monkeypatch):
+    """At 100 steps/s with 5 s to spare, stepping stops after 500 steps."""
+    clock = [1000.0]
+    monkeypatch.setattr(OpenMMRunner.time, "time", lambda: clock[0])
+
+    class FakeSimulation:
+        currentStep = 0
+        chunks = []
+
+        def step(self, n):
+            self.chunks.append(n)
+            self.currentStep += n
+            clock[0] += n * 0.01
+
+    sim = FakeSimulation()
+    deadline = 1000.0 + OpenMMRunner.WALLTIME_MARGIN + 5.0
+    with pytest.raises(OpenMMRunner.WalltimeReached) as stop:
+        OpenMMRunner.step_until(sim, 10000, deadline)
+    assert stop.value.step == 500
+    assert sim.chunks == [OpenMMRunner.WALLTIME_FIRST_CHUNK, 400]
+
+    sim = FakeSimulation()
+    sim.chunks = []
+    OpenMMRunner.step_until(sim, 300, clock[0] + OpenMMRunner.WALLTIME_MARGIN + 60.0)
+    assert sim.currentStep == 300
+
+
+def test_walltime_stop_checkpoints_and_resume_finishes_the_stage(toy_workspace, monkeypatch):
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 5\nnstep = 40\nnstout = 10\nnstdcd = 10\n")
+
+    def stop_after_20(sim, steps, deadline):
+        sim.step(20)
+        raise OpenMMRunner.WalltimeReached(sim.currentStep, 100.0)
+
+    step_until = OpenMMRunner.step_until
+    monkeypatch.setattr(OpenMMRunner, "step_until", stop_after_20)
+    result = OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="run/prod", args_platform="Reference",
+                                         args_max_hours=1.0)
+
+    assert result["walltime"] and result["steps"] == 20
+    assert (toy_workspace / "run/prod.chk").exists()
+    assert (toy_workspace / "run/prod.part.rst").exists()
+    assert not (toy_workspace / "run/prod.rst").exists()
+    assert _dcd_frames(toy_workspace / "run/prod.dcd") == 2
+
+    monkeypatch.setattr(OpenMMRunner, "step_until", step_until)
+    result = OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="run/prod", args_platform="Reference",
+                                         args_resume=True)
+    assert "walltime" not in result
+    rows = (toy_workspace / "run/prod.log").read_text().splitlines()
+    assert [row.split("\t")[1] for row in rows[1:]] == ["10", "20", "30", "40"]
+    assert _dcd_frames(toy_workspace / "run/prod.dcd") == 4
+    assert (toy_workspace / "run/prod.rst").exists()
+
+
+def test_equilibration_monitor_separates_drift_from_stationary_noise():
+    pytest.importorskip("statsmodels")
+    rng = np.random.default_rng(1)
+    columns = OpenMMRunner.EQ_OBSERVABLES
+
+    def monitor_for(pe):
+        monitor = OpenMMRunner.EquilibrationMonitor(alpha=0.05)
+        for value, density in zip(pe, 1.0 + rng.normal(0, 0.001, len(pe))):
+            monitor.update({columns[0]: density, columns[1]: 27.0, columns[2]: value})
+        return monitor
+
+    converged, evidence = monitor_for(-1000.0 + rng.normal(0, 5.0, 400)).test()
+    assert converged
+    assert evidence["Box Volume (nm^3)"] == "constant"
+
+    converged, evidence = monitor_for(-1000.0 + np.linspace(0, 200, 400) + rng.normal(0, 5.0, 400)).test()
+    assert not converged
+    assert "drifting" in evidence["Potential Energy (kJ/mole)"]
+
+    converged, evidence = monitor_for(rng.normal(0, 1.0, 10)).test()
+    assert not converged and "samples" in evidence
+
+
+def test_adaptive_equilibration_ends_the_stage_after_the_minimum(toy_workspace, monkeypatch):
+    pytest.importorskip("statsmodels")
+    (toy_workspace / "eq.inp").write_text("gen_vel = yes\ngen_seed = 5\nnstep = 1000\nnstout = 5\n"
+                                          "eq_adaptive = yes\neq_min_nstep = 60\neq_max_nstep = 200\neq_block = 20\n")
+    tested = []
+
+    def converged_after_min(self):
+        tested.append(len(self.rows))
+        return True, {"Potential Energy (kJ/mole)": "stub"}
+
+    monkeypatch.setattr(OpenMMRunner.EquilibrationMonitor, "test", converged_after_min)
+    result = OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "eq.inp", args_orst="eq/eq", args_platform="Reference")
+
+    assert result["steps"] == 60
+    assert tested == [12]
+    rows = (toy_workspace / "eq/eq.log").read_text().splitlines()[1:]
+    assert rows[-1].split("\t")[1] == "60"
+    assert (toy_workspace / "eq/eq.rst").exists()
+
+    monkeypatch.setattr(OpenMMRunner.EquilibrationMonitor, "test", lambda self: (False, {}))
+    result = OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "eq.inp", args_orst="eq2/eq", args_platform="Reference")
+    assert result["steps"] == 200
+
+
+def test_guard_rolls_back_a_blow_up_and_retries_with_a_smaller_dt(toy_workspace, monkeypatch):
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 5\nnstep = 40\nnstout = 5\nnstdcd = 5\nnstchk = 10\n"
+                                            "guard_nstep = 10\n")
+    check = OpenMMRunner.GuardedStepper.check
+    failed = []
+
+    def blow_up_once_at_20(self):
+        if self.sim.currentStep == 20 and not failed:
+            failed.append(self.good_step)
+            return "injected blow-up", (float("nan"), 0.0)
+        return check(self)
+
+    monkeypatch.setattr(OpenMMRunner.GuardedStepper, "check", blow_up_once_at_20)
+    result = OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="run/prod", args_platform="Reference")
+
+    assert failed == [10]
+    assert result["steps"] == 40
+    rows = [row.split("\t") for row in (toy_workspace / "run/prod.log").read_text().splitlines()[1:]]
+    assert [row[1] for row in rows] == ["5", "10", "15", "20", "25", "30", "35", "40"]
+    # 10 steps at 2 fs, then the retried 30 at 1 fs
+    assert float(rows[-1][2]) == pytest.approx(0.05)
+    assert _dcd_frames(toy_workspace / "run/prod.dcd") == 8
+
+
+def test_guard_gives_up_after_the_retry_budget(toy_workspace, monkeypatch):
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 5\nnstep = 40\nnstout = 5\n"
+                                            "guard_nstep = 10\nguard_retries = 2\n")
+    minimized = []
+    monkeypatch.setattr(OpenMMRunner.GuardedStepper, "check", lambda self: ("injected blow-up", (0.0, 0.0)))
+    monkeypatch.setattr(app.Simulation, "minimizeEnergy", lambda self, **kwargs: minimized.append(kwargs))
+
+    with pytest.raises(OpenMMRunner.SimulationUnstable, match="injected blow-up"):
+        OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="run/prod", args_platform="Reference")
+    # Only the second retry re-minimizes; the first just halves dt
+    assert len(minimized) == 1
+
+
+def test_guard_retry_budget_is_per_step_call(monkeypatch):
+    """Unrelated blow-ups in separate step() calls each get a plain first retry."""
+    simulation = _toy_simulation([[0.1 * i, 0.0, 0.0] for i in range(3)], [(3, [(0, 1), (1, 2)])])
+    inputs = _toy_inputs()
+    inputs.guard_nstep, inputs.guard_retries = 10, 1
+    minimized = []
+    blow_ups = {20, 50}
+    monkeypatch.setattr(OpenMMRunner, "update_integrator", lambda integrator, scaled: None)
+    monkeypatch.setattr(simulation, "minimizeEnergy", lambda **kwargs: minimized.append(kwargs))
+    stepper = OpenMMRunner.GuardedStepper(simulation, inputs)
+    check = OpenMMRunner.GuardedStepper.check
+
+    def fail_once_at(self):
+        if self.sim.currentStep in blow_ups:
+            blow_ups.discard(self.sim.currentStep)
+            return "injected blow-up", (float("nan"), 0.0)
+        return check(self)
+
+    monkeypatch.setattr(OpenMMRunner.GuardedStepper, "check", fail_once_at)
+    stepper.step(30)
+    stepper.step(30)
+
+    assert simulation.currentStep == 60 and not blow_ups
+    assert stepper.retries == 1
+    assert minimized == []
+
+
+def test_structure_session_parses_the_structure_once_per_run(toy_workspace, monkeypatch):
+    """CRD conversion, MDAnalysis restraints and XTC_SEL share one Universe."""
+    universe = pytest.importorskip("MDAnalysis").Universe
+    universes = []
+
+    def counting_universe(*args, **kwargs):
+        universes.append(args)
+        return universe(*args, **kwargs)
+
+    monkeypatch.setattr(OpenMMRunner.mda, "Universe", counting_universe)
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 5\nnstep = 10\nnstout = 5\n"
+                                            "rest = yes\nrest_atom = \"name OH2\"\nrest_k = 100\n"
+                                            "nstxtc = 5\nxtc_sel = \"resid 2\"\n")
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="a/prod", args_platform="Reference")
+    assert universes == [("toy.psf", "toy.pdb")]
+    assert (toy_workspace / "toy.crd.key").exists()
+
+    # A second run reuses the .crd; only the selections need a Universe
+    universes.clear()
+    OpenMMRunner.run_simulation("toy.psf", "toy.pdb", "prod.inp", args_orst="b/prod", args_platform="Reference")
+    assert universes == [("toy.psf", "toy.pdb")]
+
+
+def test_structure_session_revalidates_the_cached_crd(toy_workspace):
+    pytest.importorskip("MDAnalysis")
+    crd = toy_workspace / "toy.crd"
+    OpenMMRunner.StructureSession("toy.psf", "toy.pdb").coordinates()
+    written = crd.stat().st_mtime_ns
+
+    # Same content with a new mtime: the hash matches, the .crd is kept
+    os.utime(toy_workspace / "toy.pdb", ns=(written + 10**9, written + 10**9))
+    stamp = (toy_workspace / "toy.crd.key").read_text()
+    assert OpenMMRunner.StructureSession("toy.psf", "toy.pdb").crd_is_current(str(crd))
+    assert (toy_workspace / "toy.crd.key").read_text() == stamp, "the check itself must not write"
+    OpenMMRunner.StructureSession("toy.psf", "toy.pdb").coordinates()
+    assert json.loads((toy_workspace / "toy.crd.key").read_text())["toy.pdb"]["mtime_ns"] == written + 10**9
+
+    # Moved atoms: the .crd is regenerated from the new PDB
+    pdb = (toy_workspace / "toy.pdb").read_text()
+    (toy_workspace / "toy.pdb").write_text(pdb.replace("   0.000", "   0.500", 1))
+    session = OpenMMRunner.StructureSession("toy.psf", "toy.pdb")
+    assert not session.crd_is_current(str(crd))
+    moved = session.coordinates().positions
+    assert moved[0][0].value_in_unit(unit.nanometer) == pytest.approx(0.05)
+    assert moved == OpenMMRunner.StructureSession("toy.psf", "toy.pdb").coordinates().positions
+    assert OpenMMRunner.StructureSession("toy.psf", "toy.pdb").crd_is_current(str(crd))
+
+    # A .crd from before stamps is trusted without creating one
+    (toy_workspace / "toy.crd.key").unlink()
+    os.utime(crd, ns=(written + 5 * 10**9, written + 5 * 10**9))
+    assert OpenMMRunner.StructureSession("toy.psf", "toy.pdb").crd_is_current(str(crd))
+    assert not (toy_workspace / "toy.crd.key").exists()
+
+
+def test_replica_layout_and_cpu_split():
+    assert OpenMMRunner.replica_prefix("04prod/prod", 3) == os.path.join("04prod", "rep3", "prod")
+    assert OpenMMRunner.replica_prefix("output", 0) == os.path.join("rep0", "output")
+    cpus = list(range(8))
+    assert [OpenMMRunner.replica_cpus(i, 3, cpus) for i in range(3)] == [[0, 1], [2, 3], [4, 5]]
+    assert OpenMMRunner.replica_cpus(5, 16, cpus) == [5]
+
+
+def test_ensemble_runs_seeded_replicas_from_one_system(toy_workspace):
+    (toy_workspace / "prod.inp").write_text("gen_vel = yes\ngen_seed = 7\nnstep = 20\nnstout = 10\n")
+    results = OpenMMRunner.run_ensemble(2, "toy.psf", "toy.pdb", "prod.inp", args_orst="ens/prod", args_platform="Reference")
+
+    assert sorted((r["replica"], r["seed"]) for r in results) == [(0, 7), (1, 8)]
+    for i in range(2):
+        assert (toy_workspace / f"ens/rep{i}/prod.rst").exists()
+        assert len((toy_workspace / f"ens/rep{i}/prod.log").read_text().splitlines()) == 3
+    assert (toy_workspace / "ens/rep0/prod.rst").read_text() != (toy_workspace / "ens/rep1/prod.rst").read_text()
+    summary = (toy_workspace / "ens/ensemble.csv").read_text().splitlines()
+    assert summary[0] == "replica,seed,cpus,steps,seconds,ns_per_day"
+    assert summary[-1].startswith("all,")
+    assert not (toy_workspace / "ens/ensemble_system.xml").exists()
@@ -159,20 +159,23 @@ def test_cli_rejects_invalid_gromacs_environment():
 def test_psf_generators_preserve_box_defaults_and_user_overrides(tmp_path, monkeypatch):
     """Generated TCL records solution and membrane geometry decisions."""
     monkeypatch.chdir(tmp_path)
-    BuildSolution().build("input.psf", "input.pdb", 0.15, "sol", 0)
-    solution = (tmp_path / "PSFGenSol.tcl").read_text()
+    builder = BuildSolution()
+    builder.build("input.psf", "input.pdb", 0.15, "sol", 0)
+    solution = builder.tcl
     assert "set p 18.0" in solution
     assert "STRICT CUBIC" in solution
 
-    BuildSolution().build("input.psf", "input.pdb", 0.15, "sol", 0, padding=20.0, pad_z_pos=30.0)
-    solution = (tmp_path / "PSFGenSol.tcl").read_text()
+    builder.build("input.psf", "input.pdb", 0.15, "sol", 0, padding=20.0, pad_z_pos=30.0)
+    solution = builder.tcl
     assert "set p 20.0" in solution
     assert "set maxz" in solution
 
-    BuildMembrane().build("input.psf", "input.pdb", 0.15, "mem", 0, 0, 10.0)
-    membrane = (tmp_path / "PSFGenMemb.tcl").read_text()
+    membrane_builder = BuildMembrane()
+    membrane_builder.build("input.psf", "input.pdb", 0.15, "mem", 0, 0, 10.0)
+    membrane = membrane_builder.tcl
     assert "set padding 25.0" in membrane
     assert "STRICT XY SQUARE" in membrane
+    assert not list(tmp_path.iterdir())
 
 
 def test_resetpsf_parser_and_apptainer_command(tmp_path, monkeypatch):
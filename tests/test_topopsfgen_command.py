@@ -1,17 +1,38 @@
 """CLI-level coverage for topopsfgen: valid dispatch and env/flag validation."""
 
+import csv
+import os
+
+import pytest
 from click.testing import CliRunner
 
 from mstbx.commands.topopsfgen import topopsfgen
+from mstbx.core.Utils.VMDSession import VMDJobError
 
 
 class FakeBuilder:
-    """Records the arguments passed to build() without touching VMD."""
+    """Records the arguments passed to build() and run() and writes stand-in outputs without VMD."""
 
+    script = "PSFGenSol.tcl"
     calls = []
+    runs = []
+    error = None
+    failing = ()
 
     def build(self, **kwargs):
         FakeBuilder.calls.append(kwargs)
+        self.ofile = kwargs["ofile"]
+
+    def run(self, workdir, log, echo=True):
+        FakeBuilder.runs.append((workdir, log))
+        if FakeBuilder.error:
+            raise FakeBuilder.error
+        if self.ofile in FakeBuilder.failing:
+            raise VMDJobError(f"Tcl error in the {self.ofile} build")
+        with open(os.path.join(workdir, f"{self.ofile}.psf"), "w") as handle:
+            handle.write("PSF\n\n       3 !NATOM\n")
+        with open(os.path.join(workdir, "step3_pbcsetup.str"), "w") as handle:
+            handle.write("SET A = 40.0\nSET B = 40.0\nSET C = 52.5\n")
 
 
 def _inputs(tmp_path):
@@ -22,14 +43,16 @@ def _inputs(tmp_path):
     return psf, pdb
 
 
-def _run(monkeypatch, tmp_path, args):
+def _run(monkeypatch, tmp_path, args, failing=()):
     import mstbx.commands.topopsfgen as command
 
     FakeBuilder.calls = []
+    FakeBuilder.runs = []
+    FakeBuilder.failing = failing
     monkeypatch.setattr(command, "BuildSolution", FakeBuilder)
     monkeypatch.setattr(command, "BuildMembrane", FakeBuilder)
     monkeypatch.setattr(command, "BuildSolutionSMD", FakeBuilder)
-    monkeypatch.setattr(command.os, "system", lambda cmd: 0)
+    monkeypatch.setattr(command.os, "system", lambda cmd: pytest.fail(f"shell command run: {cmd}"))
     monkeypatch.setattr(command.time, "sleep", lambda seconds: None)
     monkeypatch.chdir(tmp_path)
     return CliRunner().invoke(topopsfgen, args)
@@ -46,6 +69,18 @@ def test_topopsfgen_solution_forwards_per_axis_padding(tmp_path, monkeypatch):
 
     assert result.exit_code == 0, result.output
     assert FakeBuilder.calls[0]["pad_z_pos"] == 30.0
+    assert FakeBuilder.runs == [(os.path.join(".", "01build"), "psfgen.log")]
+    assert (tmp_path / "01build" / "input.psf").exists() and (tmp_path / "01build" / "input.pdb").exists()
+
+
+def test_topopsfgen_reports_a_failed_vmd_job(tmp_path, monkeypatch):
+    """A Tcl error in the pooled VMD job fails the command instead of passing silently."""
+    psf, pdb = _inputs(tmp_path)
+    monkeypatch.setattr(FakeBuilder, "error", VMDJobError("Tcl error in PSFGenSol.tcl"))
+    result = _run(monkeypatch, tmp_path, ["--env", "solution", "--psf", str(psf), "--pdb", str(pdb)])
+
+    assert result.exit_code != 0
+    assert "VMD failed while running PSFGenSol.tcl" in result.output
 
 
 def test_topopsfgen_smd_requires_anchor_and_pull(tmp_path, monkeypatch):
@@ -77,6 +112,25 @@ def test_topopsfgen_rejects_solution_padding_flags_outside_solution(tmp_path, mo
     assert not FakeBuilder.calls
 
 
+def test_topopsfgen_native_solvation_is_solution_only(tmp_path, monkeypatch):
+    psf, pdb = _inputs(tmp_path)
+    result = _run(
+        monkeypatch, tmp_path,
+        ["--env", "solution", "--psf", str(psf), "--pdb", str(pdb), "--solvate-backend", "native"],
+    )
+    assert result.exit_code == 0, result.output
+    assert FakeBuilder.calls[0]["solvate_backend"] == "native"
+
+    result = _run(
+        monkeypatch, tmp_path,
+        ["--env", "smd", "--psf", str(psf), "--pdb", str(pdb), "--solvate-backend", "native",
+         "--atoms-anchor", "protein", "--atoms-pull", "resname LIG"],
+    )
+    assert result.exit_code != 0
+    assert "--solvate-backend" in result.output
+    assert not FakeBuilder.calls
+
+
 def test_topopsfgen_rejects_membrane_flags_outside_membrane(tmp_path, monkeypatch):
     psf, pdb = _inputs(tmp_path)
     result = _run(
@@ -110,5 +164,52 @@ def test_topopsfgen_help_groups_options_by_env():
     for title in [
         "Common Options", "Solution per-axis padding (trigger: --env solution)",
         "Membrane Options (trigger: --env membrane)", "SMD Options (trigger: --env smd)",
+        "Solvation (trigger: --env solution)",
     ]:
         assert title in result.output, title
+
+
+def test_topopsfgen_manifest_builds_each_system_in_its_own_directory(tmp_path, monkeypatch):
+    """Batch mode builds every row concurrently, keeps going past a failure and writes a summary."""
+    psf, pdb = _inputs(tmp_path)
+    (tmp_path / "systems.csv").write_text(
+        "name,env,psf,pdb,ofile,atoms_anchor,atoms_pull\n"
+        "wt,solution,input.psf,input.pdb,wt150,,\n"
+        "pull,smd,input.psf,input.pdb,pull150,protein,resname LIG\n"
+        "mut,,input.psf,input.pdb,broken,,\n"
+    )
+    import mstbx.commands.topopsfgen as command
+
+    sizes = []
+    monkeypatch.setattr(command, "vmd_pool", sizes.append)
+    result = _run(monkeypatch, tmp_path, ["--env", "solution", "--manifest", "systems.csv", "--jobs", "2"],
+                  failing=("broken",))
+
+    assert result.exit_code != 0
+    assert sizes == [2]
+    assert os.getcwd() == str(tmp_path)
+    assert "1 of 3 system(s) failed: mut" in result.output
+    for name, ofile in (("wt", "wt150"), ("pull", "pull150")):
+        assert (tmp_path / name / "01build" / f"{ofile}.psf").exists()
+        assert (tmp_path / name / "input.psf").exists()
+    with open(tmp_path / "systems_summary.csv") as handle:
+        rows = {row["name"]: row for row in csv.DictReader(handle)}
+    assert rows["wt"]["status"] == rows["pull"]["status"] == "ok"
+    assert rows["pull"]["env"] == "smd" and rows["pull"]["atoms"] == "3"
+    assert rows["wt"]["box"] == "40.0 x 40.0 x 52.5"
+    assert rows["mut"]["status"] == "failed" and "broken" in rows["mut"]["error"]
+
+
+def test_topopsfgen_manifest_rows_are_validated_before_building(tmp_path, monkeypatch):
+    """A row with a flag from another env is rejected with its line number and nothing is built."""
+    psf, pdb = _inputs(tmp_path)
+    (tmp_path / "systems.csv").write_text(
+        "name,env,psf,pdb,z_distance\n"
+        "ok,membrane,input.psf,input.pdb,12\n"
+        "bad,solution,input.psf,input.pdb,12\n"
+    )
+    result = _run(monkeypatch, tmp_path, ["--manifest", "systems.csv"])
+
+    assert result.exit_code != 0
+    assert "line 3 (bad)" in result.output and "--z-distance" in result.output
+    assert not FakeBuilder.calls
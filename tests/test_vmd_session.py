@@ -0,0 +1,132 @@
+"""Persistent VMD worker pool, driven by ``tclsh`` standing in for ``vmd -dispdev text``."""
+
+import os
+import shutil
+
+import pytest
+
+from mstbx.core.Utils import VMDSession
+from mstbx.core.Utils.VMDSession import VMDJobError, VMDPool
+
+TCLSH = shutil.which("tclsh")
+pytestmark = pytest.mark.skipif(TCLSH is None, reason="tclsh is not installed")
+
+
+@pytest.fixture
+def fake_vmd(tmp_path, monkeypatch):
+    """A ``vmd`` on PATH that is a plain Tcl shell; VMD-only commands fail inside ``catch``."""
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (bindir / "vmd").write_text(f'#!/bin/sh\nexec {TCLSH} "$@"\n')
+    (bindir / "vmd").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _job(directory, body):
+    directory.mkdir(exist_ok=True)
+    (directory / "job.tcl").write_text(body)
+    return directory
+
+
+def test_jobs_run_in_their_own_directory_on_one_long_lived_worker(fake_vmd):
+    first = _job(fake_vmd / "first", 'set leaked 1\nset f [open out.txt w]\nputs $f [pwd]\nclose $f\nputs "pid [pid]"\nquit\nputs unreachable\n')
+    second = _job(fake_vmd / "second", 'puts "leaked [info exists leaked]"\nputs "pid [pid]"\n')
+
+    with VMDPool(1) as pool:
+        output = pool.run("job.tcl", cwd="first", log="first/job.log")
+        again = pool.run("job.tcl", cwd="second")
+
+    assert (first / "out.txt").read_text().strip() == str(first)
+    assert (first / "job.log").read_text() == output
+    assert "unreachable" not in output
+    assert "leaked 0" in again
+    assert output.split("pid ")[1] == again.split("pid ")[1]
+    assert os.getcwd() == str(fake_vmd)
+    assert not (second / "out.txt").exists()
+
+
+def test_a_failed_job_raises_and_recycles_its_worker(fake_vmd):
+    _job(fake_vmd / "bad", "puts [pid]\nerror boom\n")
+    _job(fake_vmd / "good", "puts [pid]\n")
+
+    with VMDPool(1) as pool:
+        with pytest.raises(VMDJobError) as failure:
+            pool.run("job.tcl", cwd="bad", log="bad/job.log")
+        good = pool.run("job.tcl", cwd="good")
+
+    assert "boom" in failure.value.output
+    assert "boom" in (fake_vmd / "bad/job.log").read_text()
+    assert pool.recycled == 1
+    assert good.split()[0] != failure.value.output.split()[0]
+
+
+def test_the_pool_runs_jobs_concurrently(fake_vmd):
+    jobs = [_job(fake_vmd / f"job{i}", "after 300\nputs [pid]\n") for i in range(4)]
+
+    with VMDPool(4) as pool:
+        futures = [pool.submit("job.tcl", cwd=str(job)) for job in jobs]
+        pids = {future.result().strip() for future in futures}
+
+    assert len(pids) == 4
+
+
+def test_a_grown_pool_keeps_its_warm_workers_and_adds_more(fake_vmd):
+    jobs = [_job(fake_vmd / f"job{i}", "after 300\nputs [pid]\n") for i in range(3)]
+
+    with VMDPool(1) as pool:
+        warm = pool.run("job.tcl", cwd=str(jobs[0])).strip()
+        pool.grow(3)
+        pool.grow(2)
+        futures = [pool.submit("job.tcl", cwd=str(job)) for job in jobs]
+        pids = {future.result().strip() for future in futures}
+
+    assert pool.size == 3
+    assert len(pids) == 3 and warm in pids
+
+
+def test_run_tcl_falls_back_to_one_shot_vmd(fake_vmd, monkeypatch):
+    calls = []
+
+    class Result:
+        returncode = 0
+        stdout = "Info) done\n"
+
+    def fake_run(command, **kwargs):
+        calls.append((command, kwargs["cwd"]))
+        return Result()
+
+    monkeypatch.setenv("MSTBX_VMD_WORKERS", "0")
+    monkeypatch.setattr(VMDSession.subprocess, "run", fake_run)
+    VMDSession.run_tcl("PSFGenSol.tcl", cwd="01build", log="psfgen.log", echo=False)
+
+    assert calls == [(["vmd", "-dispdev", "text", "-e", "PSFGenSol.tcl"], "01build")]
+    assert (fake_vmd / "psfgen.log").read_text() == "Info) done\n"
+
+
+def test_build_jobs_promote_only_final_outputs_from_a_private_scratch(fake_vmd, monkeypatch):
+    from mstbx.core.Build.BuildJob import build_outputs, run_build_job
+
+    script = ('foreach name {solvated.pdb ionized.psf sys.psf sys.pdb step3_pbcsetup.str} '
+              '{ set f [open $name w]; puts $f [file tail [pwd]]; close $f }\nputs built\n')
+    (fake_vmd / "step3_pbcsetup.str").write_text("previous build\n")
+
+    with VMDPool(1) as pool:
+        monkeypatch.setattr(VMDSession, "_POOL", pool)
+        promoted = run_build_job("PSFGenSol.tcl", script, build_outputs("sys", 0), str(fake_vmd), prefix="sys-sol",
+                                 echo=False)
+        with pytest.raises(VMDJobError) as failure:
+            run_build_job("PSFGenSol.tcl", script.replace("sys.pdb ", "") + "error late\n", build_outputs("other", 0),
+                          str(fake_vmd), prefix="other-sol", echo=False)
+
+    scratch_name = (fake_vmd / "sys.psf").read_text().strip()
+    assert scratch_name.startswith(".sys-sol-")
+    assert [os.path.basename(path) for path in promoted] == ["sys.psf", "sys.pdb", "step3_pbcsetup.str", "psfgen.log"]
+    assert not (fake_vmd / "solvated.pdb").exists() and not (fake_vmd / scratch_name).exists()
+    assert (fake_vmd / "step3_pbcsetup.str").read_text().strip() == scratch_name
+    assert not (fake_vmd / "other.psf").exists()
+    kept = [path for path in fake_vmd.iterdir() if path.name.startswith(".other-sol-")]
+    assert len(kept) == 1 and str(kept[0]) in str(failure.value)
+    assert "late" in (fake_vmd / "psfgen.log").read_text()
+    assert not (fake_vmd / "PSFGenSol.tcl").exists()